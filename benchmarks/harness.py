@@ -0,0 +1,176 @@
+# benchmarks/harness.py
+#
+# Registration, measurement and baseline comparison for the dform benchmarks
+import gc, platform, random, time
+from collections import OrderedDict
+
+import django
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+try:
+    import tracemalloc
+except ImportError:      # pragma: no cover, python 2.7
+    tracemalloc = None
+
+try:
+    from time import perf_counter
+except ImportError:      # pragma: no cover, python 2.7
+    from timeit import default_timer as perf_counter
+
+BENCHMARKS = OrderedDict()
+
+# ============================================================================
+
+class Benchmark(object):
+    """A named piece of code to be timed.  ``setup`` is called once per scale
+    and its return value is passed to each call of ``run``; setup time is not
+    measured.
+    """
+    def __init__(self, name, setup, run, scales=None):
+        self.name = name
+        self.setup = setup
+        self.run = run
+        self.scales = scales
+
+
+def benchmark(name, setup=None, scales=None):
+    """Decorator registering the decorated function as the ``run`` part of a
+    :class:`Benchmark`.
+
+    :param name:
+        Unique name for the benchmark, used as the key in result files
+    :param setup:
+        Function taking the scale and returning the context for ``run``
+    :param scales:
+        Optional list of scales overriding the ones given on the command
+        line, for benchmarks where only some sizes make sense
+    """
+    def decorator(fn):
+        BENCHMARKS[name] = Benchmark(name, setup or (lambda scale: None), fn,
+            scales)
+        return fn
+    return decorator
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class _Run(object):
+    # Context manager for a single run: anything the run writes is rolled
+    # back to a savepoint afterwards and the random module is re-seeded, so
+    # every run starts from the same state as the first
+    def __enter__(self):
+        random.seed(1)
+        gc.collect()
+        self.savepoint = transaction.savepoint()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        transaction.savepoint_rollback(self.savepoint)
+
+
+def measure(bench, scale, repeat):
+    """Runs the benchmark at the given scale inside a transaction that is
+    rolled back afterwards, so each benchmark sees only its own data.  Each
+    run is also rolled back, so benchmarks that write, like submitting a
+    survey or creating a new version, time the same work every repeat.
+
+    :returns:
+        dictionary with wall time stats (seconds), the number of queries
+        and the peak memory (bytes) allocated during a single run
+    """
+    with transaction.atomic():
+        context = bench.setup(scale)
+
+        # one run to warm up caches and count queries
+        with _Run(), CaptureQueriesContext(connection) as captured:
+            bench.run(context)
+        queries = len(captured.captured_queries)
+
+        times = []
+        for _ in range(repeat):
+            with _Run():
+                start = perf_counter()
+                bench.run(context)
+                times.append(perf_counter() - start)
+
+        peak = None
+        if tracemalloc:
+            # memory is a separate run, tracing slows everything down
+            with _Run():
+                tracemalloc.start()
+                bench.run(context)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+        transaction.set_rollback(True)
+
+    return OrderedDict([
+        ('wall', OrderedDict([
+            ('min', min(times)),
+            ('median', _median(times)),
+            ('max', max(times)),
+        ])),
+        ('queries', queries),
+        ('peak_memory', peak),
+    ])
+
+
+def run_benchmarks(names, scales, repeat, report=None):
+    """Runs the named benchmarks at each scale and returns the results in the
+    structure written to the JSON output file."""
+    results = OrderedDict()
+    for name in names:
+        bench = BENCHMARKS[name]
+        results[name] = OrderedDict()
+        for scale in (bench.scales or scales):
+            result = measure(bench, scale, repeat)
+            results[name][str(scale)] = result
+            if report:
+                report(name, scale, result)
+
+    return OrderedDict([
+        ('meta', OrderedDict([
+            ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+            ('python', platform.python_version()),
+            ('django', django.get_version()),
+            ('database', connection.vendor),
+            ('repeat', repeat),
+        ])),
+        ('results', results),
+    ])
+
+
+def compare(results, baseline, threshold):
+    """Compares a set of results against a baseline set.  A regression is
+    a median wall time more than ``threshold`` (fraction) slower than the
+    baseline, or any increase in the number of queries.
+
+    :returns:
+        list of strings describing each regression
+    """
+    regressions = []
+    for name, scales in results['results'].items():
+        for scale, result in scales.items():
+            try:
+                base = baseline['results'][name][scale]
+            except KeyError:
+                continue
+
+            now = result['wall']['median']
+            then = base['wall']['median']
+            if then and now > then * (1 + threshold):
+                regressions.append('%s[%s]: median %.4fs vs %.4fs (+%d%%)' % (
+                    name, scale, now, then, 100 * (now - then) / then))
+
+            if result['queries'] > base['queries']:
+                regressions.append('%s[%s]: %s queries vs %s' % (name, scale,
+                    result['queries'], base['queries']))
+
+    return regressions
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# benchmarks/run.py
+#
+# Runs the dform benchmarks and writes the results as JSON.  Uses the
+# settings from load_tests.py unless --settings is given; either way the
+# benchmarks run in a freshly created test database.
+#
+#   $ python benchmarks/run.py --output new.json --baseline old.json
+import argparse, json, os, sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import django
+
+# ============================================================================
+
+def setup_django(settings_module):
+    if settings_module:
+        os.environ['DJANGO_SETTINGS_MODULE'] = settings_module
+        django.setup()
+    else:
+        import load_tests
+        load_tests.configure()
+
+    # time things the way they run in production
+    from django.conf import settings
+    settings.DEBUG = False
+
+
+def report(name, scale, result):
+    memory = result['peak_memory']
+    memory = '%.1fKB' % (memory / 1024.0) if memory is not None else '-'
+    print('%-30s %6s  %9.4fs  %5d queries  %10s' % (name, scale,
+        result['wall']['median'], result['queries'], memory))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--settings', default='',
+        help='Django settings module, defaults to the load_tests.py settings')
+    parser.add_argument('--scales', default='10,100,1000',
+        help='Comma separated list of data scales')
+    parser.add_argument('--repeat', type=int, default=5,
+        help='Number of timed runs per benchmark and scale')
+    parser.add_argument('--only', action='append', default=[],
+        help='Name of a benchmark to run, can be given more than once')
+    parser.add_argument('--list', action='store_true',
+        help='List the available benchmarks and exit')
+    parser.add_argument('--output', default='',
+        help='File to write the JSON results to')
+    parser.add_argument('--baseline', default='',
+        help='JSON results file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+        help='Fraction slower than the baseline that counts as a regression')
+    parser.add_argument('--keepdb', action='store_true',
+        help='Keep the test database between runs')
+    args = parser.parse_args()
+
+    setup_django(args.settings)
+
+    from django.db import connection
+    from django.test.utils import (setup_test_environment,
+        teardown_test_environment)
+
+    from harness import BENCHMARKS, run_benchmarks, compare
+    import suite   # noqa, registers the benchmarks
+
+    if args.list:
+        for name in BENCHMARKS.keys():
+            print(name)
+        return 0
+
+    names = args.only or list(BENCHMARKS.keys())
+    unknown = set(names) - set(BENCHMARKS.keys())
+    if unknown:
+        parser.error('Unknown benchmarks: %s' % ', '.join(sorted(unknown)))
+
+    scales = [int(scale) for scale in args.scales.split(',')]
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0,
+        keepdb=args.keepdb)
+    try:
+        results = run_benchmarks(names, scales, args.repeat, report)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0,
+            keepdb=args.keepdb)
+        teardown_test_environment()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('\nRegressions against %s:' % args.baseline)
+            for regression in regressions:
+                print('  ' + regression)
+            return 1
+
+        print('\nNo regressions against %s' % args.baseline)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,203 @@
+# benchmarks/suite.py
+#
+# The benchmarks for dform's hot paths.  Unless noted otherwise the scale is
+# the number of questions in the survey being exercised.
+import datetime, random
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.test import Client
+from django.utils import timezone
+from six import StringIO
+
+from dform.export import export_changes
+from dform.forms import SurveyForm
+from dform.models import Survey, AnswerGroup, Answer
+from dform.results import ResultsTable
+from dform.sampledata import AnswerGenerator, form_value
+from dform.transfer import clone_survey, write_surveys
+
+from harness import benchmark
+
+# ============================================================================
+# Data Builders
+# ============================================================================
+
+def build_surveys(surveys=1, questions=10, groups=0):
+    """Builds data with the ``dform_generate_data`` command, returns the most
+    recently created survey."""
+    call_command('dform_generate_data', surveys=surveys, questions=questions,
+        groups=groups, answer_rate=1.0, seed=1, stdout=StringIO())
+    return Survey.objects.order_by('-id')[0]
+
+
+def post_data(version, seed=1):
+    generator = AnswerGenerator(random.Random(seed), answer_rate=1.0)
+    data = {}
+    for question in version.questions():
+        data['q_%s' % question.id] = form_value(question,
+            generator.value(question))
+
+    return data
+
+
+def admin_client():
+    user = User.objects.create_superuser('bench', 'bench@example.com', 'x')
+    client = Client()
+    client.force_login(user)
+    return client
+
+# ============================================================================
+# Survey Views
+# ============================================================================
+
+def setup_survey(scale):
+    survey = build_surveys(questions=scale)
+    version = survey.latest_version
+    return {
+        'client':Client(),
+        'version':version,
+        'url':reverse('dform-survey', args=(version.id, survey.token)),
+    }
+
+
+@benchmark('survey_render', setup_survey)
+def survey_render(context):
+    response = context['client'].get(context['url'])
+    assert response.status_code == 200
+
+
+def setup_submit(scale):
+    context = setup_survey(scale)
+    context['data'] = post_data(context['version'])
+    return context
+
+
+@benchmark('survey_submit', setup_submit)
+def survey_submit(context):
+    form = SurveyForm(context['data'], survey_version=context['version'],
+        ip_address='127.0.0.1')
+    assert form.is_valid(), form.errors
+    form.save()
+
+
+def setup_with_answers(scale):
+    survey = build_surveys(questions=scale, groups=1)
+    version = survey.latest_version
+    group = AnswerGroup.objects.filter(survey_version=version)[0]
+    return {
+        'client':Client(),
+        'url':reverse('dform-survey-with-answers', args=(version.id,
+            survey.token, group.id, group.token)),
+    }
+
+
+@benchmark('survey_with_answers', setup_with_answers)
+def survey_with_answers(context):
+    response = context['client'].get(context['url'])
+    assert response.status_code == 200
+
+# ============================================================================
+# Survey Editing
+# ============================================================================
+
+def setup_replace(scale):
+    survey = build_surveys(questions=scale)
+    data = survey.to_dict()
+    for q_data in data['questions']:
+        q_data['text'] += ' (edited)'
+
+    return {
+        'version':survey.latest_version,
+        'data':data,
+    }
+
+
+@benchmark('replace_from_dict', setup_replace, scales=[10, 100, 1000])
+def replace_from_dict(context):
+    context['version'].replace_from_dict(context['data'])
+
+
+@benchmark('new_version', lambda scale: build_surveys(questions=scale))
+def new_version(survey):
+    survey.new_version()
+
+# ============================================================================
+# Answer Exports -- scale is the number of AnswerGroups, 10 questions each
+# ============================================================================
+
+def setup_export(scale):
+    survey = build_surveys(questions=10, groups=scale)
+
+    # older than the export lag, which skips rows changed in the last seconds
+    past = timezone.now() - datetime.timedelta(hours=1)
+    AnswerGroup.objects.filter(survey_version__survey=survey).update(
+        created=past, updated=past)
+    Answer.objects.filter(answer_group__survey_version__survey=survey).update(
+        created=past, updated=past)
+    return survey
+
+
+@benchmark('export_changes', setup_export)
+def export_all_changes(survey):
+    cursor = ''
+    while True:
+        export = export_changes(survey, cursor, limit=500)
+        cursor = export.cursor
+        if not export.has_more:
+            break
+
+
+def setup_results(scale):
+    survey = build_surveys(questions=10, groups=scale)
+    return ResultsTable(survey.latest_version)
+
+
+@benchmark('results_table_rebuild', setup_results)
+def results_table_rebuild(table):
+    table.rebuild()
+
+# ============================================================================
+# Survey Transfer
+# ============================================================================
+
+@benchmark('export_surveys', lambda scale: build_surveys(surveys=10,
+    questions=scale))
+def export_surveys(survey):
+    write_surveys(Survey.objects.all(), StringIO())
+
+
+@benchmark('clone_survey', lambda scale: build_surveys(questions=scale))
+def clone(survey):
+    clone_survey(survey)
+
+# ============================================================================
+# Admin Change Lists -- scale is the number of AnswerGroups (or Surveys)
+# ============================================================================
+
+def setup_changelist(name, **kwargs):
+    def setup(scale):
+        params = {'questions':10, 'groups':scale}
+        params.update(kwargs)
+        if 'surveys' in params:
+            params['surveys'] = scale
+
+        build_surveys(**params)
+        return {
+            'client':admin_client(),
+            'url':reverse('admin:dform_%s_changelist' % name),
+        }
+    return setup
+
+
+def changelist(context):
+    response = context['client'].get(context['url'])
+    assert response.status_code == 200
+
+
+benchmark('admin_survey_changelist', setup_changelist('survey', surveys=0,
+    questions=5, groups=2))(changelist)
+benchmark('admin_answergroup_changelist',
+    setup_changelist('answergroup'))(changelist)
+benchmark('admin_answer_changelist', setup_changelist('answer'))(changelist)
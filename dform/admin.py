@@ -1,17 +1,22 @@
 from django.contrib import admin
 from django.core.urlresolvers import reverse, NoReverseMatch
+from django.http import QueryDict
 
 from awl.admintools import make_admin_obj_mixin
 from awl.rankedmodel.admintools import admin_link_move_up, admin_link_move_down
 
 from .fields import FIELD_CHOICES_DICT
 from .models import (Survey, SurveyVersion, Question, QuestionOrder, Answer,
-    AnswerGroup)
+    AnswerGroup, prefetch_group_data)
+from .paginator import EstimatedCountPaginator
+from .sharding import shard_databases
 
 # ============================================================================
 
-def _questions_link(version, show_reorder=True):
-    num_q = Question.objects.filter(survey_versions=version).count()
+def _questions_link(version, show_reorder=True, num_q=None):
+    if num_q is None:
+        num_q = Question.objects.filter(survey_versions=version).count()
+
     if num_q == 0:
         return ''
 
@@ -35,6 +40,116 @@ def _questions_link(version, show_reorder=True):
 
     return '&nbsp;|&nbsp'.join(urls)
 
+
+def _count_subselect(model, fk_name, outer_model, outer_column='id'):
+    # returns SQL for a correlated sub-select counting the rows of "model"
+    # that point at the outer row through "fk_name"; used with extra() so the
+    # count is only calculated for the rows on the displayed page
+    fk_column = model._meta.get_field(fk_name).column
+    return 'SELECT COUNT(*) FROM %s WHERE %s.%s = %s.%s' % (
+        model._meta.db_table, model._meta.db_table, fk_column,
+        outer_model._meta.db_table, outer_column)
+
+
+def _shard_query(alias, separator='&'):
+    # query string argument pointing the answer admins at a shard
+    if not alias:
+        return ''
+
+    return '%sshard=%s' % (separator, alias)
+
+
+def _shard_of(obj):
+    # alias of the shard an answer object was loaded from, or None
+    if obj._state.db in shard_databases():
+        return obj._state.db
+
+    return None
+
+
+class ShardListFilter(admin.SimpleListFilter):
+    """Chooses the database sharded answers are listed from.  Ids are only
+    unique within a database so the shards aren't merged into one list."""
+    title = 'shard'
+    parameter_name = 'shard'
+
+    def lookups(self, request, model_admin):
+        return [(alias, alias) for alias in shard_databases()]
+
+    def choices(self, changelist):
+        for num, choice in enumerate(super(ShardListFilter, self).choices(
+                changelist)):
+            if num == 0:
+                choice['display'] = 'Default'
+            yield choice
+
+    def queryset(self, request, queryset):
+        # ShardAdminMixin.get_queryset() has already picked the database
+        return queryset
+
+
+class ShardAdminMixin(object):
+    """Mixin for the :class:`AnswerGroup` and :class:`Answer` admins that
+    reads and writes the shard named in the ``shard`` query argument, see
+    :mod:`dform.sharding`.
+    """
+    def get_shard(self, request):
+        shard = request.GET.get('shard')
+        if not shard:
+            # change forms opened from a filtered change list
+            filters = QueryDict(request.GET.get('_changelist_filters', ''))
+            shard = filters.get('shard')
+
+        if shard in shard_databases():
+            return shard
+
+        return None
+
+    def get_list_filter(self, request):
+        list_filter = super(ShardAdminMixin, self).get_list_filter(request)
+        if shard_databases():
+            return (ShardListFilter, ) + tuple(list_filter)
+
+        return list_filter
+
+    def get_queryset(self, request):
+        qs = super(ShardAdminMixin, self).get_queryset(request)
+        shard = self.get_shard(request)
+        if shard:
+            qs = qs.using(shard)
+
+        return qs
+
+
+class KeysetChangeListMixin(object):
+    """Mixin for :class:`ModelAdmin` classes of very large tables.  Deep
+    pages of a change list use ``OFFSET`` which gets slower the further you
+    go, this adds an "Older" link to the template context that filters on
+    ``id__lt`` of the last row shown instead.  The link is only provided when
+    the change list is in its default ``-id`` ordering.
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    ordering = ('-id', )
+
+    def changelist_view(self, request, extra_context=None):
+        response = super(KeysetChangeListMixin, self).changelist_view(request,
+            extra_context)
+
+        context = getattr(response, 'context_data', None)
+        if not context or 'cl' not in context:
+            # redirects and error pages
+            return response
+
+        cl = context['cl']
+        if cl.multi_page and 'o' not in cl.params:
+            ids = [obj.id for obj in cl.result_list]
+            if ids:
+                context['keyset_url'] = cl.get_query_string(
+                    {'id__lt':min(ids)}, ['p', 'id__lt'])
+
+        return response
+
 # ============================================================================
 # Surveys
 # ============================================================================
@@ -43,6 +158,8 @@ def _questions_link(version, show_reorder=True):
 class SurveyAdmin(admin.ModelAdmin):
     list_display = ('id', 'name', 'version_num', 'use_recaptcha', 
         'show_actions', 'show_versions', 'show_questions', 'show_answers')
+    # changing storage needs the answers moved, see dform_convert_storage
+    readonly_fields = ('answer_storage', )
 
     def version_num(self, obj):
         return '%s' % obj.latest_version.version_num
@@ -92,7 +209,9 @@ class SurveyAdmin(admin.ModelAdmin):
     show_questions.allow_tags = True
 
     def show_answers(self, obj):
-        num_a = AnswerGroup.objects.filter(survey_version__survey=obj).count()
+        shard = obj.answer_database
+        num_a = AnswerGroup.objects.using(shard).filter(
+            survey_version__survey=obj).count()
         if num_a == 0:
             return ''
 
@@ -102,8 +221,17 @@ class SurveyAdmin(admin.ModelAdmin):
 
         link = reverse('admin:dform_answergroup_changelist')
 
-        u = '<a href="%s?survey_version__survey__id=%s">%s Answer Set%s</a>' % (
-            link, obj.id, num_a, plural)
+        if shard:
+            # surveys aren't on the shard, filter by the version ids
+            ids = SurveyVersion.objects.filter(survey=obj).values_list('id',
+                flat=True)
+            query = 'survey_version__id__in=%s%s' % (
+                ','.join(str(id) for id in ids), _shard_query(shard))
+        else:
+            query = 'survey_version__survey__id=%s' % obj.id
+
+        u = '<a href="%s?%s">%s Answer Set%s</a>' % (link, query, num_a,
+            plural)
         return u
     show_answers.short_description = 'All Answer Sets'
     show_answers.allow_tags = True
@@ -146,7 +274,7 @@ class SurveyVersionAdmin(admin.ModelAdmin, mixin):
     show_questions.allow_tags = True
 
     def show_answers(self, obj):
-        num_a = AnswerGroup.objects.filter(survey_version=obj).count()
+        num_a = obj.answer_groups().count()
         if num_a == 0:
             return ''
 
@@ -156,8 +284,8 @@ class SurveyVersionAdmin(admin.ModelAdmin, mixin):
 
         link = reverse('admin:dform_answergroup_changelist')
 
-        url = '<a href="%s?survey_version__id=%s">%s Answer Set%s</a>' % (link,
-            obj.id, num_a, plural)
+        url = '<a href="%s?survey_version__id=%s%s">%s Answer Set%s</a>' % (
+            link, obj.id, _shard_query(obj.answer_database), num_a, plural)
         return url
     show_answers.short_description = 'Answer Sets'
     show_answers.allow_tags = True
@@ -181,7 +309,8 @@ class QuestionAdmin(admin.ModelAdmin):
     show_reorder.allow_tags = True
 
     def show_answers(self, obj):
-        num_a = Answer.objects.filter(question=obj).count()
+        shard = obj.survey.answer_database
+        num_a = Answer.objects.using(shard).filter(question=obj).count()
         if num_a == 0:
             return ''
 
@@ -190,8 +319,8 @@ class QuestionAdmin(admin.ModelAdmin):
             plural = 's'
 
         link = reverse('admin:dform_answer_changelist')
-        url = '<a href="%s?question__id=%s">%s Answer%s</a>'  % (link, obj.id, 
-            num_a, plural)
+        url = '<a href="%s?question__id=%s%s">%s Answer%s</a>'  % (link,
+            obj.id, _shard_query(shard), num_a, plural)
         return url
     show_answers.short_description = 'Answers'
     show_answers.allow_tags = True
@@ -227,9 +356,34 @@ mixin.add_obj_link('show_question', 'question',
     display='Question.id={{obj.id}}')
 
 @admin.register(Answer)
-class AnswerAdmin(admin.ModelAdmin, mixin):
+class AnswerAdmin(ShardAdminMixin, KeysetChangeListMixin, admin.ModelAdmin,
+        mixin):
     list_display = ('id', 'show_group', 'show_question', 'show_text', 
         'show_field_key', 'value')
+    list_select_related = ('question', 'answer_group')
+
+    def get_list_select_related(self, request):
+        if self.get_shard(request):
+            # questions are on the default database, they're prefetched
+            return ('answer_group', )
+
+        return self.list_select_related
+
+    def get_queryset(self, request):
+        qs = super(AnswerAdmin, self).get_queryset(request)
+        if self.get_shard(request):
+            qs = qs.prefetch_related('question')
+
+        return qs
+
+    def show_group(self, obj):
+        link = reverse('admin:dform_answergroup_change',
+            args=(obj.answer_group_id, ))
+        return '<a href="%s%s">AnswerGroup.id=%s</a>' % (link,
+            _shard_query(_shard_of(obj), '?'),
+            obj.answer_group_id)
+    show_group.short_description = 'Answer Group'
+    show_group.allow_tags = True
 
     def show_text(self, obj):
         return obj.question.text
@@ -246,24 +400,82 @@ mixin.add_obj_link('show_version', 'survey_version', 'Survey Version',
     display='{{obj.survey.name}} (v={{obj.id}})')
 
 @admin.register(AnswerGroup)
-class AnswerGroupAdmin(admin.ModelAdmin, mixin):
+class AnswerGroupAdmin(ShardAdminMixin, KeysetChangeListMixin,
+        admin.ModelAdmin, mixin):
     list_display = ('id', 'updated', 'show_version', 'show_data',
         'ip_address', 'show_questions', 'show_answers', 'show_actions')
+    list_select_related = ('survey_version', 'survey_version__survey')
+
+    # fields loaded for "Group Data", see prefetch_group_data()
+    group_data_only = None
+
+    def get_list_select_related(self, request):
+        if self.get_shard(request):
+            return False
+
+        return self.list_select_related
+
+    def changelist_view(self, request, extra_context=None):
+        response = super(AnswerGroupAdmin, self).changelist_view(request,
+            extra_context)
+
+        context = getattr(response, 'context_data', None)
+        if context and 'cl' in context:
+            # one query per content type for the page, rendered later from
+            # the same objects
+            prefetch_group_data(context['cl'].result_list,
+                self.group_data_only)
+
+        return response
+
+    def get_queryset(self, request):
+        qs = super(AnswerGroupAdmin, self).get_queryset(request)
+        select = {
+            'num_answers':_count_subselect(Answer, 'answer_group',
+                AnswerGroup),
+        }
+
+        if self.get_shard(request):
+            # versions and questions are only on the default database
+            return qs.extra(select=select).prefetch_related(
+                'survey_version__survey')
+
+        through = Question.survey_versions.through
+        select['num_questions'] = _count_subselect(through, 'surveyversion',
+            AnswerGroup, 'survey_version_id')
+        return qs.extra(select=select)
 
     def lookup_allowed(self, key, value):
         # enable cross FK lookups for this admin object
-        if key in ('survey_version__survey__id', ):
+        if key in ('survey_version__survey__id', 'survey_version__id__in'):
             return True
 
         return super(AnswerGroupAdmin, self).lookup_allowed(key, value)
 
     def show_questions(self, obj):
-        return _questions_link(obj.survey_version, False)
+        return _questions_link(obj.survey_version, False,
+            getattr(obj, 'num_questions', None))
     show_questions.short_description = 'Questions'
     show_questions.allow_tags = True
 
     def show_answers(self, obj):
-        num_a = Answer.objects.filter(answer_group=obj).count()
+        if obj.survey_version.survey.answer_storage == 'document':
+            # no Answer rows to link to
+            num_a = len(obj.document)
+            if num_a == 0:
+                return ''
+
+            plural = ''
+            if num_a > 1:
+                plural = 's'
+
+            return '%s Answer%s' % (num_a, plural)
+
+        num_a = getattr(obj, 'num_answers', None)
+        if num_a is None:
+            num_a = Answer.objects.using(obj._state.db).filter(
+                answer_group=obj).count()
+
         if num_a == 0:
             return ''
 
@@ -273,8 +485,8 @@ class AnswerGroupAdmin(admin.ModelAdmin, mixin):
 
         link = reverse('admin:dform_answer_changelist')
 
-        url = '<a href="%s?answer_group__id=%s">%s Answer%s</a>' % (link,
-            obj.id, num_a, plural)
+        url = '<a href="%s?answer_group__id=%s%s">%s Answer%s</a>' % (link,
+            obj.id, _shard_query(_shard_of(obj)), num_a, plural)
         return url
     show_answers.short_description = 'Answers'
     show_answers.allow_tags = True
@@ -288,7 +500,8 @@ class AnswerGroupAdmin(admin.ModelAdmin, mixin):
             actions.append('<a href="%s">Change Answers</a>' % url)
 
             url = reverse('dform-answer-links', args=(obj.id,))
-            actions.append('<a href="%s">Show Links</a>' % url)
+            actions.append('<a href="%s%s">Show Links</a>' % (url,
+                _shard_query(_shard_of(obj), '?')))
         except NoReverseMatch:
             # views aren't guarnteed to be there
             pass
@@ -9,4 +9,11 @@ urlpatterns = [
 
     url(r'^survey_links/(\d+)/$', v.survey_links, name='dform-survey-links'),
     url(r'^answer_links/(\d+)/$', v.answer_links, name='dform-answer-links'),
+
+    url(r'^metrics/$', v.show_metrics, name='dform-metrics'),
+    url(r'^events/$', v.event_feed, name='dform-events'),
+    url(r'^events/ack/$', v.event_ack, name='dform-events-ack'),
+    url(r'^profiles/$', v.profiles, name='dform-profiles'),
+    url(r'^profiles/([\w.-]+)$', v.profile_download,
+        name='dform-profile-download'),
 ]
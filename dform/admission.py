@@ -0,0 +1,157 @@
+# dform.admission.py
+#
+# Admission control for survey submissions.  Rate limits per client IP and
+# per survey, and a cap on the submissions of a survey in flight at once,
+# are kept in the Django cache and checked before a submission view touches
+# the database; requests over a limit get a 429.
+import time, uuid
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+
+from . import metrics
+
+# ============================================================================
+
+def _cache():
+    return caches[getattr(settings, 'DFORM_RATE_LIMIT_CACHE', 'default')]
+
+
+def _limits():
+    return getattr(settings, 'DFORM_RATE_LIMITS', {})
+
+
+def _concurrency():
+    return getattr(settings, 'DFORM_SURVEY_CONCURRENCY', 0)
+
+
+def _slot_timeout():
+    return getattr(settings, 'DFORM_SURVEY_CONCURRENCY_TIMEOUT', 60)
+
+
+def over_limit(name, limit, window, cache=None, now=None):
+    """Counts a hit against a sliding window rate limit and returns True if
+    the limit is exceeded.
+
+    The window is approximated with two fixed windows: the count in the
+    current one plus the previous one's count weighted by how much of it
+    still overlaps the sliding window.  Hits over the limit are counted too,
+    so a client that keeps sending stays limited.
+
+    :param name:
+        identifies what is being limited, e.g. ``ip:10.0.0.1``
+    :param limit:
+        number of hits allowed per window
+    :param window:
+        length of the window in seconds
+    """
+    cache = cache or _cache()
+    now = time.time() if now is None else now
+    current = int(now // window)
+    key = 'dform:rate:%s:%s:%s' % (name, window, current)
+
+    cache.add(key, 0, window * 2)
+    try:
+        count = cache.incr(key)
+    except ValueError:
+        # expired between add() and incr()
+        cache.set(key, 1, window * 2)
+        count = 1
+
+    previous = cache.get('dform:rate:%s:%s:%s' % (name, window, current - 1),
+        0)
+    overlap = 1 - (now % window) / float(window)
+    return count + previous * overlap > limit
+
+
+class ConcurrencySlot(object):
+    """Context manager holding one of a survey's in-flight submission slots,
+    see :func:`admission_control`.  ``acquired`` is False if the survey was
+    already at ``settings.DFORM_SURVEY_CONCURRENCY``.
+
+    Each slot is its own cache key, taken with an atomic ``add()`` and
+    deleted on release.  Slots expire after
+    ``settings.DFORM_SURVEY_CONCURRENCY_TIMEOUT`` seconds (default 60) in
+    case a process dies holding one; an expired slot is simply free again,
+    there is no shared count to drift.
+    """
+    def __init__(self, token, cap, cache=None):
+        self.cache = cache or _cache()
+        self.keys = ['dform:inflight:%s:%s' % (token, i) for i in range(cap)]
+        self.key = None
+        self.value = uuid.uuid4().hex
+        self.acquired = False
+
+    def __enter__(self):
+        # one round trip finds the free slots, add() claims one of them
+        taken = self.cache.get_many(self.keys)
+        for key in self.keys:
+            if key in taken:
+                continue
+
+            if self.cache.add(key, self.value, _slot_timeout()):
+                self.key = key
+                self.acquired = True
+                break
+
+        return self
+
+    def __exit__(self, *args):
+        if self.acquired:
+            # the slot may have expired and been taken by someone else
+            if self.cache.get(self.key) == self.value:
+                self.cache.delete(self.key)
+
+            self.acquired = False
+
+
+def _rejected(reason, retry_after):
+    metrics.REJECTED_SUBMISSIONS.inc(reason=reason)
+    response = HttpResponse('Too many requests, try again later',
+        content_type='text/plain', status=429)
+    response['Retry-After'] = str(int(retry_after))
+    return response
+
+
+def admission_control(target):
+    """Decorator for the survey submission views, which take the survey
+    token as their third argument.  POSTs are checked against:
+
+    * ``settings.DFORM_RATE_LIMITS``: dictionary with optional ``ip`` and
+      ``survey`` entries, each a tuple of ``(count, seconds)``, for the
+      submissions allowed per client IP address (``REMOTE_ADDR``) and per
+      survey in a sliding window
+    * ``settings.DFORM_SURVEY_CONCURRENCY``: maximum number of submissions
+      of a survey processed at once
+
+    Surveys are identified by the token in the URL so no query is needed.
+    """
+    @wraps(target)
+    def wrapper(request, object_id, token, *args, **kwargs):
+        if request.method != 'POST':
+            return target(request, object_id, token, *args, **kwargs)
+
+        limits = _limits()
+        checks = (
+            ('ip', 'ip:%s' % request.META.get('REMOTE_ADDR', '')),
+            ('survey', 'survey:%s' % token),
+        )
+        for reason, name in checks:
+            if reason in limits:
+                limit, window = limits[reason]
+                if over_limit(name, limit, window):
+                    return _rejected(reason, window)
+
+        cap = _concurrency()
+        if not cap:
+            return target(request, object_id, token, *args, **kwargs)
+
+        with ConcurrencySlot(token, cap) as slot:
+            if not slot.acquired:
+                return _rejected('concurrency', 1)
+
+            return target(request, object_id, token, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,107 @@
+# dform.events.py
+#
+# Append-only log of survey submissions and edits.  Consumers read the log
+# in offset (id) order, long-polling for new events, and acknowledge the
+# offset they have processed.
+import datetime, time
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import SubmissionEvent, EventConsumer
+
+# ============================================================================
+
+def enabled():
+    return getattr(settings, 'DFORM_EVENT_LOG', False)
+
+
+def append(kind, survey_version, answer_group, changes):
+    """Adds an event to the log when ``settings.DFORM_EVENT_LOG`` is on.
+
+    :param kind:
+        ``submit`` for a new response, ``edit`` for changed answers
+    :param changes:
+        dictionary mapping question ids to their new values, see
+        :func:`SurveyForm.changed_answers`
+    :returns:
+        the new :class:`SubmissionEvent`, or None if the log is off
+    """
+    if not enabled():
+        return None
+
+    return SubmissionEvent.objects.create(kind=kind,
+        survey_version_id=survey_version.id,
+        answer_group_id=answer_group.id,
+        changes={str(key):value for key, value in changes.items()})
+
+
+def to_dict(event):
+    return {
+        'offset':event.id,
+        'kind':event.kind,
+        'survey_version':event.survey_version_id,
+        'answer_group':event.answer_group_id,
+        'changes':event.changes,
+        'created':event.created.isoformat(),
+    }
+
+
+def read(after=0, limit=100):
+    """Returns up to ``limit`` events with offsets after ``after``.
+
+    Offsets are handed out as events are inserted but a transaction can
+    commit after one that started later, so a missing offset may still
+    appear.  Reading stops at a gap until the event after it is
+    ``settings.DFORM_EVENT_SETTLE_SECONDS`` (default 2) old; a gap older
+    than that is a rolled back insert and is skipped.
+    """
+    events = SubmissionEvent.objects.filter(id__gt=after).order_by('id')
+    settle = getattr(settings, 'DFORM_EVENT_SETTLE_SECONDS', 2)
+    cutoff = timezone.now() - datetime.timedelta(seconds=settle)
+
+    result = []
+    previous = after
+    for event in events[:limit]:
+        if event.id != previous + 1 and event.created > cutoff:
+            break
+
+        result.append(event)
+        previous = event.id
+
+    return result
+
+
+def poll(after=0, limit=100, timeout=30):
+    """Like :func:`read` but waits up to ``timeout`` seconds for events if
+    there aren't any yet."""
+    deadline = time.time() + timeout
+    delay = 0.05
+    while True:
+        events = read(after, limit)
+        remaining = deadline - time.time()
+        if events or remaining <= 0:
+            return events
+
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 1.0)
+
+
+def get_offset(consumer):
+    """Returns the last offset acknowledged by the named consumer, 0 for a
+    new one."""
+    record = EventConsumer.objects.filter(name=consumer).first()
+    return record.offset if record else 0
+
+
+def ack(consumer, offset):
+    """Records that the named consumer has processed the events up to and
+    including ``offset``.  Offsets only move forward.
+
+    :returns:
+        the consumer's offset
+    """
+    record, _ = EventConsumer.objects.get_or_create(name=consumer)
+    EventConsumer.objects.filter(id=record.id, offset__lt=offset).update(
+        offset=offset, updated=timezone.now())
+    return max(record.offset, offset)
@@ -0,0 +1,224 @@
+# dform.export.py
+#
+# Incremental export of a survey's answers.  Each call returns what was
+# created, changed or deleted after an opaque cursor, paging through the
+# (updated, id) index of AnswerGroup, Answer and Tombstone.
+import base64, datetime, json
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import AnswerGroup, Answer, Tombstone, prefetch_group_data
+
+STREAMS = ('groups', 'answers', 'deleted')
+
+# ============================================================================
+
+class ExportCursorError(Exception):
+    pass
+
+
+def encode_cursor(positions):
+    """Returns the opaque cursor string for a dictionary mapping stream names
+    to ``(updated, id)`` of the last row exported."""
+    data = {name:[updated.isoformat(), id] for name, (updated, id) in
+        positions.items()}
+    text = json.dumps(data, sort_keys=True).encode('utf-8')
+    return base64.urlsafe_b64encode(text).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Inverse of :func:`encode_cursor`, an empty cursor is the start of
+    time.
+
+    :raises ExportCursorError:
+        if the cursor can't be read
+    """
+    if not cursor:
+        return {}
+
+    try:
+        data = json.loads(base64.urlsafe_b64decode(
+            cursor.encode('ascii')).decode('utf-8'))
+        positions = {}
+        for name, (updated, id) in data.items():
+            if name not in STREAMS:
+                raise ValueError(name)
+            positions[name] = (parse_datetime(updated), int(id))
+    except (TypeError, ValueError, AttributeError):
+        raise ExportCursorError('Invalid export cursor')
+
+    return positions
+
+
+def _after(queryset, position, until, limit):
+    # rows after the position in (updated, id) order
+    if position:
+        updated, id = position
+        queryset = queryset.filter(Q(updated__gt=updated) |
+            Q(updated=updated, id__gt=id))
+
+    return list(queryset.filter(updated__lt=until).order_by('updated',
+        'id')[:limit])
+
+
+def _timestamp(value):
+    return value.isoformat() if value else None
+
+
+def _content_label(content_type_id):
+    # "app_label.model_name" of a content type, which are cached
+    content_type = ContentType.objects.get_for_id(content_type_id)
+    return '%s.%s' % (content_type.app_label, content_type.model)
+
+
+def _group_data(group, fields):
+    if not group.content_type_id:
+        return None
+
+    label = _content_label(group.content_type_id)
+    data = {
+        'model':label,
+        'id':group.object_id,
+    }
+
+    # only read what prefetch_group_data() loaded
+    obj = getattr(group, AnswerGroup.group_data.cache_attr, None)
+    if fields.get(label) and obj is not None:
+        for name in fields[label]:
+            data[name] = obj._meta.get_field(name).value_to_string(obj)
+
+    return data
+
+
+class ChangeExport(object):
+    """What changed in a survey's answers since a cursor.
+
+    .. code-block:: python
+
+        export = export_changes(survey, cursor)
+        for record in export.records:
+            ...
+        save_somewhere(export.cursor)
+        if export.has_more:
+            # call again with export.cursor
+
+    :param records:
+        list of dictionaries, AnswerGroups (``type`` is ``answer_group``)
+        then Answers (``answer``) then deletions (``deleted``), each in the
+        order they changed
+    :param cursor:
+        opaque string to pass to the next call
+    :param has_more:
+        True if the export stopped at the limit
+    """
+    def __init__(self, records, cursor, has_more):
+        self.records = records
+        self.cursor = cursor
+        self.has_more = has_more
+
+
+def export_changes(survey, cursor='', limit=1000, group_data_fields=None):
+    """Returns a :class:`ChangeExport` with the answers of all versions of
+    the survey created, updated or deleted after the cursor.  Only rows last
+    changed more than ``settings.DFORM_EXPORT_LAG_SECONDS`` (default 5) ago
+    are returned, so rows from transactions still in flight when the export
+    runs aren't skipped by the cursor moving past them.
+
+    :param cursor:
+        cursor from the previous export, empty to start from the beginning
+    :param limit:
+        maximum number of rows read from each of the group, answer and
+        deletion streams
+    :param group_data_fields:
+        optional dictionary mapping ``app_label.model_name`` labels to
+        lists of field names.  When given, answer group records have a
+        ``group_data`` entry with the ``model`` and ``id`` of the linked
+        object, plus the named fields for the models listed, fetched with
+        one query per model.
+    :raises ExportCursorError:
+        if the cursor can't be read
+    """
+    positions = decode_cursor(cursor)
+    lag = getattr(settings, 'DFORM_EXPORT_LAG_SECONDS', 5)
+    until = timezone.now() - datetime.timedelta(seconds=lag)
+
+    # versions are on the default database, answers may be on a shard
+    versions = {version.id:version for version in
+        survey.surveyversion_set.all()}
+    using = survey.answer_database
+    storage = survey.answer_storage_backend
+
+    groups = _after(AnswerGroup.objects.using(using).filter(
+        survey_version_id__in=versions.keys()), positions.get('groups'),
+        until, limit)
+    answers = _after(Answer.objects.using(using).filter(
+        answer_group__survey_version_id__in=versions.keys()),
+        positions.get('answers'), until, limit)
+    deleted = _after(Tombstone.objects.using(using).filter(
+        survey_version_id__in=versions.keys()), positions.get('deleted'),
+        until, limit)
+
+    storage_keys = {}
+    for version in versions.values():
+        for rule in version.validation_plan().rules:
+            storage_keys[rule.question.id] = rule.storage_key
+
+    fields = None
+    if group_data_fields is not None:
+        fields = {label.lower():list(names) for label, names in
+            group_data_fields.items()}
+        prefetch_group_data([group for group in groups if
+            group.content_type_id and
+            fields.get(_content_label(group.content_type_id))], fields)
+
+    records = []
+    for group in groups:
+        record = {
+            'type':'answer_group',
+            'id':group.id,
+            'survey_version':group.survey_version_id,
+            'token':group.token,
+            'ip_address':group.ip_address,
+            'created':_timestamp(group.created),
+            'updated':_timestamp(group.updated),
+        }
+        if storage.name == 'document':
+            record['answers'] = group.document
+
+        if fields is not None:
+            record['group_data'] = _group_data(group, fields)
+
+        records.append(record)
+
+    for answer in answers:
+        key = storage_keys.get(answer.question_id)
+        records.append({
+            'type':'answer',
+            'id':answer.id,
+            'answer_group':answer.answer_group_id,
+            'question':answer.question_id,
+            'value':getattr(answer, key) if key else None,
+            'created':_timestamp(answer.created),
+            'updated':_timestamp(answer.updated),
+        })
+
+    for tombstone in deleted:
+        records.append({
+            'type':'deleted',
+            'model':tombstone.model_name,
+            'id':tombstone.object_id,
+            'answer_group':tombstone.answer_group_id,
+            'question':tombstone.question_id,
+            'deleted':_timestamp(tombstone.created),
+        })
+
+    for name, rows in zip(STREAMS, (groups, answers, deleted)):
+        if rows:
+            positions[name] = (rows[-1].updated, rows[-1].id)
+
+    has_more = any(len(rows) == limit for rows in (groups, answers, deleted))
+    return ChangeExport(records, encode_cursor(positions), has_more)
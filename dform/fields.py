@@ -1,6 +1,6 @@
 # dform.fields.py
 import logging
-from six import with_metaclass
+from six import text_type, with_metaclass
 
 from django.core.exceptions import ValidationError
 from django.forms import fields
@@ -43,6 +43,110 @@ class ChoiceField(Field):
 # Storage Types
 # ============================================================================
 
+def _passes(is_valid, value):
+    try:
+        return is_valid(value)
+    except Exception:
+        return False
+
+
+def _distinct_mask(values, is_valid):
+    # Columns of answers repeat a small number of distinct values, so each
+    # distinct value is checked once and the mask built from the failures
+    try:
+        distinct = set(values)
+    except TypeError:
+        # unhashable values, check them one at a time
+        return [not _passes(is_valid, value) for value in values]
+
+    failed = set(value for value in distinct if not _passes(is_valid,
+        value))
+    if not failed:
+        return [False] * len(values)
+
+    return [value in failed for value in values]
+
+
+def _is_int(value):
+    int(value)
+    return True
+
+
+def _is_float(value):
+    float(value)
+    return True
+
+
+def _numpy():
+    try:
+        import numpy
+        return numpy
+    except ImportError:
+        return None
+
+
+def _string_array(values):
+    # the column as a NumPy array of strings if NumPy is installed and every
+    # value is a string, otherwise None.  Mixed columns aren't converted,
+    # NumPy would turn 2.5 or None into strings int() judges differently.
+    kind = getattr(getattr(values, 'dtype', None), 'kind', None)
+    if kind not in ('U', None) or not len(values):
+        return None
+
+    numpy = _numpy()
+    if not numpy:
+        return None
+
+    if kind == 'U':
+        return values
+
+    if set(map(type, values)) != set([text_type]):
+        return None
+
+    # NumPy drops trailing NULs, which int() and float() reject
+    if u'\x00' in u''.join(values):
+        return None
+
+    return numpy.asarray(values, dtype=text_type)
+
+
+def _number_strings(numpy, strings, decimal=False):
+    # True for each string that is an optionally signed run of ASCII digits,
+    # with at most one decimal point if ``decimal``.  int() or float()
+    # always accept these.  Checked on the code points, NumPy pads shorter
+    # strings with zeros.
+    if not strings.dtype.itemsize:
+        return numpy.zeros(len(strings), dtype=bool)
+
+    points = numpy.ascontiguousarray(strings).view(
+        strings.dtype.byteorder.replace('|', '=') + 'u4').reshape(
+        len(strings), -1)
+    digits = (points >= 48) & (points <= 57)
+    padding = points == 0
+    allowed = digits | padding
+    allowed[:, 0] |= (points[:, 0] == 43) | (points[:, 0] == 45)
+    if decimal:
+        dots = points == 46
+        allowed |= dots
+        allowed &= (dots.sum(axis=1) <= 1)[:, None]
+
+    trailing = (padding == numpy.logical_or.accumulate(padding,
+        axis=1)).all(axis=1)
+    return allowed.all(axis=1) & digits.any(axis=1) & trailing
+
+
+def _string_mask(numpy, values, passed, is_valid):
+    # values already known to pass are skipped, the rest, usually few, are
+    # checked in Python
+    mask = numpy.zeros(len(values), dtype=bool)
+    rest = numpy.flatnonzero(~passed)
+    if len(rest):
+        mask[rest] = _distinct_mask([values[i] for i in rest.tolist()],
+            is_valid)
+
+    return mask.tolist()
+
+
 class TextStorage(object):
     storage_key = 'answer_text'
 
@@ -50,6 +154,25 @@ class TextStorage(object):
     def check_value(cls, field_parms, value):
         pass
 
+    @classmethod
+    def check_values(cls, field_parms, values):
+        """Validates a column of values at once.
+
+        :returns:
+            list of booleans, True for each value that would fail
+            :func:`check_value`
+        """
+        return [False] * len(values)
+
+    @classmethod
+    def coercer(cls, field_parms):
+        """Returns a function that validates a value the same way as
+        :func:`check_value` and returns it converted to the type stored in
+        ``storage_key``.  Anything derived from ``field_parms`` is computed
+        once, see :class:`.ValidationPlan`.
+        """
+        return lambda value: value
+
 
 class ChoicesStorage(object):
     storage_key = 'answer_key'
@@ -59,6 +182,21 @@ class ChoicesStorage(object):
         if value not in field_parms:
             raise ValidationError('value was not in available choices')
 
+    @classmethod
+    def check_values(cls, field_parms, values):
+        keys = frozenset(field_parms)
+        return _distinct_mask(values, lambda value: value in keys)
+
+    @classmethod
+    def coercer(cls, field_parms):
+        keys = frozenset(field_parms)
+
+        def coerce(value):
+            if value not in keys:
+                raise ValidationError('value was not in available choices')
+            return value
+        return coerce
+
 
 class MultipleChoicesStorage(object):
     storage_key = 'answer_key'
@@ -70,6 +208,25 @@ class MultipleChoicesStorage(object):
             if key not in field_parms:
                 raise ValidationError('value was not in available choices')
 
+    @classmethod
+    def check_values(cls, field_parms, values):
+        keys = frozenset(field_parms)
+        return _distinct_mask(values, lambda value: keys.issuperset(
+            value.split(',')))
+
+    @classmethod
+    def coercer(cls, field_parms):
+        """Values may also be a list of keys, as submitted by a form."""
+        keys = frozenset(field_parms)
+
+        def coerce(value):
+            if not isinstance(value, (list, tuple)):
+                value = value.split(',')
+            if not keys.issuperset(value):
+                raise ValidationError('value was not in available choices')
+            return ','.join(value)
+        return coerce
+
 
 class IntegerStorage(object):
     storage_key = 'answer_int'
@@ -81,6 +238,36 @@ class IntegerStorage(object):
         except ValueError:
             raise ValidationError('value was not an integer')
 
+    @classmethod
+    def check_values(cls, field_parms, values):
+        """See :func:`TextStorage.check_values`.  NumPy arrays of numbers,
+        and columns of strings when NumPy is installed, are checked without
+        looping in Python; only strings that aren't plain numbers are
+        checked one distinct value at a time."""
+        kind = getattr(getattr(values, 'dtype', None), 'kind', None)
+        if kind in ('b', 'i', 'u'):
+            return [False] * len(values)
+        if kind == 'f':
+            import numpy
+            return (~numpy.isfinite(values)).tolist()
+
+        strings = _string_array(values)
+        if strings is not None:
+            numpy = _numpy()
+            return _string_mask(numpy, values, _number_strings(numpy,
+                strings), _is_int)
+
+        return _distinct_mask(values, _is_int)
+
+    @classmethod
+    def coercer(cls, field_parms):
+        def coerce(value):
+            try:
+                return int(value)
+            except (TypeError, ValueError):
+                raise ValidationError('value was not an integer')
+        return coerce
+
 
 class FloatStorage(object):
     storage_key = 'answer_float'
@@ -92,6 +279,30 @@ class FloatStorage(object):
         except ValueError:
             raise ValidationError('value was not a float')
 
+    @classmethod
+    def check_values(cls, field_parms, values):
+        """See :func:`IntegerStorage.check_values`."""
+        kind = getattr(getattr(values, 'dtype', None), 'kind', None)
+        if kind in ('b', 'i', 'u', 'f'):
+            return [False] * len(values)
+
+        strings = _string_array(values)
+        if strings is not None:
+            numpy = _numpy()
+            return _string_mask(numpy, values, _number_strings(numpy,
+                strings, decimal=True), _is_float)
+
+        return _distinct_mask(values, _is_float)
+
+    @classmethod
+    def coercer(cls, field_parms):
+        def coerce(value):
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                raise ValidationError('value was not a float')
+        return coerce
+
 # ============================================================================
 # Field Types
 # ============================================================================
@@ -2,9 +2,12 @@
 from django import forms
 from django.template.loader import render_to_string
 
-from .fields import (ChoiceField, Rating, MultipleChoicesStorage, Integer, 
-    Float)
-from .models import Answer, AnswerGroup, Question
+from django.core.exceptions import ValidationError
+
+from . import idempotency, recaptcha, results
+from .fields import ChoiceField, Rating
+from .models import AnswerGroup
+from .tracing import span
 
 # ============================================================================
 
@@ -16,6 +19,9 @@ class SurveyForm(forms.Form):
         create this form
     :param answer_group: :class:`.AnswerGroup` object that references the
         stored questions and answers for the form
+    :param idempotency_key: key identifying a new submission, rendered as a
+        hidden field and stored on the :class:`.AnswerGroup` so a repeated
+        POST of the form isn't saved twice, see :mod:`dform.idempotency`
     """
     def __init__(self, *args, **kwargs):
         self.survey_version = kwargs.pop('survey_version')
@@ -28,12 +34,22 @@ class SurveyForm(forms.Form):
 
         super(SurveyForm, self).__init__(*args, **kwargs)
 
+        self.idempotency_key = None
+        if not self.answer_group:
+            if len(args) > 0:
+                self.idempotency_key = idempotency.clean_key(
+                    args[0].get(idempotency.FIELD_NAME))
+            else:
+                self.idempotency_key = idempotency.new_key()
+
         # populate any answers from the database
+        self.storage = self.survey_version.validation_plan().storage
+        self.stored_values = {}
         values = {}
         if self.answer_group:
-            for answer in self.answer_group.answer_set.all():
-                key = 'q_%s' % answer.question.id
-                values[key] = answer.value
+            self.stored_values = self.storage.values(self.answer_group)
+            for question_id, value in self.stored_values.items():
+                values['q_%s' % question_id] = value
 
         # update values with info from a POST if passed in
         if len(args) > 0:
@@ -42,8 +58,10 @@ class SurveyForm(forms.Form):
         self.populate_fields(values)
 
     def populate_fields(self, values):
-        for question in self.survey_version.questions():
-            name = 'q_%s' % question.id
+        self.plan = self.survey_version.validation_plan()
+        for rule in self.plan.rules:
+            question = rule.question
+            name = rule.name
 
             kwargs = {
                 'label':question.text,
@@ -69,6 +87,7 @@ class SurveyForm(forms.Form):
 
             field = question.field.django_field(**kwargs)
             field.question = question
+            field.rule = rule
             if question.field.form_control:
                 field.widget.attrs['class'] = 'form-control'
 
@@ -77,41 +96,80 @@ class SurveyForm(forms.Form):
     def render_form(self):
         return render_to_string('dform/fields.html', {'form':self})
 
+    def clean(self):
+        """Converts each answer with the survey version's
+        :class:`.ValidationPlan`; the results are kept in ``storage_values``
+        for :func:`save`.  Surveys with ``use_recaptcha`` also need a
+        verified reCAPTCHA response when ``DFORM_RECAPTCHA_SECRET`` is set,
+        see :mod:`dform.recaptcha`."""
+        cleaned_data = super(SurveyForm, self).clean()
+        self.storage_values = {}
+        for name, field in self.fields.items():
+            if name not in cleaned_data:
+                # failed field validation
+                continue
+
+            value = cleaned_data[name]
+            if not value:
+                # empty, any existing answer gets removed
+                self.storage_values[name] = None
+                continue
+
+            try:
+                with span('check_value'):
+                    self.storage_values[name] = field.rule.coerce(value)
+            except ValidationError as e:
+                self.add_error(name, e)
+
+        # only otherwise valid submissions are worth a verification call
+        if not self.errors and self.survey_version.survey.use_recaptcha \
+                and recaptcha.enabled():
+            # a pass is only reused by a retry of this same submission
+            submission = None
+            if self.idempotency_key:
+                submission = '%s:%s' % (self.survey_version.id,
+                    self.idempotency_key)
+
+            with span('recaptcha'):
+                verified = recaptcha.verify(
+                    self.data.get(recaptcha.FIELD_NAME, ''), self.ip_address,
+                    submission)
+
+            if not verified:
+                self.add_error(None, 'Please confirm you are not a robot.')
+
+        return cleaned_data
+
     def save(self):
         if not self.answer_group:
             self.answer_group = AnswerGroup.factory(
-                survey_version=self.survey_version)
+                survey_version=self.survey_version,
+                idempotency_key=self.idempotency_key)
 
         if self.ip_address:
             self.answer_group.ip_address = self.ip_address
             self.answer_group.save()
 
+        # fields were built from this version's questions and values were
+        # validated in clean(), see populate_fields()
+        values = {field.question:self.storage_values[name] for name, field
+            in self.fields.items()}
+        self.storage.save(self.answer_group, values)
+        results.record(self.survey_version, [self.answer_group])
+
+    def changed_answers(self):
+        """Returns a dictionary mapping the ids of the questions whose
+        answers differ from what was stored when the form was created to
+        their new values, None for cleared answers.  Call after
+        :func:`is_valid`."""
+        changes = {}
         for name, field in self.fields.items():
-            question = Question.objects.get(id=name[2:], 
-                survey_versions=self.survey_version)
+            question_id = field.question.id
+            value = self.storage_values[name]
+            if value != self.stored_values.get(question_id):
+                changes[question_id] = value
 
-            value = self.cleaned_data[name]
-            if not value:
-                # value is empty, remove any existing answers and otherwise
-                # ignore it
-                try:
-                    # check for an existing Answer that should now be removed
-                    answer = Answer.objects.get(question=question,
-                        answer_group=self.answer_group)
-                    answer.delete()
-                except Answer.DoesNotExist:
-                    # no answer to remove, do nothing
-                    pass
-            else:
-                if question.field in [Rating, Integer]:
-                    value = int(value)
-                elif question.field == Float:
-                    value = float(value)
-                elif issubclass(question.field, MultipleChoicesStorage):
-                    value = ','.join(value)
-
-                self.survey_version.answer_question(question, 
-                    self.answer_group, value)
+        return changes
 
     def has_required(self):
         for field in self.fields.values():
@@ -0,0 +1,56 @@
+# dform.idempotency.py
+#
+# Deduplication of repeated survey submissions.  Each new survey form carries
+# a random key; a POST whose key has already been used gets the original
+# success redirect instead of creating another AnswerGroup.  Keys are checked
+# in the cache first and enforced by a unique (survey_version,
+# idempotency_key) index on AnswerGroup.
+import re, uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+FIELD_NAME = 'dform_idempotency_key'
+RE_KEY = re.compile(r'^[A-Za-z0-9_-]{8,40}$')
+
+# ============================================================================
+
+def new_key():
+    return uuid.uuid4().hex
+
+
+def clean_key(value):
+    """Returns the key if it is well formed, otherwise None."""
+    if value and RE_KEY.match(value):
+        return value
+
+    return None
+
+
+def _cache():
+    return caches[getattr(settings, 'DFORM_IDEMPOTENCY_CACHE', 'default')]
+
+
+def _timeout():
+    return getattr(settings, 'DFORM_IDEMPOTENCY_TIMEOUT', 24 * 60 * 60)
+
+
+def _cache_key(survey_version, key):
+    return 'dform:idempotency:%s:%s' % (survey_version.id, key)
+
+
+def seen(survey_version, key):
+    """Returns the redirect sent for an earlier submission with the key if
+    the cache remembers one, otherwise None."""
+    if not key or not _timeout():
+        return None
+
+    return _cache().get(_cache_key(survey_version, key))
+
+
+def remember(survey_version, key, redirect):
+    """Remembers the redirect sent for a submission with the key for
+    ``settings.DFORM_IDEMPOTENCY_TIMEOUT`` seconds (default a day, 0 turns
+    the cache check off)."""
+    if key and _timeout():
+        _cache().set(_cache_key(survey_version, key), redirect, _timeout())
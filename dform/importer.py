@@ -0,0 +1,500 @@
+# dform.importer.py
+#
+# Bulk import of historical answers from CSV or JSON Lines into a
+# SurveyVersion.  Rows are validated with the fields' check_value() and
+# written with batched bulk_create() calls, optionally parsing in worker
+# processes and checkpointing progress so an interrupted import can resume.
+import csv, io, json, multiprocessing, os
+
+import six
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_ipv46_address
+from django.db import connections, transaction
+
+from . import results
+from .fields import FIELDS_DICT
+from .models import AnswerGroup, Answer, _generate_token
+
+# columns that set AnswerGroup fields instead of answering a question
+GROUP_COLUMNS = ('token', 'ip_address')
+
+# ============================================================================
+
+class AnswerImportError(Exception):
+    """Raised when a row can't be imported.
+
+    :param line: line number in the source file, 0 if not row specific
+    """
+    def __init__(self, message, line=0):
+        # both in args so the exception survives pickling from a worker
+        super(AnswerImportError, self).__init__(message, line)
+        self.message = message
+        self.line = line
+
+    def __str__(self):
+        if self.line:
+            return 'line %s: %s' % (self.line, self.message)
+
+        return self.message
+
+
+def fill_group_ids(groups, using=None):
+    """Sets the ids of AnswerGroups created with ``bulk_create``.  Only
+    PostgreSQL returns ids from a bulk insert, everywhere else they are
+    looked up through the (random) tokens.
+
+    :param using:
+        alias of the database the groups were created on, needed for
+        sharded answers
+    """
+    if not groups or groups[0].id:
+        return
+
+    version_id = groups[0].survey_version_id
+    by_token = {group.token:group for group in groups}
+    if len(by_token) != len(groups):
+        raise ValueError('AnswerGroup tokens are not unique')
+
+    tokens = list(by_token.keys())
+    for start in range(0, len(tokens), 500):
+        # in id order so the groups just created win over any older group
+        # that has the same token
+        rows = AnswerGroup.objects.using(using).filter(
+            survey_version_id=version_id,
+            token__in=tokens[start:start + 500]).order_by('id').values_list(
+            'token', 'id')
+        for token, id in rows:
+            by_token[token].id = id
+
+
+def normalize_value(value):
+    """Returns an imported value as the string ``check_value`` expects, lists
+    (multiple choices) being comma joined, or None if the value is empty."""
+    if value is None:
+        return None
+
+    if isinstance(value, (list, tuple)):
+        value = ','.join(six.text_type(item) for item in value)
+    elif not isinstance(value, six.string_types):
+        value = six.text_type(value)
+
+    if value.strip() == '':
+        return None
+
+    return value
+
+
+def storage_value(field, value):
+    """Converts a validated value to the type stored in the field's
+    ``storage_key``."""
+    if field.storage_key == 'answer_int':
+        return int(value)
+    if field.storage_key == 'answer_float':
+        return float(value)
+
+    return value
+
+
+def question_columns(survey_version):
+    """Returns a dictionary mapping the column names an import file may use
+    to the ``(question_id, field_key, field_parms)`` of the questions in the
+    survey version.  A question can be referred to by its id, as ``q_<id>``
+    like in a :class:`SurveyForm`, or by its text.
+    """
+    rules = survey_version.validation_plan().rules
+    columns = {}
+    for rule in rules:
+        question = rule.question
+        text = question.text.strip()
+        spec = (question.id, question.field_key, question.field_parms)
+        # None marks text shared by more than one question
+        columns[text] = None if text in columns else spec
+
+    # ids win over text that happens to look like an id
+    for rule in rules:
+        question = rule.question
+        spec = (question.id, question.field_key, question.field_parms)
+        columns[str(question.id)] = spec
+        columns[rule.name] = spec
+
+    return columns
+
+
+def _check_group_value(name, value, line):
+    value = six.text_type(value).strip()
+    if name == 'token' and len(value) > 40:
+        raise AnswerImportError('token is longer than 40 characters', line)
+
+    if name == 'ip_address':
+        try:
+            validate_ipv46_address(value)
+        except ValidationError:
+            raise AnswerImportError('bad ip_address "%s"' % value, line)
+
+    return value
+
+
+def parse_rows(task):
+    """Validates and converts a chunk of rows.  Module level and working only
+    with plain values so it can be run in a worker process.  Answers are
+    validated a column at a time with the fields' ``check_values`` rather
+    than with the :class:`.ValidationPlan`, whose compiled rules can't be
+    sent to the workers.
+
+    :param task:
+        tuple of the column map from :func:`question_columns`, a list of
+        ``(line, row_dict)`` and whether to skip (True) or fail on invalid
+        rows
+    :returns:
+        tuple of the parsed rows, each ``(line, group_fields, answers)``
+        where answers are ``(question_id, storage_key, value)``, and a list
+        of ``(line, message)`` for the rows that were skipped
+    """
+    columns, rows, skip_invalid = task
+    errors = {}
+    group_fields = [{} for _ in rows]
+
+    # question_id -> (column name, row indexes, values)
+    by_question = {}
+    for index, (line, row) in enumerate(rows):
+        try:
+            for name, value in row.items():
+                name = name.strip()
+                if name in GROUP_COLUMNS:
+                    if value:
+                        group_fields[index][name] = _check_group_value(name,
+                            value, line)
+                    continue
+
+                if name not in columns:
+                    raise AnswerImportError('unknown column "%s"' % name,
+                        line)
+                if columns[name] is None:
+                    raise AnswerImportError(('column "%s" matches more than '
+                        'one question, use the question id') % name, line)
+
+                value = normalize_value(value)
+                if value is not None:
+                    question_id = columns[name][0]
+                    column = by_question.setdefault(question_id,
+                        (name, [], []))
+                    column[1].append(index)
+                    column[2].append(value)
+        except AnswerImportError as e:
+            errors[index] = e
+
+    # tokens identify the new groups, a repeat would be merged into another
+    # row's group
+    seen = {}
+    for index, (line, _) in enumerate(rows):
+        token = group_fields[index].get('token')
+        if token and index not in errors:
+            if token in seen:
+                errors[index] = AnswerImportError(
+                    'token "%s" is already used on line %s' % (token,
+                    seen[token]), line)
+            else:
+                seen[token] = line
+
+    answers = [[] for _ in rows]
+    for question_id, (name, indexes, values) in by_question.items():
+        _, field_key, field_parms = columns[name]
+        field = FIELDS_DICT[field_key]
+        mask = field.check_values(field_parms, values)
+        for index, value, failed in zip(indexes, values, mask):
+            if failed:
+                if index not in errors:
+                    errors[index] = AnswerImportError(
+                        'column "%s": "%s" is not a valid %s value' % (name,
+                        value, field.__name__), rows[index][0])
+                continue
+
+            answers[index].append((question_id, field.storage_key,
+                storage_value(field, value)))
+
+    parsed = []
+    skipped = []
+    for index, (line, _) in enumerate(rows):
+        if index in errors:
+            if not skip_invalid:
+                raise errors[index]
+            skipped.append((line, str(errors[index])))
+            continue
+
+        parsed.append((line, group_fields[index], answers[index]))
+
+    return parsed, skipped
+
+# ============================================================================
+# Readers
+# ============================================================================
+
+def read_csv(filename, encoding='utf-8'):
+    """Yields ``(line, row_dict)`` for each row of a CSV file with a header
+    row.  Empty cells are left out of the row."""
+    if six.PY2:
+        f = open(filename, 'rb')
+        reader = csv.reader(f)
+        decode = lambda values: [value.decode(encoding) for value in values]
+    else:
+        f = io.open(filename, encoding=encoding, newline='')
+        reader = csv.reader(f)
+        decode = lambda values: values
+
+    with f:
+        try:
+            header = decode(next(reader))
+        except StopIteration:
+            return
+
+        for values in reader:
+            values = decode(values)
+            if not any(values):
+                continue
+
+            yield reader.line_num, {name:value for name, value in zip(header,
+                values) if value != ''}
+
+
+def read_jsonl(filename, encoding='utf-8'):
+    """Yields ``(line, row_dict)`` for each line of a JSON Lines file, each
+    line being an object mapping columns to values."""
+    with io.open(filename, encoding=encoding) as f:
+        for line, text in enumerate(f, 1):
+            text = text.strip()
+            if not text:
+                continue
+
+            try:
+                row = json.loads(text)
+            except ValueError as e:
+                raise AnswerImportError('bad JSON: %s' % e, line)
+
+            if not isinstance(row, dict):
+                raise AnswerImportError('expected a JSON object', line)
+
+            yield line, row
+
+
+def read_rows(filename, format=None, encoding='utf-8'):
+    """Yields ``(line, row_dict)`` from a CSV or JSON Lines file.  The format
+    is ``csv`` or ``jsonl``, guessed from the file extension if not given."""
+    if not format:
+        ext = os.path.splitext(filename)[1].lower()
+        format = 'jsonl' if ext in ('.jsonl', '.json', '.ndjson') else 'csv'
+
+    if format == 'csv':
+        return read_csv(filename, encoding)
+    if format == 'jsonl':
+        return read_jsonl(filename, encoding)
+
+    raise AnswerImportError('unknown format "%s"' % format)
+
+# ============================================================================
+# Importer
+# ============================================================================
+
+class AnswerImporter(object):
+    """Imports rows of answers into a :class:`SurveyVersion`, each row
+    becoming an :class:`AnswerGroup`.
+
+    .. code-block:: python
+
+        importer = AnswerImporter(version, batch_size=2000)
+        importer.run(read_rows('responses.csv'))
+        print(importer.groups, importer.answers, importer.skipped)
+
+    :param survey_version:
+        :class:`SurveyVersion` the answers are for
+    :param batch_size:
+        number of rows parsed and written in each transaction
+    :param skip_invalid:
+        when True rows that fail validation are skipped and listed in
+        ``skipped``, otherwise an :class:`AnswerImportError` is raised
+    :param checkpoint:
+        optional filename recording the number of rows imported, written
+        inside each batch's transaction.  If it exists when the import
+        starts, that many rows are skipped; it is removed once the import
+        finishes
+    :param workers:
+        number of processes to parse and validate rows with, writes always
+        happen in this process
+    """
+    def __init__(self, survey_version, batch_size=1000, skip_invalid=False,
+            checkpoint='', workers=1):
+        self.survey_version = survey_version
+        self.batch_size = max(1, batch_size)
+        self.skip_invalid = skip_invalid
+        self.checkpoint = checkpoint
+        self.workers = workers
+
+        self.rows_done = 0
+        self.groups = 0
+        self.answers = 0
+        self.skipped = []
+
+    def _read_checkpoint(self):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return 0
+
+        with open(self.checkpoint) as f:
+            data = json.load(f)
+
+        if data['survey_version'] != self.survey_version.id:
+            raise AnswerImportError(('checkpoint %s is for survey version '
+                '%s') % (self.checkpoint, data['survey_version']))
+
+        # written inside a batch's transaction, it only counts if one of the
+        # batch's groups made it to the database
+        token = data.get('token')
+        if token and not self.survey_version.answer_groups().filter(
+                token=token).exists():
+            return data['previous']
+
+        return data['rows']
+
+    def _write_checkpoint(self, rows, token=None):
+        # records rows as imported, given the token of a group written by
+        # the current batch the checkpoint is tied to the batch's commit
+        if not self.checkpoint:
+            return
+
+        data = {
+            'survey_version':self.survey_version.id,
+            'rows':rows,
+        }
+        if token:
+            data['token'] = token
+            data['previous'] = self.rows_done
+
+        tmp = self.checkpoint + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.checkpoint)
+
+    def _chunks(self, rows, columns, skip):
+        chunk = []
+        for num, item in enumerate(rows):
+            if num < skip:
+                continue
+
+            chunk.append(item)
+            if len(chunk) >= self.batch_size:
+                yield (columns, chunk, self.skip_invalid)
+                chunk = []
+
+        if chunk:
+            yield (columns, chunk, self.skip_invalid)
+
+    def _drop_existing(self, parsed):
+        # rows whose token already belongs to a group of the version would
+        # have their answers written into that group; returns the rows to
+        # write and the skipped ones
+        tokens = [fields['token'] for _, fields, _ in parsed if
+            fields.get('token')]
+        existing = set()
+        groups = self.survey_version.answer_groups()
+        for start in range(0, len(tokens), 500):
+            existing.update(groups.filter(token__in=tokens[start:start + 500]
+                ).values_list('token', flat=True))
+
+        if not existing:
+            return parsed, []
+
+        keep = []
+        skipped = []
+        for line, fields, values in parsed:
+            if fields.get('token') in existing:
+                error = AnswerImportError('token "%s" is already used in '
+                    'this survey version' % fields['token'], line)
+                if not self.skip_invalid:
+                    raise error
+
+                skipped.append((line, str(error)))
+            else:
+                keep.append((line, fields, values))
+
+        return keep, skipped
+
+    def _write(self, parsed, rows):
+        storage = self.survey_version.validation_plan().storage
+        groups = []
+        for line, group_fields, values in parsed:
+            group = AnswerGroup(survey_version=self.survey_version,
+                token=group_fields.get('token') or _generate_token(),
+                ip_address=group_fields.get('ip_address', '0.0.0.0'))
+            storage.prepare_group(group, values)
+            groups.append(group)
+
+        shard = self.survey_version.answer_database
+        with transaction.atomic(using=shard):
+            AnswerGroup.objects.using(shard).bulk_create(groups)
+            fill_group_ids(groups, shard)
+
+            answers = []
+            for group, (_, _, values) in zip(groups, parsed):
+                answers.extend(storage.build_answers(group, values))
+
+            Answer.objects.using(shard).bulk_create(answers, batch_size=1000)
+            results.record(self.survey_version, groups)
+            self._write_checkpoint(rows, groups[0].token)
+
+        self.groups += len(groups)
+        self.answers += sum(len(values) for _, _, values in parsed)
+
+    def run(self, rows, progress=None):
+        """Imports the given rows, an iterable of ``(line, row_dict)`` such
+        as returned by :func:`read_rows`.
+
+        :param progress:
+            optional callable, called with the importer after each batch
+        """
+        skip = self._read_checkpoint()
+        self.rows_done = skip
+        columns = question_columns(self.survey_version)
+        tasks = self._chunks(rows, columns, skip)
+
+        if self.workers > 1:
+            # child processes must not share this process's connections
+            connections.close_all()
+            pool = multiprocessing.Pool(self.workers)
+            batches = pool.imap(parse_rows, tasks)
+        else:
+            pool = None
+            batches = (parse_rows(task) for task in tasks)
+
+        try:
+            for parsed, skipped in batches:
+                rows = self.rows_done + len(parsed) + len(skipped)
+                parsed, existing = self._drop_existing(parsed)
+                if parsed:
+                    self._write(parsed, rows)
+                else:
+                    self._write_checkpoint(rows)
+
+                self.skipped.extend(sorted(skipped + existing))
+                self.rows_done = rows
+                if progress:
+                    progress(self)
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+        return self
+
+
+def import_answers(survey_version, filename, format=None, **kwargs):
+    """Imports answers from a CSV or JSON Lines file into the survey
+    version, see :class:`AnswerImporter` for the keyword arguments.
+
+    :returns:
+        the :class:`AnswerImporter` with the import's counts
+    """
+    importer = AnswerImporter(survey_version, **kwargs)
+    return importer.run(read_rows(filename, format))
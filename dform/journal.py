@@ -0,0 +1,467 @@
+# dform.journal.py
+#
+# Optional local journal for survey submissions.  With DFORM_JOURNAL_DIR set,
+# validated first time submissions are appended to JSON Lines segment files
+# and fsync'd before the respondent is redirected, without touching the
+# database.  The dform_replay_journal command drains the segments into the
+# database in bulk.
+import glob, json, logging, os, threading, time, uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+from django.forms.utils import ErrorDict
+from django.utils import timezone
+
+from . import events, metrics, results
+from .forms import SurveyForm
+from .importer import fill_group_ids
+from .models import SurveyVersion, AnswerGroup, Answer, SubmissionEvent
+
+logger = logging.getLogger(__name__)
+
+OPEN_SUFFIX = '.open'
+SEALED_SUFFIX = '.jsonl'
+CLAIMED_SUFFIX = '.replaying'
+DONE_SUFFIX = '.done'
+
+# ============================================================================
+
+def journal_dir():
+    return getattr(settings, 'DFORM_JOURNAL_DIR', '')
+
+
+def enabled():
+    return bool(journal_dir())
+
+
+def _segment_bytes():
+    return getattr(settings, 'DFORM_JOURNAL_SEGMENT_BYTES', 8 * 1024 * 1024)
+
+
+def _segment_seconds():
+    return getattr(settings, 'DFORM_JOURNAL_SEGMENT_SECONDS', 10)
+
+
+def _sync_directory(directory):
+    # makes file creation and renames in the directory durable
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class JournalWriter(object):
+    """Appends records to the current segment file of one process.
+
+    Appending is a single ``write()`` under a lock, followed by a group
+    commit: the first caller to reach the fsync flushes everything written
+    so far, and callers whose records were covered by it return without
+    syncing again.  Under load many submissions share one fsync.
+
+    Segments are written as ``<name>.open`` and renamed to ``<name>.jsonl``
+    once they reach ``DFORM_JOURNAL_SEGMENT_BYTES`` (default 8MB) or are
+    ``DFORM_JOURNAL_SEGMENT_SECONDS`` (default 10) old.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.fd = None
+        self.count = 0
+        self.written = 0
+        self.synced = 0
+
+    def _open(self):
+        self.count += 1
+        self.name = os.path.join(self.directory, '%013d-%s-%s' % (
+            int(time.time() * 1000), self.pid, self.count))
+        self.fd = os.open(self.name + OPEN_SUFFIX,
+            os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        _sync_directory(self.directory)
+        self.opened = time.time()
+        self.size = 0
+
+    def _seal(self):
+        # called holding both locks
+        os.fsync(self.fd)
+        os.close(self.fd)
+        self.fd = None
+        self.synced = self.written
+        try:
+            os.rename(self.name + OPEN_SUFFIX, self.name + SEALED_SUFFIX)
+            _sync_directory(self.directory)
+        except OSError:
+            # already claimed as a stale segment by the replayer
+            pass
+
+    def _rotate(self):
+        if self.fd is not None:
+            if self.size < _segment_bytes() and \
+                    time.time() - self.opened < _segment_seconds():
+                return
+
+            with self.sync_lock:
+                self._seal()
+
+        self._open()
+
+    def append(self, record):
+        """Writes a record and returns once it is on disk."""
+        line = (json.dumps(record, sort_keys=True) + '\n').encode('utf-8')
+        with self.lock:
+            self._rotate()
+            os.write(self.fd, line)
+            self.size += len(line)
+            self.written += 1
+            position = self.written
+
+        with self.sync_lock:
+            if self.synced < position:
+                covered = self.written
+                os.fsync(self.fd)
+                self.synced = covered
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                with self.sync_lock:
+                    self._seal()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_writer():
+    """Returns the :class:`JournalWriter` of this process, a new one after a
+    fork."""
+    global _writer
+    with _writer_lock:
+        directory = journal_dir()
+        if _writer is None or _writer.pid != os.getpid() or \
+                _writer.directory != directory:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            _writer = JournalWriter(directory)
+
+        return _writer
+
+
+def append(form):
+    """Journals the answers of a validated new submission instead of saving
+    the form.
+
+    :param form:
+        :class:`SurveyForm` that passed :func:`is_valid` and has no
+        ``answer_group``
+    :returns:
+        id of the record, it becomes the token of the :class:`AnswerGroup`
+        written on replay
+    """
+    answers = {}
+    for name, field in form.fields.items():
+        value = form.storage_values[name]
+        if value is not None:
+            answers[str(field.question.id)] = value
+
+    record = {
+        'id':uuid.uuid4().hex,
+        'survey_version':form.survey_version.id,
+        'ip_address':form.ip_address or '0.0.0.0',
+        'idempotency_key':form.idempotency_key,
+        'submitted':timezone.now().isoformat(),
+        'answers':answers,
+        # rebuilds the validated form passed to DFORM_SUBMIT_HOOK on replay
+        'cleaned_data':{name:form.cleaned_data[name] for name in form.fields
+            if name in form.cleaned_data},
+    }
+    get_writer().append(record)
+    return record['id']
+
+# ============================================================================
+# Replay
+# ============================================================================
+
+def claim_segments(directory=None):
+    """Renames the segments ready for replay to ``.replaying`` and returns
+    their paths, oldest first.  Sealed segments are ready, as are open ones
+    not written to for twice ``DFORM_JOURNAL_SEGMENT_SECONDS``: their writer
+    would start a new segment before writing again, usually they belong to
+    a process that has exited.  Segments left claimed by an interrupted
+    replay are returned again.
+    """
+    directory = directory or journal_dir()
+    stale = time.time() - 2 * _segment_seconds()
+    for path in glob.glob(os.path.join(directory, '*' + OPEN_SUFFIX)):
+        try:
+            if os.path.getmtime(path) < stale:
+                os.rename(path, path[:-len(OPEN_SUFFIX)] + SEALED_SUFFIX)
+        except OSError:
+            # sealed by its writer in the meantime
+            pass
+
+    for path in glob.glob(os.path.join(directory, '*' + SEALED_SUFFIX)):
+        try:
+            os.rename(path, path[:-len(SEALED_SUFFIX)] + CLAIMED_SUFFIX)
+        except OSError:
+            pass
+
+    # progress of a segment removed just before its progress file
+    for path in glob.glob(os.path.join(directory, '*' + CLAIMED_SUFFIX +
+            DONE_SUFFIX)):
+        if not os.path.exists(path[:-len(DONE_SUFFIX)]):
+            os.remove(path)
+
+    return sorted(glob.glob(os.path.join(directory, '*' + CLAIMED_SUFFIX)),
+        key=os.path.basename)
+
+
+def read_segment(path):
+    """Yields the records of a segment.  A partly written last line, from a
+    crash during a write that was never acknowledged, is skipped."""
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                yield json.loads(line.decode('utf-8'))
+            except ValueError:
+                logger.warning('Skipping unreadable journal line in %s', path)
+
+
+def _hook_form(version, group, record):
+    # the form the survey view would have passed to the hook: bound to the
+    # submitted data and valid.  Validation isn't run again, it passed when
+    # the submission was journalled and a reCAPTCHA response can't be
+    # verified twice.
+    answers = record['answers']
+    storage_values = {}
+    for rule in version.validation_plan().rules:
+        storage_values[rule.name] = answers.get(str(rule.question.id))
+
+    cleaned_data = record.get('cleaned_data')
+    if cleaned_data is None:
+        cleaned_data = {name:value for name, value in storage_values.items()
+            if value is not None}
+
+    form = SurveyForm(dict(cleaned_data), survey_version=version,
+        answer_group=group, ip_address=group.ip_address)
+    form.cleaned_data = dict(cleaned_data)
+    form.storage_values = storage_values
+    # a new submission, all of its answers are changes
+    form.stored_values = {}
+    form._errors = ErrorDict()
+    return form
+
+
+def _follow_up(version, replayed, recovered=False):
+    # appends the submit events and calls DFORM_SUBMIT_HOOK for the
+    # (group, record) pairs, once their transaction has committed.  The
+    # answers are already saved so a failing hook is only logged.
+    # Recovered groups were committed by an interrupted replay that may or
+    # may not have got this far, their events are only added if missing.
+    if recovered and events.enabled():
+        logged = set(SubmissionEvent.objects.filter(kind='submit',
+            survey_version_id=version.id, answer_group_id__in=[group.id
+            for group, record in replayed]).values_list('answer_group_id',
+            flat=True))
+        replayed_events = [(group, record) for group, record in replayed
+            if group.id not in logged]
+    else:
+        replayed_events = replayed
+
+    storage_keys = {rule.question.id for rule in
+        version.validation_plan().rules}
+    for group, record in replayed_events:
+        events.append('submit', version, group, {int(question_id):value for
+            question_id, value in record['answers'].items() if
+            int(question_id) in storage_keys})
+
+    if not getattr(settings, 'DFORM_SUBMIT_HOOK', ''):
+        return
+
+    for group, record in replayed:
+        try:
+            metrics.run_hook('DFORM_SUBMIT_HOOK', _hook_form(version, group,
+                record))
+        except Exception:
+            logger.exception('DFORM_SUBMIT_HOOK failed for journalled '
+                'AnswerGroup %s', group.id)
+
+
+def replay_records(records, finished=None):
+    """Writes journalled submissions to the database, bulk creating the
+    groups and answers of each survey version in one transaction.  Records
+    whose group already exists, found by token, are skipped so replaying a
+    segment twice is harmless, as are repeats of a submission's idempotency
+    key.
+
+    Once a transaction has committed, submit events are appended and
+    ``DFORM_SUBMIT_HOOK`` is called for each new group with a bound, valid
+    :class:`SurveyForm` holding the submitted ``cleaned_data``.
+
+    :param finished:
+        optional set of the ids of records whose events and hook have
+        already run.  When given, an existing group whose record isn't in
+        it was committed by a replay that stopped before its follow-up: its
+        missing events are appended and the hook is called again, so hooks
+        run at least once.  :func:`replay_segment` keeps track of this.
+    :returns:
+        number of :class:`AnswerGroup` objects created
+    """
+    by_version = {}
+    for record in records:
+        # kept in journal order so ids follow submission order
+        by_version.setdefault(record['survey_version'], OrderedDict())[
+            record['id']] = record
+
+    versions = SurveyVersion.objects.select_related('survey').in_bulk(
+        list(by_version.keys()))
+
+    created = 0
+    for version_id, pending in sorted(by_version.items()):
+        version = versions.get(version_id)
+        if not version:
+            logger.warning('Dropping %s journalled submissions for deleted '
+                'SurveyVersion %s', len(pending), version_id)
+            continue
+
+        shard = version.answer_database
+        plan = version.validation_plan()
+        storage_keys = {rule.question.id:rule.storage_key for rule in
+            plan.rules}
+
+        recovered = []
+        for group in AnswerGroup.objects.using(shard).filter(
+                survey_version=version, token__in=list(pending.keys())):
+            record = pending.pop(group.token)
+            if finished is not None and group.token not in finished:
+                recovered.append((group, record))
+
+        if recovered:
+            _follow_up(version, recovered, recovered=True)
+
+        if not pending:
+            continue
+
+        # a repeated submission may have been journalled before the first
+        # one's key was cached
+        keys = [record['idempotency_key'] for record in pending.values()
+            if record.get('idempotency_key')]
+        used = set(AnswerGroup.objects.using(shard).filter(
+            survey_version=version, idempotency_key__in=keys).values_list(
+            'idempotency_key', flat=True))
+
+        groups = []
+        parsed = []
+        replayed = []
+        for token, record in pending.items():
+            key = record.get('idempotency_key')
+            if key:
+                if key in used:
+                    continue
+
+                used.add(key)
+
+            values = [(int(question_id), storage_keys[int(question_id)],
+                value) for question_id, value in sorted(
+                record['answers'].items()) if int(question_id) in
+                storage_keys]
+            group = AnswerGroup(survey_version=version, token=token,
+                ip_address=record['ip_address'], idempotency_key=key)
+            plan.storage.prepare_group(group, values)
+            groups.append(group)
+            parsed.append(values)
+            replayed.append((group, record))
+
+        if not groups:
+            continue
+
+        with transaction.atomic(using=shard):
+            AnswerGroup.objects.using(shard).bulk_create(groups)
+            fill_group_ids(groups, shard)
+
+            answers = []
+            for group, values in zip(groups, parsed):
+                answers.extend(plan.storage.build_answers(group, values))
+
+            Answer.objects.using(shard).bulk_create(answers, batch_size=1000)
+            results.record(version, groups)
+
+        _follow_up(version, replayed)
+        created += len(groups)
+
+    return created
+
+
+def _read_finished(path):
+    try:
+        with open(path) as f:
+            return set(line.strip() for line in f if line.strip())
+    except (IOError, OSError):
+        return set()
+
+
+def _mark_finished(path, records):
+    # appended and synced after a batch's events and hooks have run
+    with open(path, 'a') as f:
+        f.write(''.join(record['id'] + '\n' for record in records))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def replay_segment(path, batch_size=500, throttle=1.0, progress=None):
+    """Replays a claimed segment in batches and deletes it.
+
+    The ids of the records of each batch are appended to
+    ``<segment>.done`` once their events and hook have run.  If the replay
+    is interrupted, the next one skips those records and finishes the
+    follow-up of any group that was committed without it, see
+    :func:`replay_records`.
+
+    :param throttle:
+        after each batch sleep for this multiple of the time the batch
+        took, so a slow database gets proportionally more room
+    :param progress:
+        optional callable, called with the number of groups created after
+        each batch
+    :returns:
+        number of :class:`AnswerGroup` objects created
+    """
+    done_path = path + DONE_SUFFIX
+    finished = _read_finished(done_path)
+    created = 0
+    batch = []
+
+    def flush():
+        start = time.time()
+        count = replay_records(batch, finished)
+        _mark_finished(done_path, batch)
+        del batch[:]
+        if progress:
+            progress(count)
+
+        if throttle:
+            time.sleep((time.time() - start) * throttle)
+
+        return count
+
+    for record in read_segment(path):
+        if record['id'] in finished:
+            continue
+
+        batch.append(record)
+        if len(batch) >= batch_size:
+            created += flush()
+
+    if batch:
+        created += flush()
+
+    # the segment goes first, without its progress file every record in it
+    # would be treated as an unfinished follow-up
+    os.remove(path)
+    if os.path.exists(done_path):
+        os.remove(done_path)
+
+    return created
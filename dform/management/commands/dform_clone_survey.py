@@ -0,0 +1,32 @@
+# dform.management.commands.dform_clone_survey.py
+#
+# Deep copies a survey under new tokens, see dform.transfer
+from django.core.management.base import BaseCommand, CommandError
+
+from dform.models import Survey
+from dform.transfer import clone_survey
+
+# ============================================================================
+
+class Command(BaseCommand):
+    help = ('Copies a survey with all of its versions and questions, but no '
+        'answers, under new tokens')
+
+    def add_arguments(self, parser):
+        parser.add_argument('survey', type=int,
+            help='Id of the Survey to copy')
+        parser.add_argument('--name', default='',
+            help='Name for the copies, default is the survey\'s name')
+        parser.add_argument('--count', type=int, default=1,
+            help='Number of copies to make')
+
+    def handle(self, *args, **options):
+        try:
+            survey = Survey.objects.get(id=options['survey'])
+        except Survey.DoesNotExist:
+            raise CommandError('No Survey with id %s' % options['survey'])
+
+        copies = clone_survey(survey, options['name'] or None,
+            max(1, options['count']))
+        for copy in copies:
+            self.stdout.write('Created %s token=%s' % (copy, copy.token))
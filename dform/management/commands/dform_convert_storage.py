@@ -0,0 +1,43 @@
+# dform.management.commands.dform_convert_storage.py
+#
+# Converts a survey's answers between Answer rows and JSON documents on the
+# AnswerGroups, see dform.storage
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dform.models import Survey
+from dform.storage import BACKENDS, convert_survey
+
+# ============================================================================
+
+class Command(BaseCommand):
+    help = ('Moves the answers of a survey to another answer storage, "rows" '
+        '(one Answer per question) or "document" (JSON on the AnswerGroup), '
+        'and switches the survey to it')
+
+    def add_arguments(self, parser):
+        parser.add_argument('survey', type=int,
+            help='Id of the Survey to convert')
+        parser.add_argument('storage', choices=sorted(BACKENDS.keys()),
+            help='Answer storage to convert to')
+        parser.add_argument('--batch-size', type=int, default=500,
+            help='Number of AnswerGroups converted per transaction')
+
+    def handle(self, *args, **options):
+        try:
+            survey = Survey.objects.get(id=options['survey'])
+        except Survey.DoesNotExist:
+            raise CommandError('No Survey with id %s' % options['survey'])
+
+        def progress(count):
+            if options['verbosity'] > 1:
+                self.stdout.write('%s AnswerGroups' % count)
+
+        start = time.time()
+        previous = survey.answer_storage
+        count = convert_survey(survey, options['storage'],
+            max(1, options['batch_size']), progress)
+
+        self.stdout.write('Converted %s AnswerGroups from %s to %s in %.1fs' % (
+            count, previous, options['storage'], time.time() - start))
@@ -0,0 +1,92 @@
+# dform.management.commands.dform_export_changes.py
+#
+# Writes the answers of a survey that changed since a cursor as JSON Lines,
+# see dform.export
+import io, json, os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dform.export import ExportCursorError, export_changes
+from dform.models import Survey
+
+# ============================================================================
+
+class Command(BaseCommand):
+    help = ('Exports the AnswerGroups and Answers of a survey created, '
+        'updated or deleted since a cursor as JSON Lines')
+
+    def add_arguments(self, parser):
+        parser.add_argument('survey', type=int,
+            help='Id of the Survey to export')
+        parser.add_argument('--cursor', default='',
+            help='Cursor from a previous export, starts from the beginning '
+                'if not given')
+        parser.add_argument('--cursor-file', default='',
+            help=('File the cursor is read from, if it exists, and written '
+                'to after each page so the next run carries on from there'))
+        parser.add_argument('--output', default='',
+            help='File to write to, default is stdout')
+        parser.add_argument('--limit', type=int, default=1000,
+            help='Rows read per page')
+        parser.add_argument('--group-data', action='append', default=[],
+            metavar='APP_LABEL.MODEL[:FIELD,...]',
+            help=('Include the object linked to each AnswerGroup, with the '
+                'given fields for objects of this model.  Can be repeated'))
+
+    def _save_cursor(self, filename, cursor):
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(cursor)
+        os.rename(tmp, filename)
+
+    def handle(self, *args, **options):
+        try:
+            survey = Survey.objects.get(id=options['survey'])
+        except Survey.DoesNotExist:
+            raise CommandError('No Survey with id %s' % options['survey'])
+
+        group_data_fields = None
+        if options['group_data']:
+            group_data_fields = {}
+            for value in options['group_data']:
+                label, _, names = value.partition(':')
+                group_data_fields[label] = [name for name in names.split(',')
+                    if name]
+
+        cursor = options['cursor']
+        cursor_file = options['cursor_file']
+        if not cursor and cursor_file and os.path.exists(cursor_file):
+            with open(cursor_file) as f:
+                cursor = f.read().strip()
+
+        if options['output']:
+            out = io.open(options['output'], 'a', encoding='utf-8')
+        else:
+            out = self.stdout
+
+        count = 0
+        try:
+            while True:
+                try:
+                    export = export_changes(survey, cursor,
+                        max(1, options['limit']), group_data_fields)
+                except ExportCursorError as e:
+                    raise CommandError(str(e))
+
+                for record in export.records:
+                    out.write(u'%s\n' % json.dumps(record, sort_keys=True))
+                out.flush()
+
+                # only move the cursor once the page has been written
+                cursor = export.cursor
+                if cursor_file:
+                    self._save_cursor(cursor_file, cursor)
+
+                count += len(export.records)
+                if not export.has_more:
+                    break
+        finally:
+            if options['output']:
+                out.close()
+
+        self.stderr.write('Exported %s records, cursor: %s' % (count, cursor))
@@ -0,0 +1,47 @@
+# dform.management.commands.dform_export_surveys.py
+#
+# Writes survey definitions as JSON Lines, see dform.transfer
+import io
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dform.models import Survey
+from dform.transfer import write_surveys
+
+# ============================================================================
+
+class Command(BaseCommand):
+    help = ('Exports surveys with all of their versions, questions and '
+        'question ordering as JSON Lines, one survey per line.  Answers are '
+        'not exported')
+
+    def add_arguments(self, parser):
+        parser.add_argument('surveys', type=int, nargs='*',
+            help='Ids of the Surveys to export, all of them if none are given')
+        parser.add_argument('--output', default='',
+            help='File to write to, default is stdout')
+        parser.add_argument('--batch-size', type=int, default=100,
+            help='Number of surveys read at a time')
+
+    def handle(self, *args, **options):
+        surveys = Survey.objects.all()
+        if options['surveys']:
+            surveys = surveys.filter(id__in=options['surveys'])
+            missing = set(options['surveys']) - set(surveys.values_list('id',
+                flat=True))
+            if missing:
+                raise CommandError('No Survey with id %s' % ', '.join(
+                    str(id) for id in sorted(missing)))
+
+        if options['output']:
+            out = io.open(options['output'], 'w', encoding='utf-8')
+        else:
+            out = self.stdout
+
+        try:
+            count = write_surveys(surveys, out, max(1, options['batch_size']))
+        finally:
+            if options['output']:
+                out.close()
+
+        self.stderr.write('Exported %s surveys' % count)
@@ -0,0 +1,219 @@
+# dform.management.commands.dform_generate_data.py
+#
+# Builds a large synthetic data set: surveys, versions, questions of every
+# field type and bulk inserted AnswerGroups & Answers, written through the
+# surveys' answer storage
+import multiprocessing, random, time
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+
+from dform import results
+from dform.importer import fill_group_ids
+from dform.models import (Survey, SurveyVersion, Question, QuestionOrder,
+    AnswerGroup, Answer, ANSWER_STORAGE_CHOICES, _generate_token)
+from dform.storage import get_storage
+from dform.sampledata import (AnswerGenerator, random_field_parms,
+    random_ip, field_for_index)
+
+# ============================================================================
+
+def _generate_chunk(task):
+    """Creates one chunk of AnswerGroups and their Answers.  Module level so
+    that it can be sent to a worker process."""
+    version_id, shard, storage_name, count, seed, options = task
+    rng = random.Random(seed)
+    generator = AnswerGenerator(rng, options['answer_rate'])
+    storage = get_storage(storage_name)
+
+    orders = QuestionOrder.objects.filter(survey_version_id=version_id
+        ).select_related('question').order_by('rank')
+    questions = [order.question for order in orders]
+    link_ids = options['link_ids']
+
+    groups = []
+    parsed = []
+    for _ in range(count):
+        group = AnswerGroup(survey_version_id=version_id,
+            token=_generate_token(rng=rng), ip_address=random_ip(rng))
+        if link_ids and rng.random() < options['link_ratio']:
+            group.content_type_id = options['link_content_type']
+            group.object_id = rng.choice(link_ids)
+
+        values = [(question.id, question.field.storage_key,
+            generator.value(question)) for question in questions if not
+            generator.skip(question)]
+        storage.prepare_group(group, values)
+        groups.append(group)
+        parsed.append(values)
+
+    with transaction.atomic(using=shard):
+        AnswerGroup.objects.using(shard).bulk_create(groups)
+        fill_group_ids(groups, shard)
+
+        answers = []
+        for group, values in zip(groups, parsed):
+            answers.extend(storage.build_answers(group, values))
+
+        Answer.objects.using(shard).bulk_create(answers,
+            batch_size=options['batch_size'])
+
+    return len(groups), sum(len(values) for values in parsed)
+
+
+class Command(BaseCommand):
+    help = ('Generates synthetic surveys, versions, questions and answers '
+        'using bulk inserts')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--surveys', type=int, default=1,
+            help='Number of surveys to create')
+        parser.add_argument('--versions', type=int, default=1,
+            help='Number of versions per survey')
+        parser.add_argument('--questions', type=int, default=20,
+            help='Number of questions per survey, cycles through field types')
+        parser.add_argument('--groups', type=int, default=1000,
+            help='Number of AnswerGroups per survey version')
+        parser.add_argument('--answer-rate', type=float, default=0.85,
+            help='Probability an optional question is answered')
+        parser.add_argument('--required-rate', type=float, default=0.2,
+            help='Probability a question is marked as required')
+        parser.add_argument('--link-model', default='',
+            help=('"app_label.Model" whose existing rows are linked to '
+                'AnswerGroups through group_data'))
+        parser.add_argument('--link-ratio', type=float, default=0.5,
+            help='Fraction of AnswerGroups linked to --link-model rows')
+        parser.add_argument('--batch-size', type=int, default=5000,
+            help='Approximate number of Answer rows per insert batch')
+        parser.add_argument('--workers', type=int, default=1,
+            help=('Number of worker processes, requires a database that '
+                'handles concurrent writers (not SQLite)'))
+        parser.add_argument('--seed', type=int, default=None,
+            help='Random seed for repeatable data sets')
+        parser.add_argument('--answer-storage', default='rows',
+            choices=[name for name, _ in ANSWER_STORAGE_CHOICES],
+            help='How the generated surveys store their answers')
+
+    def _create_survey(self, rng, index, options):
+        with transaction.atomic():
+            survey = Survey.objects.create(name='Generated Survey %s' % index,
+                token=_generate_token(rng=rng), success_redirect='/',
+                answer_storage=options['answer_storage'])
+
+            questions = []
+            for num in range(options['questions']):
+                field = field_for_index(num)
+                questions.append(Question(survey=survey,
+                    text='Question %s: %s' % (num + 1, field.__name__),
+                    field_key=field.field_key,
+                    field_parms=random_field_parms(rng, field),
+                    required=rng.random() < options['required_rate']))
+
+            Question.objects.bulk_create(questions)
+            questions = list(Question.objects.filter(survey=survey).order_by(
+                'id'))
+
+            # the first version is created by Survey's post_save signal,
+            # every version shares the same questions like new_version()
+            versions = [survey.latest_version]
+            for num in range(2, options['versions'] + 1):
+                versions.append(SurveyVersion.objects.create(survey=survey,
+                    version_num=num))
+
+            through = Question.survey_versions.through
+            links = []
+            orders = []
+            for version in versions:
+                for rank, question in enumerate(questions):
+                    links.append(through(question_id=question.id,
+                        surveyversion_id=version.id))
+                    orders.append(QuestionOrder(survey_version=version,
+                        question=question, rank=rank + 1))
+
+            through.objects.bulk_create(links)
+            QuestionOrder.objects.bulk_create(orders)
+
+        return versions
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        start = time.time()
+
+        options['link_ids'] = []
+        options['link_content_type'] = None
+        if options['link_model']:
+            try:
+                model = apps.get_model(options['link_model'])
+            except (LookupError, ValueError) as e:
+                raise CommandError('Bad --link-model: %s' % e)
+
+            options['link_content_type'] = \
+                ContentType.objects.get_for_model(model).id
+            options['link_ids'] = list(model.objects.values_list('pk',
+                flat=True)[:10000])
+            if not options['link_ids']:
+                self.stderr.write('No %s rows to link to' % (
+                    options['link_model']))
+
+        # only plain values get sent to the worker processes
+        chunk_options = {key:options[key] for key in ('answer_rate',
+            'batch_size', 'link_ratio', 'link_ids', 'link_content_type')}
+
+        # size chunks so each one inserts about batch_size Answers
+        per_group = max(1, options['questions'])
+        chunk_size = max(1, options['batch_size'] // per_group)
+
+        tasks = []
+        versions = []
+        for index in range(options['surveys']):
+            for version in self._create_survey(rng, index + 1, options):
+                versions.append(version)
+                remaining = options['groups']
+                while remaining > 0:
+                    count = min(chunk_size, remaining)
+                    # seeds are drawn up front so results don't depend on
+                    # which worker runs which chunk
+                    tasks.append((version.id, version.answer_database,
+                        options['answer_storage'], count,
+                        rng.randrange(2 ** 31), chunk_options))
+                    remaining -= count
+
+        if options['workers'] > 1 and connection.vendor == 'sqlite':
+            self.stderr.write('SQLite does not support concurrent writers, '
+                'ignoring --workers')
+            options['workers'] = 1
+
+        if options['workers'] > 1:
+            # child processes must not share the parent's connections
+            connections.close_all()
+            pool = multiprocessing.Pool(options['workers'])
+            chunks = pool.imap_unordered(_generate_chunk, tasks)
+        else:
+            pool = None
+            chunks = (_generate_chunk(task) for task in tasks)
+
+        total_groups = 0
+        total_answers = 0
+        try:
+            for groups, answers in chunks:
+                total_groups += groups
+                total_answers += answers
+                if options['verbosity'] > 1:
+                    self.stdout.write('%s AnswerGroups, %s Answers' % (
+                        total_groups, total_answers))
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        # built once from the finished data rather than a chunk at a time,
+        # the tables of surveys created with bulk inserts may not exist yet
+        if results.enabled():
+            for version in versions:
+                results.ResultsTable(version).rebuild()
+
+        self.stdout.write(('Created %s surveys, %s AnswerGroups and %s '
+            'Answers in %.1fs') % (options['surveys'], total_groups,
+            total_answers, time.time() - start))
@@ -0,0 +1,76 @@
+# dform.management.commands.dform_import_answers.py
+#
+# Imports historical answers from a CSV or JSON Lines file into a survey
+# version, see dform.importer
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dform.importer import AnswerImporter, AnswerImportError, read_rows
+from dform.models import SurveyVersion
+
+# ============================================================================
+
+class Command(BaseCommand):
+    help = ('Imports answers from a CSV or JSON Lines file, one AnswerGroup '
+        'per row.  Columns are question ids, "q_<id>" or question text, plus '
+        'the optional "token" and "ip_address" columns')
+
+    def add_arguments(self, parser):
+        parser.add_argument('survey_version', type=int,
+            help='Id of the SurveyVersion to import answers into')
+        parser.add_argument('filename',
+            help='CSV (with a header row) or JSON Lines file')
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+            default=None,
+            help='File format, guessed from the extension if not given')
+        parser.add_argument('--encoding', default='utf-8',
+            help='File encoding')
+        parser.add_argument('--batch-size', type=int, default=1000,
+            help='Number of rows written per transaction')
+        parser.add_argument('--skip-invalid', action='store_true',
+            help='Skip rows that fail validation instead of stopping')
+        parser.add_argument('--checkpoint', default='',
+            help=('File recording progress after each batch, an interrupted '
+                'import run again with the same checkpoint resumes'))
+        parser.add_argument('--workers', type=int, default=1,
+            help='Number of processes used to parse and validate rows')
+
+    def handle(self, *args, **options):
+        try:
+            version = SurveyVersion.objects.get(id=options['survey_version'])
+        except SurveyVersion.DoesNotExist:
+            raise CommandError('No SurveyVersion with id %s' % (
+                options['survey_version']))
+
+        importer = AnswerImporter(version,
+            batch_size=options['batch_size'],
+            skip_invalid=options['skip_invalid'],
+            checkpoint=options['checkpoint'], workers=options['workers'])
+
+        def progress(importer):
+            if options['verbosity'] > 1:
+                self.stdout.write('%s rows, %s Answers' % (
+                    importer.rows_done, importer.answers))
+
+        start = time.time()
+        try:
+            rows = read_rows(options['filename'], options['format'],
+                options['encoding'])
+            importer.run(rows, progress)
+        except (AnswerImportError, IOError) as e:
+            message = 'Import stopped, %s' % e
+            if options['checkpoint']:
+                message += ('.  %s rows were imported, run again with the '
+                    'same checkpoint to resume') % importer.rows_done
+            raise CommandError(message)
+
+        for line, message in importer.skipped[:20]:
+            self.stderr.write('Skipped %s' % message)
+        if len(importer.skipped) > 20:
+            self.stderr.write('... and %s more' % (
+                len(importer.skipped) - 20))
+
+        self.stdout.write(('Imported %s AnswerGroups and %s Answers, skipped '
+            '%s rows in %.1fs') % (importer.groups, importer.answers,
+            len(importer.skipped), time.time() - start))
@@ -0,0 +1,38 @@
+# dform.management.commands.dform_import_surveys.py
+#
+# Creates surveys from a dform_export_surveys file, see dform.transfer
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dform.transfer import SurveyImportError, import_surveys, read_surveys
+
+# ============================================================================
+
+class Command(BaseCommand):
+    help = ('Creates the surveys in a JSON Lines file written by '
+        'dform_export_surveys, each in a single transaction')
+
+    def add_arguments(self, parser):
+        parser.add_argument('filename',
+            help='JSON Lines file, one survey per line')
+        parser.add_argument('--encoding', default='utf-8',
+            help='File encoding')
+        parser.add_argument('--new-tokens', action='store_true',
+            help='Generate new survey tokens instead of keeping the exported '
+                'ones')
+
+    def handle(self, *args, **options):
+        def progress(survey):
+            if options['verbosity'] > 1:
+                self.stdout.write('Created %s' % survey)
+
+        start = time.time()
+        try:
+            count = import_surveys(read_surveys(options['filename'],
+                options['encoding']), options['new_tokens'], progress)
+        except (IOError, OSError, SurveyImportError) as e:
+            raise CommandError(str(e))
+
+        self.stdout.write('Imported %s surveys in %.1fs' % (count,
+            time.time() - start))
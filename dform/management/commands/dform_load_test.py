@@ -0,0 +1,409 @@
+# dform.management.commands.dform_load_test.py
+#
+# Fires concurrent simulated respondents at the survey views and reports
+# throughput, latency percentiles, errors and database lock contention
+import random, threading, time
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.db import DatabaseError, connection, connections
+from django.test import Client
+from django.test.utils import override_settings
+from six.moves.http_cookiejar import CookieJar
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.parse import urlencode
+from six.moves.urllib.request import (build_opener, HTTPCookieProcessor,
+    HTTPRedirectHandler, Request)
+
+from dform.models import Survey
+from dform.sampledata import AnswerGenerator, form_value
+
+VIEWS = ('survey', 'survey_latest', 'embedded_survey', 'survey_with_answers')
+
+# queries counting the sessions currently waiting on a lock
+LOCK_WAIT_SQL = {
+    'postgresql':("SELECT COUNT(*) FROM pg_stat_activity "
+        "WHERE wait_event_type = 'Lock'"),
+    'mysql':("SELECT COUNT(*) FROM information_schema.innodb_trx "
+        "WHERE trx_state = 'LOCK WAIT'"),
+}
+
+LOCK_ERROR_WORDS = ('lock', 'deadlock', 'could not serialize')
+
+# ============================================================================
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return 0
+
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
+
+
+def is_lock_error(error):
+    message = str(error).lower()
+    return isinstance(error, DatabaseError) and any(word in message for word
+        in LOCK_ERROR_WORDS)
+
+
+class Stats(object):
+    """Thread-safe collection of request timings and errors."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = OrderedDict()
+        self.errors = Counter()
+        self.lock_errors = 0
+        self.lock_waits = []
+
+    def record(self, view, method, seconds, error=None):
+        key = (view, method)
+        with self.lock:
+            self.timings.setdefault(key, []).append(seconds)
+            if error is not None:
+                if isinstance(error, Exception):
+                    if is_lock_error(error):
+                        self.lock_errors += 1
+                    error = '%s: %s' % (error.__class__.__name__,
+                        str(error)[:80])
+
+                self.errors[(view, method, error)] += 1
+
+    @property
+    def count(self):
+        return sum(len(values) for values in self.timings.values())
+
+# ----------------------------------------------------------------------------
+# Transports: how a respondent talks to the views
+# ----------------------------------------------------------------------------
+
+class ClientTransport(object):
+    """Runs requests in-process through the Django test client, each thread
+    with its own database connection."""
+    def __init__(self):
+        self.client = Client()
+
+    def get(self, url):
+        return self.client.get(url).status_code
+
+    def post(self, url, data):
+        return self.client.post(url, data).status_code
+
+    def close(self):
+        connection.close()
+
+
+class _NoRedirect(HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpTransport(object):
+    """Runs requests against a running server, handling the CSRF cookie the
+    way a browser would."""
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.cookies = CookieJar()
+        self.opener = build_opener(HTTPCookieProcessor(self.cookies),
+            _NoRedirect())
+
+    def _open(self, request):
+        try:
+            response = self.opener.open(request, timeout=60)
+            response.read()
+            return response.getcode()
+        except HTTPError as e:
+            return e.code
+
+    def get(self, url):
+        return self._open(Request(self.base_url + url))
+
+    def post(self, url, data):
+        data = dict(data)
+        for cookie in self.cookies:
+            if cookie.name == settings.CSRF_COOKIE_NAME:
+                data['csrfmiddlewaretoken'] = cookie.value
+
+        request = Request(self.base_url + url,
+            urlencode(data, doseq=True).encode('utf-8'),
+            {'Referer':self.base_url + url})
+        return self._open(request)
+
+    def close(self):
+        pass
+
+# ----------------------------------------------------------------------------
+
+class LoadTest(object):
+    def __init__(self, survey, groups, options):
+        self.survey = survey
+        self.version = survey.latest_version
+        self.questions = list(self.version.questions())
+        self.groups = groups
+        self.options = options
+        self.stats = Stats()
+        self.lock = threading.Lock()
+        self.started = 0
+        self.stop_at = None
+
+        self.views = []
+        self.weights = []
+        for view, weight in options['mix'].items():
+            if view == 'survey_with_answers' and not groups:
+                continue
+
+            self.views.append(view)
+            self.weights.append(weight)
+
+    def url(self, view, rng):
+        version = self.version
+        survey = self.survey
+        if view == 'survey':
+            return reverse('dform-survey', args=(version.id, survey.token))
+        if view == 'embedded_survey':
+            return reverse('dform-embedded-survey', args=(version.id,
+                survey.token))
+        if view == 'survey_latest':
+            return reverse('dform-survey-latest', args=(survey.id,
+                survey.token))
+
+        group_id, group_token = rng.choice(self.groups)
+        return reverse('dform-survey-with-answers', args=(version.id,
+            survey.token, group_id, group_token))
+
+    def post_data(self, generator):
+        data = {}
+        for question in self.questions:
+            if not generator.skip(question):
+                data['q_%s' % question.id] = form_value(question,
+                    generator.value(question))
+
+        return data
+
+    def _next(self):
+        # claims the next respondent, False once the run is over
+        with self.lock:
+            if self.stop_at and time.time() >= self.stop_at:
+                return False
+            if not self.stop_at and self.started >= self.options[
+                    'respondents']:
+                return False
+
+            self.started += 1
+            return True
+
+    def _timed(self, view, method, fn, *args):
+        start = time.time()
+        error = None
+        try:
+            status = fn(*args)
+            if status >= 400:
+                error = 'HTTP %s' % status
+            elif method == 'POST' and status != 302:
+                # a valid submission redirects, anything else is a form
+                # that didn't validate
+                error = 'HTTP %s, answers rejected' % status
+        except Exception as e:
+            error = e
+
+        self.stats.record(view, method, time.time() - start, error)
+
+    def respondent(self, num, close=True):
+        rng = random.Random(self.options['seed'] + num)
+        generator = AnswerGenerator(rng, self.options['answer_rate'])
+        transport = self.options['transport']()
+        try:
+            while self._next():
+                view = self.views[self.pick(rng)]
+                url = self.url(view, rng)
+                self._timed(view, 'GET', transport.get, url)
+                self._timed(view, 'POST', transport.post, url,
+                    self.post_data(generator))
+        finally:
+            if close:
+                transport.close()
+
+    def pick(self, rng):
+        point = rng.random() * sum(self.weights)
+        for index, weight in enumerate(self.weights):
+            point -= weight
+            if point < 0:
+                return index
+
+        return len(self.weights) - 1
+
+    def monitor_locks(self, done):
+        sql = LOCK_WAIT_SQL.get(connection.vendor)
+        if not sql:
+            return
+
+        try:
+            while not done.wait(0.25):
+                with connection.cursor() as cursor:
+                    cursor.execute(sql)
+                    self.stats.lock_waits.append(cursor.fetchone()[0])
+        except DatabaseError:
+            # no permission to see the lock tables, report errors only
+            pass
+        finally:
+            connection.close()
+
+    def run(self):
+        concurrency = self.options['concurrency']
+        if self.options['duration']:
+            self.stop_at = time.time() + self.options['duration']
+
+        start = time.time()
+        if concurrency == 1:
+            # run inline, uses (and keeps) this thread's connection
+            self.respondent(0, close=False)
+            return time.time() - start
+
+        # threads get their own connections, close ours so the database
+        # isn't holding an idle one open during the run
+        connections.close_all()
+        done = threading.Event()
+        monitor = threading.Thread(target=self.monitor_locks, args=(done,))
+        monitor.start()
+
+        threads = [threading.Thread(target=self.respondent, args=(num,))
+            for num in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        elapsed = time.time() - start
+        done.set()
+        monitor.join()
+        return elapsed
+
+
+class Command(BaseCommand):
+    help = ('Simulates concurrent respondents submitting random valid '
+        'answers to a survey and reports throughput, latency, errors and '
+        'lock contention')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--survey', type=int, default=None,
+            help='Id of the Survey to answer, defaults to the newest one')
+        parser.add_argument('--concurrency', type=int, default=4,
+            help='Number of respondent threads')
+        parser.add_argument('--respondents', type=int, default=100,
+            help='Total number of respondents, each does a GET then a POST')
+        parser.add_argument('--duration', type=float, default=0,
+            help='Run for this many seconds instead of --respondents')
+        parser.add_argument('--mix', default=','.join('%s=1' % view for
+            view in VIEWS),
+            help=('Comma separated view=weight pairs choosing which views '
+                'respondents use, views: %s' % ', '.join(VIEWS)))
+        parser.add_argument('--answer-rate', type=float, default=0.85,
+            help='Probability an optional question is answered')
+        parser.add_argument('--base-url', default='',
+            help=('URL of a running server, e.g. http://localhost:8000, '
+                'instead of the in-process test client'))
+        parser.add_argument('--seed', type=int, default=0,
+            help='Random seed for the respondents')
+
+    def _parse_mix(self, text):
+        mix = OrderedDict()
+        for item in text.split(','):
+            view, _, weight = item.partition('=')
+            view = view.strip()
+            if view not in VIEWS:
+                raise CommandError('Unknown view in --mix: %s' % view)
+
+            try:
+                mix[view] = float(weight or 1)
+            except ValueError:
+                raise CommandError('Bad weight in --mix: %s' % item)
+
+        return mix
+
+    def handle(self, *args, **options):
+        options['mix'] = self._parse_mix(options['mix'])
+        if options['concurrency'] < 1:
+            raise CommandError('--concurrency must be at least 1')
+
+        if options['survey']:
+            try:
+                survey = Survey.objects.get(id=options['survey'])
+            except Survey.DoesNotExist:
+                raise CommandError('No Survey with id %s' % options['survey'])
+        else:
+            survey = Survey.objects.order_by('-id').first()
+            if not survey:
+                raise CommandError('There are no surveys, create some with '
+                    'dform_generate_data')
+
+        groups = list(survey.latest_version.answer_groups().values_list(
+            'id', 'token')[:1000])
+        if not groups and 'survey_with_answers' in options['mix']:
+            self.stderr.write('No AnswerGroups for the latest version, '
+                'skipping survey_with_answers')
+
+        if options['base_url']:
+            base_url = options['base_url']
+            options['transport'] = lambda: HttpTransport(base_url)
+        else:
+            options['transport'] = ClientTransport
+            if options['concurrency'] > 1 and connection.vendor == 'sqlite':
+                self.stderr.write('SQLite serializes writers, expect lock '
+                    'errors with --concurrency above 1')
+
+        load = LoadTest(survey, groups, options)
+        if not load.views:
+            raise CommandError('No views to test')
+
+        if options['base_url']:
+            elapsed = load.run()
+        else:
+            # the test client identifies itself as "testserver"
+            hosts = list(settings.ALLOWED_HOSTS) + ['testserver']
+            with override_settings(ALLOWED_HOSTS=hosts):
+                elapsed = load.run()
+
+        self.report(survey, load, elapsed)
+
+    def report(self, survey, load, elapsed):
+        stats = load.stats
+        write = self.stdout.write
+        write('Survey %s "%s", %s respondents with concurrency %s' % (
+            survey.id, survey.name, load.started,
+            load.options['concurrency']))
+        write('%s requests in %.2fs: %.1f requests/s, %.1f respondents/s' % (
+            stats.count, elapsed, stats.count / elapsed if elapsed else 0,
+            load.started / elapsed if elapsed else 0))
+        write('')
+        write('%-20s %-6s %7s %7s %9s %9s %9s %9s' % ('view', 'method',
+            'count', 'errors', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+
+        errors_by_key = Counter()
+        for (view, method, _), num in stats.errors.items():
+            errors_by_key[(view, method)] += num
+
+        rows = sorted(stats.timings.items(), key=lambda item: (
+            VIEWS.index(item[0][0]), item[0][1]))
+        for (view, method), values in rows:
+            values = sorted(values)
+            write('%-20s %-6s %7s %7s %9.1f %9.1f %9.1f %9.1f' % (view,
+                method, len(values), errors_by_key[(view, method)],
+                percentile(values, 0.5) * 1000,
+                percentile(values, 0.9) * 1000,
+                percentile(values, 0.99) * 1000, values[-1] * 1000))
+
+        total_errors = sum(stats.errors.values())
+        write('')
+        write('Error rate: %.2f%%' % (100.0 * total_errors / stats.count
+            if stats.count else 0))
+        for (view, method, error), num in stats.errors.most_common():
+            write('  %5dx %s %s: %s' % (num, view, method, error))
+
+        text = 'Lock contention: %s lock errors' % stats.lock_errors
+        if stats.lock_waits:
+            text += ', sessions waiting on locks: max %s, mean %.2f' % (
+                max(stats.lock_waits),
+                sum(stats.lock_waits) / float(len(stats.lock_waits)))
+        write(text)
@@ -0,0 +1,47 @@
+# dform.management.commands.dform_rebuild_results.py
+#
+# Recreates the wide results tables of survey versions from their answers,
+# see dform.results
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dform.models import SurveyVersion
+from dform.results import ResultsTable
+
+# ============================================================================
+
+class Command(BaseCommand):
+    help = ('Drops and rebuilds the dform_results_<id> table of survey '
+        'versions, one row per AnswerGroup and one column per question')
+
+    def add_arguments(self, parser):
+        parser.add_argument('survey_versions', type=int, nargs='*',
+            help='Ids of the SurveyVersions to rebuild')
+        parser.add_argument('--survey', type=int, action='append',
+            default=[], help='Rebuild all versions of this Survey')
+        parser.add_argument('--all', action='store_true',
+            help='Rebuild the tables of every SurveyVersion')
+        parser.add_argument('--batch-size', type=int, default=500,
+            help='Number of AnswerGroups read and written at a time')
+
+    def handle(self, *args, **options):
+        versions = SurveyVersion.objects.order_by('id')
+        if not options['all']:
+            if not (options['survey_versions'] or options['survey']):
+                raise CommandError('Give survey version ids, --survey or '
+                    '--all')
+
+            versions = versions.filter(id__in=options['survey_versions']) | \
+                versions.filter(survey_id__in=options['survey'])
+
+        for version in versions:
+            def progress(count):
+                if options['verbosity'] > 1:
+                    self.stdout.write('%s rows' % count)
+
+            start = time.time()
+            table = ResultsTable(version)
+            count = table.rebuild(max(1, options['batch_size']), progress)
+            self.stdout.write('Rebuilt %s with %s rows in %.1fs' % (
+                table.name, count, time.time() - start))
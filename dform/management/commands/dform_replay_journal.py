@@ -0,0 +1,52 @@
+# dform.management.commands.dform_replay_journal.py
+#
+# Drains journalled submissions into the database, see dform.journal
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dform import journal
+
+# ============================================================================
+
+class Command(BaseCommand):
+    help = ('Writes the submissions in the DFORM_JOURNAL_DIR segment files '
+        'to the database in bulk and removes the segments.  Run one '
+        'replayer per journal directory')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--directory', default='',
+            help='Journal directory, default is settings.DFORM_JOURNAL_DIR')
+        parser.add_argument('--batch-size', type=int, default=500,
+            help='Number of submissions written per transaction')
+        parser.add_argument('--throttle', type=float, default=1.0,
+            help=('After each batch sleep this multiple of the time it took, '
+                '0 to write as fast as possible'))
+        parser.add_argument('--follow', action='store_true',
+            help='Keep waiting for new segments instead of stopping')
+        parser.add_argument('--interval', type=float, default=5,
+            help='Seconds between checks for new segments with --follow')
+
+    def handle(self, *args, **options):
+        directory = options['directory'] or journal.journal_dir()
+        if not directory:
+            raise CommandError('No journal directory, set DFORM_JOURNAL_DIR '
+                'or pass --directory')
+
+        def progress(count):
+            if options['verbosity'] > 1:
+                self.stdout.write('%s submissions written' % count)
+
+        while True:
+            for path in journal.claim_segments(directory):
+                start = time.time()
+                count = journal.replay_segment(path,
+                    max(1, options['batch_size']), options['throttle'],
+                    progress)
+                self.stdout.write('Replayed %s submissions from %s in %.1fs'
+                    % (count, path, time.time() - start))
+
+            if not options['follow']:
+                break
+
+            time.sleep(options['interval'])
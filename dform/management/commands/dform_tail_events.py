@@ -0,0 +1,52 @@
+# dform.management.commands.dform_tail_events.py
+#
+# Prints events from the submission log as JSON Lines, see dform.events
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dform import events
+
+# ============================================================================
+
+class Command(BaseCommand):
+    help = ('Prints submission log events as JSON Lines.  With --consumer '
+        'it starts after the consumer\'s acknowledged offset and '
+        'acknowledges each batch once it has been written')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--consumer', default='',
+            help='Name of the consumer to read and acknowledge offsets for')
+        parser.add_argument('--after', type=int, default=None,
+            help='Start after this offset instead of the consumer\'s')
+        parser.add_argument('--follow', action='store_true',
+            help='Keep waiting for new events instead of stopping at the end')
+        parser.add_argument('--limit', type=int, default=100,
+            help='Maximum number of events read at a time')
+        parser.add_argument('--timeout', type=float, default=30,
+            help='Seconds each long-poll waits for new events with --follow')
+
+    def handle(self, *args, **options):
+        if not events.enabled():
+            raise CommandError('The event log is not enabled, set '
+                'DFORM_EVENT_LOG')
+
+        consumer = options['consumer']
+        after = options['after']
+        if after is None:
+            after = events.get_offset(consumer) if consumer else 0
+
+        timeout = options['timeout'] if options['follow'] else 0
+        while True:
+            found = events.poll(after, max(1, options['limit']), timeout)
+            for event in found:
+                self.stdout.write(json.dumps(events.to_dict(event),
+                    sort_keys=True))
+            self.stdout.flush()
+
+            if found:
+                after = found[-1].id
+                if consumer:
+                    events.ack(consumer, after)
+            elif not options['follow']:
+                break
@@ -0,0 +1,415 @@
+# dform.metrics.py
+#
+# Small in-process metrics registry with Prometheus text exposition.  When
+# running multiple worker processes each one periodically writes a snapshot
+# to a shared directory and the exposition view adds them together, folding
+# the snapshots of exited processes into an archive file.
+import atexit, errno, fcntl, json, logging, os, threading, time, uuid
+from bisect import bisect_left
+from functools import wraps
+
+from django.conf import settings
+from wrench.utils import dynamic_load
+
+from .queries import QueryTimer
+from .routers import dform_databases
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0)
+
+# ============================================================================
+
+def enabled():
+    return getattr(settings, 'DFORM_METRICS', False)
+
+
+class Registry(object):
+    """Holds the values of all metrics for this process.  Values are keyed
+    by metric name and a tuple of label values.  If
+    ``settings.DFORM_METRICS_DIR`` is set, a snapshot of this process's values
+    is written there every ``settings.DFORM_METRICS_FLUSH_INTERVAL`` seconds
+    (default 1) by a background thread, and once more when the process
+    exits.
+    """
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+        self.flusher_pid = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self._start_process()
+
+    def _start_process(self):
+        self.pid = os.getpid()
+        # pids get reused, the token keeps a new process from overwriting
+        # the snapshot of a dead one with smaller counts
+        self.token = uuid.uuid4().hex[:12]
+        self.values = {}
+        self.dirty = False
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def _check_fork(self):
+        # a forked worker starts counting from zero, the parent's values are
+        # in the parent's snapshot
+        if os.getpid() != self.pid:
+            self._start_process()
+
+    def update(self, key, fn):
+        """Applies ``fn`` to the current value for ``key`` (``None`` if there
+        isn't one yet) and stores the result."""
+        with self.lock:
+            self._check_fork()
+            self.values[key] = fn(self.values.get(key))
+            self.dirty = True
+
+        if getattr(settings, 'DFORM_METRICS_DIR', ''):
+            self._start_flusher()
+
+    def _start_flusher(self):
+        # threads don't survive a fork, each process starts its own
+        if self.flusher_pid == os.getpid():
+            return
+
+        with self.lock:
+            if self.flusher_pid == os.getpid():
+                return
+
+            self.flusher_pid = os.getpid()
+
+        thread = threading.Thread(target=self._flush_loop,
+            name='dform-metrics-flush')
+        thread.daemon = True
+        thread.start()
+
+    def _flush_loop(self):
+        pid = os.getpid()
+        while pid == os.getpid():
+            time.sleep(getattr(settings, 'DFORM_METRICS_FLUSH_INTERVAL', 1))
+            self.flush_changes()
+
+    def flush_changes(self):
+        """Writes this process's snapshot if anything changed since the
+        last write.  Called by the flush thread and at exit."""
+        directory = getattr(settings, 'DFORM_METRICS_DIR', '')
+        if directory and self.dirty and os.getpid() == self.pid:
+            self.flush(directory)
+
+    def _filename(self, directory, pid, token):
+        return os.path.join(directory, 'dform_metrics_%s_%s.json' % (pid,
+            token))
+
+    def flush(self, directory):
+        """Writes this process's values to its snapshot file."""
+        with self.lock:
+            self._check_fork()
+            self.dirty = False
+            data = [[name, list(labels), value] for (name, labels), value in
+                self.values.items()]
+            filename = self._filename(directory, self.pid, self.token)
+
+        tmp = filename + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.rename(tmp, filename)
+        except (IOError, OSError):
+            logger.exception('Could not write metrics to %s', filename)
+
+    def _read(self, filename):
+        try:
+            with open(filename) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            # being written or removed, skip it for this scrape
+            return None
+
+    def _merge(self, totals, data):
+        by_name = {metric.name:metric for metric in self.metrics}
+        for name, labels, value in data:
+            metric = by_name.get(name)
+            if not metric:
+                continue
+
+            key = (name, tuple(labels))
+            totals[key] = metric.merge(totals.get(key), value)
+
+    def _snapshots(self, directory):
+        # yields (pid, path) of the per-process snapshot files
+        for filename in os.listdir(directory):
+            if not (filename.startswith('dform_metrics_') and
+                    filename.endswith('.json')):
+                continue
+
+            pid = filename[len('dform_metrics_'):-len('.json')].split('_')[0]
+            if pid.isdigit():
+                yield int(pid), os.path.join(directory, filename)
+
+    def _sweep(self, directory):
+        # folds the snapshots of processes that are no longer running into
+        # the archive and removes them, called with the lock held
+        dead = [path for pid, path in self._snapshots(directory)
+            if not _running(pid)]
+        if not dead:
+            return
+
+        archive = os.path.join(directory, 'dform_metrics_archive.json')
+        totals = {}
+        self._merge(totals, self._read(archive) or [])
+        for path in dead:
+            self._merge(totals, self._read(path) or [])
+
+        data = [[name, list(labels), value] for (name, labels), value in
+            totals.items()]
+        with open(archive + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.rename(archive + '.tmp', archive)
+
+        for path in dead:
+            os.remove(path)
+
+    def collect(self):
+        """Returns the values for all processes if
+        ``settings.DFORM_METRICS_DIR`` is set, otherwise just this one.
+
+        Snapshots of processes that are no longer running are folded into
+        ``dform_metrics_archive.json`` and removed, so the totals don't drop
+        when workers are recycled and the directory doesn't keep growing.
+        Processes are checked by pid, so the directory must be local to the
+        host."""
+        directory = getattr(settings, 'DFORM_METRICS_DIR', '')
+        if not directory:
+            with self.lock:
+                self._check_fork()
+                return dict(self.values)
+
+        self.flush(directory)
+
+        totals = {}
+        with open(os.path.join(directory, 'dform_metrics.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    self._sweep(directory)
+                except (IOError, OSError):
+                    logger.exception('Could not archive metrics in %s',
+                        directory)
+
+                paths = [path for pid, path in self._snapshots(directory)]
+                paths.append(os.path.join(directory,
+                    'dform_metrics_archive.json'))
+                for path in paths:
+                    self._merge(totals, self._read(path) or [])
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        return totals
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        values = self.collect()
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for (name, labels), value in sorted(values.items()):
+                if name == metric.name:
+                    lines.extend(metric.render(labels, value))
+
+        return '\n'.join(lines) + '\n'
+
+
+def _running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+
+    return True
+
+
+REGISTRY = Registry()
+atexit.register(REGISTRY.flush_changes)
+
+# ============================================================================
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace(
+        '"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+
+    if not pairs:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+        for name, value in pairs)
+
+
+class Metric(object):
+    kind = ''
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.registry = registry
+        registry.register(self)
+
+    def _key(self, labels):
+        return (self.name, tuple(str(labels.get(name, ''))
+            for name in self.labels))
+
+
+class Counter(Metric):
+    """A monotonically increasing value.
+
+    .. code-block:: python
+
+        SUBMISSIONS.inc(survey=version.survey_id)
+    """
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if not enabled():
+            return
+
+        self.registry.update(self._key(labels),
+            lambda value: (value or 0) + amount)
+
+    def merge(self, total, value):
+        return (total or 0) + value
+
+    def render(self, labels, value):
+        return ['%s%s %s' % (self.name, _format_labels(self.labels, labels),
+            value)]
+
+
+class Histogram(Metric):
+    """Counts observations (usually durations in seconds) into buckets."""
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS,
+            registry=REGISTRY):
+        super(Histogram, self).__init__(name, help, labels, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, amount, **labels):
+        if not enabled():
+            return
+
+        index = bisect_left(self.buckets, amount)
+
+        def add(value):
+            # value is [count per bucket..., +Inf count, sum]
+            if value is None:
+                value = [0] * (len(self.buckets) + 1) + [0.0]
+            value[index] += 1
+            value[-1] += amount
+            return value
+
+        self.registry.update(self._key(labels), add)
+
+    def merge(self, total, value):
+        if total is None:
+            return list(value)
+
+        return [a + b for a, b in zip(total, value)]
+
+    def render(self, labels, value):
+        lines = []
+        cumulative = 0
+        bounds = [repr(float(b)) for b in self.buckets] + ['+Inf']
+        for bound, count in zip(bounds, value[:-1]):
+            cumulative += count
+            lines.append('%s_bucket%s %s' % (self.name,
+                _format_labels(self.labels, labels, ('le', bound)),
+                cumulative))
+
+        label_text = _format_labels(self.labels, labels)
+        lines.append('%s_sum%s %s' % (self.name, label_text, value[-1]))
+        lines.append('%s_count%s %s' % (self.name, label_text, cumulative))
+        return lines
+
+# ============================================================================
+# DForm Metrics
+# ============================================================================
+
+RENDERS = Counter('dform_survey_renders_total',
+    'Survey forms rendered', ['survey'])
+SUBMISSIONS = Counter('dform_survey_submissions_total',
+    'Surveys successfully submitted', ['survey'])
+EDITS = Counter('dform_survey_edits_total',
+    'Surveys with answers successfully re-submitted', ['survey'])
+VALIDATION_FAILURES = Counter('dform_survey_validation_failures_total',
+    'Survey submissions that failed validation', ['survey'])
+DUPLICATE_SUBMISSIONS = Counter('dform_survey_duplicate_submissions_total',
+    'Repeated survey submissions answered with the original redirect',
+    ['survey'])
+REJECTED_SUBMISSIONS = Counter('dform_survey_rejected_submissions_total',
+    'Survey submissions turned away by rate limits or the concurrency cap',
+    ['reason'])
+RECAPTCHA_CHECKS = Counter('dform_recaptcha_checks_total',
+    'Server side reCAPTCHA verifications by result', ['result'])
+SURVEY_EDITS = Counter('dform_survey_schema_edits_total',
+    'Survey changes saved through the survey editor', ['survey'])
+
+HOOK_SECONDS = Histogram('dform_hook_seconds',
+    'Time spent in the DFORM_SUBMIT_HOOK and DFORM_EDIT_HOOK callables',
+    ['hook', 'survey'])
+VIEW_SECONDS = Histogram('dform_view_seconds',
+    'Time spent in dform views', ['view', 'survey'])
+VIEW_DB_SECONDS = Histogram('dform_view_db_seconds',
+    'Database time spent in dform views', ['view', 'survey'])
+
+
+def timed_view(name):
+    """View decorator recording :data:`VIEW_SECONDS` and
+    :data:`VIEW_DB_SECONDS`.  A view labels the timing with its survey by
+    setting ``request.dform_survey_id``.  Database time is added up with a
+    :class:`QueryTimer` on the databases dform routes to, queries aren't
+    captured.
+    """
+    def decorator(target):
+        @wraps(target)
+        def wrapper(request, *args, **kwargs):
+            if not enabled():
+                return target(request, *args, **kwargs)
+
+            start = time.time()
+            with QueryTimer(dform_databases()) as timer:
+                response = target(request, *args, **kwargs)
+
+            survey = getattr(request, 'dform_survey_id', '')
+            VIEW_SECONDS.observe(time.time() - start, view=name,
+                survey=survey)
+            VIEW_DB_SECONDS.observe(timer.total_time, view=name,
+                survey=survey)
+            return response
+        return wrapper
+    return decorator
+
+
+def run_hook(setting, form):
+    """Runs the callable named by the given setting (if any) with the form,
+    timing it in :data:`HOOK_SECONDS`."""
+    name = getattr(settings, setting, '')
+    if not name:
+        return
+
+    fn = dynamic_load(name)
+    start = time.time()
+    try:
+        fn(form)
+    finally:
+        HOOK_SECONDS.observe(time.time() - start, hook=setting,
+            survey=form.survey_version.survey_id)
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10 on 2026-10-19 01:37
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dform', '0004_answergroup_ip_address'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='answer',
+            name='question',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to='dform.Question'),
+        ),
+        migrations.AlterField(
+            model_name='answergroup',
+            name='ip_address',
+            field=models.GenericIPAddressField(default='0.0.0.0', verbose_name='IP Address'),
+        ),
+        migrations.AlterField(
+            model_name='answergroup',
+            name='survey_version',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to='dform.SurveyVersion'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10 on 2026-10-19 01:41
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dform', '0005_sharded_answer_constraints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='answergroup',
+            name='document',
+            field=jsonfield.fields.JSONField(blank=True, default={}),
+        ),
+        migrations.AddField(
+            model_name='survey',
+            name='answer_storage',
+            field=models.CharField(choices=[('rows', 'Answer rows'), ('document', 'JSON document')], default='rows', max_length=10),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10 on 2026-10-19 01:45
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dform', '0006_answer_storage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tombstone',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('model_name', models.CharField(max_length=20)),
+                ('object_id', models.PositiveIntegerField()),
+                ('survey_version_id', models.PositiveIntegerField()),
+                ('answer_group_id', models.PositiveIntegerField()),
+                ('question_id', models.PositiveIntegerField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='answer',
+            index_together=set([('updated', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='answergroup',
+            index_together=set([('updated', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='tombstone',
+            index_together=set([('updated', 'id')]),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10 on 2026-10-19 01:52
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dform', '0008_submission_events'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='answergroup',
+            name='idempotency_key',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='answergroup',
+            unique_together=set([('survey_version', 'idempotency_key')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10 on 2026-10-19 01:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dform', '0009_answergroup_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='surveyversion',
+            name='revision',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
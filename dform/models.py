@@ -1,15 +1,19 @@
 # dform.models.py
-import logging, collections, random
+import logging, collections, random, threading
+from contextlib import contextmanager
 
+import six
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
 # from django.core.validators import URLValidator
-from django.db import models, transaction
-from django.db.models.signals import post_save
+from django.db import models, transaction, connections, IntegrityError
+from django.db.models import F, Max
+from django.db.models.signals import post_save, pre_delete, post_delete
 from django.dispatch import receiver
 from django.template import Context, Template
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 
 from jsonfield import JSONField
@@ -17,6 +21,9 @@ from awl.models import TimeTrackModel
 from awl.rankedmodel.models import RankedModel
 
 from .fields import FIELD_CHOICES, FIELDS_DICT
+from .sharding import shard_for_survey
+from .tracing import span
+from .validation import ValidationPlan, cached_plan
 
 logger = logging.getLogger(__name__)
 
@@ -24,19 +31,61 @@ logger = logging.getLogger(__name__)
 # Survey Management
 # ============================================================================
 
-def _generate_token(min_size=25, max_size=40):
+def _generate_token(min_size=25, max_size=40, rng=random):
     alphabet = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
-    size = random.randint(min_size, max_size)
-    token = ''.join(random.choice(alphabet) for _ in range(size))
+    size = rng.randint(min_size, max_size)
+    token = ''.join(rng.choice(alphabet) for _ in range(size))
     return token
 
 
+# per thread count of schema edits in progress, see _schema_edit()
+_edits = threading.local()
+
+@contextmanager
+def _schema_edit():
+    # marks question changes that SurveyVersion handles itself: the signals
+    # below don't bump the revision for them, and plans aren't cached while
+    # they are half done
+    _edits.depth = getattr(_edits, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _edits.depth -= 1
+
+
+def _in_schema_edit():
+    return getattr(_edits, 'depth', 0) > 0
+
+
+ANSWER_STORAGE_CHOICES = (
+    ('rows', 'Answer rows'),
+    ('document', 'JSON document'),
+)
+
+
 class EditNotAllowedException(Exception):
     """Exception thrown if an attempt is made to edit a version of a survey
     that currently has answers associated with it."""
     pass
 
 
+class EditConflictException(Exception):
+    """Exception thrown when a survey edit was made against an older revision
+    of a :class:`SurveyVersion` than the current one.
+
+    :param revision: the version's current revision
+    """
+    def __init__(self, revision):
+        super(EditConflictException, self).__init__(revision)
+        self.revision = revision
+
+
+class DuplicateSubmissionException(Exception):
+    """Exception thrown when a submission's idempotency key has already been
+    used for an :class:`AnswerGroup` of the survey version."""
+    pass
+
+
 @python_2_unicode_compatible
 class Survey(TimeTrackModel):
     """Main class that encapsulates a survey.  The actual questions are
@@ -53,6 +102,8 @@ class Survey(TimeTrackModel):
     token = models.CharField(max_length=40)
     success_redirect = models.TextField()
     use_recaptcha = models.BooleanField(default=False)
+    answer_storage = models.CharField(max_length=10,
+        choices=ANSWER_STORAGE_CHOICES, default='rows')
 
     def __str__(self):
         return 'Survey(id=%s %s)' % (self.id, self.name)
@@ -70,6 +121,13 @@ class Survey(TimeTrackModel):
         return Survey.objects.create(name=name, token=_generate_token(),
             success_redirect=success_redirect)
 
+    def delete(self, using=None, keep_parents=False):
+        # answers go first in bulk, see SurveyVersion.delete()
+        for version in self.surveyversion_set.all():
+            version.answer_groups().delete()
+
+        return super(Survey, self).delete(using, keep_parents)
+
     @transaction.atomic
     def new_version(self):
         """Creates a new version of the ``Survey``, associating all the
@@ -85,11 +143,15 @@ class Survey(TimeTrackModel):
 
         orders = QuestionOrder.objects.filter(
             survey_version=old_version).order_by('rank')
-        for order in orders:
-            QuestionOrder.objects.create(survey_version=new_version,
-                question=order.question, rank=order.rank)
-            order.question.survey_versions.add(new_version)
-
+        with _schema_edit():
+            for order in orders:
+                QuestionOrder.objects.create(survey_version=new_version,
+                    question=order.question, rank=order.rank)
+                order.question.survey_versions.add(new_version)
+
+        # results imports the models
+        from . import results
+        results.prepare(new_version)
         return new_version
 
     @property
@@ -97,6 +159,21 @@ class Survey(TimeTrackModel):
         return SurveyVersion.objects.filter(survey=self).order_by(
             '-version_num')[0]
 
+    @property
+    def answer_database(self):
+        """Alias of the shard holding this survey's answers, or None when
+        they are on the regular databases.  Use it with ``using()`` when
+        querying :class:`AnswerGroup` or :class:`Answer` directly."""
+        return shard_for_survey(self.id)
+
+    @property
+    def answer_storage_backend(self):
+        """The :class:`.AnswerStorage` for ``answer_storage``, which reads
+        and writes this survey's answers."""
+        # storage imports the models
+        from .storage import get_storage
+        return get_storage(self.answer_storage)
+
     @property
     def recaptcha_key(self):
         return getattr(settings, 'DFORM_RECAPTCHA_KEY')
@@ -105,7 +182,7 @@ class Survey(TimeTrackModel):
     # Methods on Latest Version
 
     def add_question(self, field, text, rank=0, required=False, 
-            field_parms={}):
+            field_parms={}, revision=None):
         """Convenience method for :func:`SurveyVersion.add_question` using
         the latest version.
 
@@ -122,24 +199,34 @@ class Survey(TimeTrackModel):
         :param field_parms:
             a field specific dictionary specifying parameters for the use of
             the field.  
+        :param revision:
+            optional :attr:`SurveyVersion.revision` the change was made
+            against
         :returns:
             newly created :class:`Question` object
+        :raises EditConflictException:
+            the version has been edited since ``revision``
         :raises EditNotAllowedException:
             editing is not allowed for surveys that already have answers
         """
         return self.latest_version.add_question(field, text, rank, required,
-            field_parms)
+            field_parms, revision)
         
-    def remove_question(self, question):
+    def remove_question(self, question, revision=None):
         """Convenience method for :func:`SurveyVersion.remove_question` using
         the latest version.
 
         :param question:
             :class:`Question` to be removed
+        :param revision:
+            optional :attr:`SurveyVersion.revision` the change was made
+            against
+        :raises EditConflictException:
+            the version has been edited since ``revision``
         :raises EditNotAllowedException:
             editing is not allowed for surveys that already have answers
         """
-        return self.latest_version.remove_question(question)
+        return self.latest_version.remove_question(question, revision)
 
 
     def questions(self):
@@ -189,6 +276,8 @@ class Survey(TimeTrackModel):
         :param data:
             Dictionary to overwrite the contents of the ``Survey`` and
             associated :class:`Question` objects with.
+        :raises EditConflictException:
+            If ``data`` has a ``base_revision`` that is no longer current
         :raises EditNotAllowedException:
             If the version being replaced is active
         :raises Question.DoesNotExist:
@@ -215,6 +304,9 @@ class SurveyVersion(TimeTrackModel):
     version_num = models.PositiveSmallIntegerField(default=1)
     success_redirect = models.TextField(blank=True)
 
+    # incremented by each edit, see SurveyVersion._editing()
+    revision = models.PositiveIntegerField(default=0)
+
     def __str__(self):
         return 'SurveyVersion(id=%s survey=%s, num=%s)' % (self.id, 
             self.survey.name, self.version_num)
@@ -222,21 +314,38 @@ class SurveyVersion(TimeTrackModel):
     class Meta:
         verbose_name = 'Survey Version'
 
+    @property
+    def answer_database(self):
+        """Alias of the shard holding this version's answers, see
+        :func:`Survey.answer_database`."""
+        return shard_for_survey(self.survey_id)
+
+    def answer_groups(self):
+        """Returns a queryset of this version's :class:`AnswerGroup`
+        objects, on its shard if there is one."""
+        return AnswerGroup.objects.using(self.answer_database).filter(
+            survey_version=self)
+
+    def delete(self, using=None, keep_parents=False):
+        # answers go first in bulk, rather than being collected one group at
+        # a time by the cascade
+        self.answer_groups().delete()
+        return super(SurveyVersion, self).delete(using, keep_parents)
+
     def validate_editable(self):
         """Raises :class:`EditNotAllowedException` if there are
         :class:`Answer` objects associated with this version.
 
         :raises EditNotAllowedException:
         """
-        if Answer.objects.filter(
-                answer_group__survey_version=self).count() != 0:
+        if not self.is_editable():
             raise EditNotAllowedException()
 
     def is_editable(self):
         """Returns ``True`` if there are no :class:`Answer` objects associated
         with this version."""
-        count = Answer.objects.filter(answer_group__survey_version=self).count()
-        return count == 0
+        storage = self.survey.answer_storage_backend
+        return not storage.has_answers(self)
 
     def on_success(self):
         """Called when this survey version has been successfully submitted.
@@ -262,7 +371,45 @@ class SurveyVersion(TimeTrackModel):
         context = Context({'survey_version':self})
         return template.render(context)
 
-    def add_question(self, field, text, rank=0, required=False, field_parms={}):
+    def _claim_revision(self, base, checked):
+        # increments the revision with a single UPDATE; a checked claim only
+        # matches if the revision is still the one the edit was made against
+        versions = SurveyVersion.objects.filter(id=self.id)
+        if not checked:
+            versions.update(revision=F('revision') + 1)
+            self.revision = versions.values_list('revision', flat=True)[0]
+            return
+
+        if not versions.filter(revision=base).update(
+                revision=F('revision') + 1):
+            raise EditConflictException(versions.values_list('revision',
+                flat=True).first())
+
+        self.revision = base + 1
+
+    @contextmanager
+    def _editing(self, base=None, checked=False):
+        # Wraps an edit in a transaction that claims the next revision before
+        # writing.  The claiming UPDATE holds the version's row lock until
+        # the transaction ends, so a concurrent editor waits for this edit
+        # and then fails the revision check instead of editing the same rows.
+        with transaction.atomic(), _schema_edit():
+            self.validate_editable()
+            self._claim_revision(base, checked)
+            yield
+
+            # a submission that arrived during the edit answered a half
+            # edited version, undo the edit instead
+            self.validate_editable()
+
+            # results imports the models
+            from . import results
+            results.prepare(self)
+
+        self._validation_plan = None
+
+    def add_question(self, field, text, rank=0, required=False, field_parms={},
+            revision=None):
         """Creates a new :class:`Question` for this ``SurveyVersion``.
 
         :param field: 
@@ -278,13 +425,21 @@ class SurveyVersion(TimeTrackModel):
         :param field_parms:
             a field specific dictionary specifying parameters for the use of
             the field.  
+        :param revision:
+            if given, the :attr:`revision` the change was made against; if
+            someone has saved changes since, nothing is changed
         :returns:
             newly created :class:`Question` object
+        :raises EditConflictException:
+            the version has been edited since ``revision``
         :raises EditNotAllowedException:
             editing is not allowed for surveys that already have answers
         """
-        self.validate_editable()
+        with self._editing(revision, revision is not None):
+            return self._add_question(field, text, rank, required,
+                field_parms)
 
+    def _add_question(self, field, text, rank, required, field_parms):
         field.check_field_parms(field_parms)
         question = Question.objects.create(survey=self.survey, text=text,
             field_key=field.field_key, required=required,
@@ -301,15 +456,23 @@ class SurveyVersion(TimeTrackModel):
         QuestionOrder.objects.create(**kwargs)
         return question
 
-    def remove_question(self, question):
+    def remove_question(self, question, revision=None):
         """Removes the given question from this ``SurveyVersion``. 
 
         :param question:
             :class:`Question` to be removed
+        :param revision:
+            if given, the :attr:`revision` the change was made against; if
+            someone has saved changes since, nothing is changed
+        :raises EditConflictException:
+            the version has been edited since ``revision``
         :raises EditNotAllowedException:
             editing is not allowed for surveys that already have answers
         """
-        self.validate_editable()
+        with self._editing(revision, revision is not None):
+            self._remove_question(question)
+
+    def _remove_question(self, question):
         question.survey_versions.remove(self)
         QuestionOrder.objects.get(question=question, 
             survey_version=self).delete()
@@ -322,9 +485,24 @@ class SurveyVersion(TimeTrackModel):
             list of :class:`Question` objects
         """
         orders = QuestionOrder.objects.filter(survey_version=self
-            ).order_by('rank')
+            ).select_related('question').order_by('rank')
         return [order.question for order in orders]
 
+    def validation_plan(self):
+        """Returns the :class:`.ValidationPlan` for this version's
+        questions.  Plans are shared by the whole process for each
+        :attr:`revision` and kept on this object, edits made through this
+        object reset it.
+        """
+        if getattr(self, '_validation_plan', None) is None:
+            if _in_schema_edit():
+                # not shared, the questions may be half edited
+                self._validation_plan = ValidationPlan(self)
+            else:
+                self._validation_plan = cached_plan(self)
+
+        return self._validation_plan
+
     def answer_question(self, question, answer_group, value):
         """Record an answer to the given question in this version of the
         survey.
@@ -346,15 +524,22 @@ class SurveyVersion(TimeTrackModel):
         :raises AttributeError:
             If the question is not attached to this version of the
             ``Survey``
+        :returns:
+            the stored :class:`Answer`, or None if the survey keeps its
+            answers in a JSON document (see :mod:`dform.storage`)
         """
-        try:
-            # make sure this question is registered against this survey
-            # version
-            question.survey_versions.get(id=self.id)
-        except SurveyVersion.DoesNotExist:
-            raise AttributeError()
+        # raises AttributeError if the question isn't in this version
+        rule = self.validation_plan().rule(question)
+        with span('check_value'):
+            value = rule.coerce(value)
 
-        return Answer.factory(question, answer_group, value)
+        # results imports the models
+        from . import results
+
+        answer = self.validation_plan().storage.store(answer_group, question,
+            value)
+        results.record(self, [answer_group])
+        return answer
 
     def to_dict(self):
         """Returns a dictionary representation of this survey version.
@@ -411,13 +596,18 @@ class SurveyVersion(TimeTrackModel):
     def replace_from_dict(self, data):
         """Takes the given dictionary and modifies this survey version and its
         associated questions.  Uses the same format as 
-        :func:`SurveyVersion.to_dict` with one additional (optional) key
+        :func:`SurveyVersion.to_dict` with two additional (optional) keys:
         "remove" which contains a list of :class:`Question` ids to be removed
-        from the ``Survey``.
+        from the ``Survey``, and "base_revision", the :attr:`revision` the
+        changes were made against.  The changes are made in a single
+        transaction.
 
         :param data:
             Dictionary to overwrite the contents of the ``Survey`` and
             associated :class:`Question` objects with.
+        :raises EditConflictException:
+            If ``base_revision`` is given and someone else has saved changes
+            since
         :raises EditNotAllowedException:
             If the version being replaced is active
         :raises Question.DoesNotExist:
@@ -427,7 +617,11 @@ class SurveyVersion(TimeTrackModel):
             If the name or success_redirect URL are blank or if the URL is
             invalid
         """
-        self.validate_editable()
+        base = data.get('base_revision')
+        with self._editing(base, base is not None):
+            self._replace_from_dict(data)
+
+    def _replace_from_dict(self, data):
         errors = {}
         name = data.get('name', '').strip()
         url = data.get('redirect_url', '').strip()
@@ -468,7 +662,8 @@ class SurveyVersion(TimeTrackModel):
 
                     # add the question and set the data's question id so that we
                     # can do re-ordering down below
-                    question = self.add_question(**kwargs)
+                    kwargs['rank'] = 0
+                    question = self._add_question(**kwargs)
                     q_data['id'] = question.id
                 else:
                     question = Question.objects.get(id=q_data['id'],
@@ -494,7 +689,188 @@ class SurveyVersion(TimeTrackModel):
             for id in data['remove']:
                 question = Question.objects.get(id=id,
                     survey_versions__id=self.id)
-                self.remove_question(question)
+                self._remove_question(question)
+
+    def _place(self, order, before):
+        # ranks the QuestionOrder in front of the question "before", last if
+        # it is None, moving only the orders after it
+        orders = QuestionOrder.objects.filter(survey_version=self)
+        if before is None:
+            top = orders.exclude(id=order.id).aggregate(Max('rank'))
+            order.rank = (top['rank__max'] or 0) + 1
+        else:
+            rank = orders.get(question=before).rank
+            orders.filter(rank__gte=rank).exclude(id=order.id).update(
+                rank=F('rank') + 1)
+            order.rank = rank
+
+        order.save(rerank=False)
+
+    def apply_patch(self, patch):
+        """Applies the changes made in the survey editor as a list of
+        operations, only touching the rows they name.  The alternative to
+        :func:`SurveyVersion.replace_from_dict` that the editor uses.
+
+        Format:
+
+        .. code-block::python
+
+            {
+                'base_revision':revision_the_edits_started_from,
+                'survey':{
+                    # only the keys that changed
+                    'name':survey_name,
+                    'recaptcha':use_recaptcha,
+                },
+                'operations':[
+                    {
+                        'op':'add',
+                        'ref':client_reference,
+                        'field_key':question_field_key,
+                        'text':question_text,
+                        'required':is_question_required,
+                        'field_parms':OrderedDict(*field_parm_tuples),
+                        'before':id_or_ref,
+                    },
+                    # only the keys that changed
+                    {'op':'update', 'id':question_id, 'text':question_text},
+                    {'op':'move', 'id':question_id, 'before':id_or_ref},
+                    {'op':'remove', 'id':question_id},
+                ]
+            }
+
+        ``before`` is the id of the question, or the ``ref`` of one added
+        earlier in the patch, to place the question in front of; leaving it
+        out or ``None`` puts the question last.  Operations are applied in
+        order in a single transaction.
+
+        :param patch:
+            Dictionary of changes
+        :returns:
+            Dictionary mapping the ``ref`` of each added question to its id
+        :raises EditConflictException:
+            If the version's revision is no longer ``base_revision``, someone
+            else has saved changes since
+        :raises EditNotAllowedException:
+            If the version being edited is active
+        :raises Question.DoesNotExist:
+            If a question id is referenced that does not exist or is not
+            associated with this survey.
+        :raises ValidationError:
+            If the name is blank or an operation is invalid, or with the
+            code ``"base_revision"`` if ``base_revision`` is missing or not
+            an integer; nothing is claimed or written then
+        """
+        base = patch.get('base_revision')
+        if not isinstance(base, six.integer_types) or isinstance(base, bool) \
+                or base < 0:
+            raise ValidationError('Survey Validation Failed', params={
+                'base_revision':'base_revision must be the integer revision '
+                    'the patch was made against'}, code='base_revision')
+
+        operations = patch.get('operations', [])
+
+        with self._editing(base, checked=True):
+            self._patch_survey(patch.get('survey', {}))
+
+            # fetch everything named by id up front
+            ids = set()
+            for operation in operations:
+                for key in ('id', 'before'):
+                    if isinstance(operation.get(key), int):
+                        ids.add(operation[key])
+
+            questions = Question.objects.filter(
+                survey_versions=self).in_bulk(list(ids))
+            added = {}
+
+            def lookup(key):
+                if key is None:
+                    return None
+
+                if key in added:
+                    return added[key]
+
+                try:
+                    return questions[key]
+                except (KeyError, TypeError):
+                    raise Question.DoesNotExist(key)
+
+            try:
+                for operation in operations:
+                    self._patch_operation(operation, lookup, added)
+            except ValidationError as e:
+                raise ValidationError('Survey Validation Failed', params={
+                    'questions':'; '.join(e.messages)})
+            except KeyError as e:
+                raise ValidationError('Survey Validation Failed', params={
+                    'questions':'Missing or unknown value %s' % e})
+
+        return {ref:question.id for ref, question in added.items()}
+
+    def _patch_survey(self, data):
+        fields = ['updated']
+        if not self.survey.success_redirect:
+            # same default as a full save, on_success() needs a redirect
+            self.survey.success_redirect = '/'
+            fields.append('success_redirect')
+
+        if 'name' in data:
+            name = data['name'].strip()
+            if not name:
+                raise ValidationError('Survey Validation Failed',
+                    params={'name':'name cannot be blank'})
+
+            self.survey.name = name
+            fields.append('name')
+
+        if 'recaptcha' in data:
+            self.survey.use_recaptcha = data['recaptcha']
+            fields.append('use_recaptcha')
+
+        if len(fields) > 1:
+            self.survey.save(update_fields=fields)
+
+    def _patch_operation(self, operation, lookup, added):
+        kind = operation.get('op')
+        if kind == 'add':
+            field = FIELDS_DICT[operation['field_key']]
+            field_parms = operation.get('field_parms', {})
+            field.check_field_parms(field_parms)
+            question = Question.objects.create(survey=self.survey,
+                text=operation.get('text', ''), field_key=field.field_key,
+                required=operation.get('required', False),
+                field_parms=field_parms)
+            question.survey_versions.add(self)
+
+            order = QuestionOrder(survey_version=self, question=question)
+            self._place(order, lookup(operation.get('before')))
+            added[operation['ref']] = question
+        elif kind == 'update':
+            question = lookup(operation['id'])
+            fields = ['updated']
+            for key in ('text', 'required', 'field_parms'):
+                if key in operation:
+                    setattr(question, key, operation[key])
+                    fields.append(key)
+
+            if 'field_parms' in operation:
+                question.field.check_field_parms(question.field_parms)
+
+            question.save(update_fields=fields)
+        elif kind == 'move':
+            question = lookup(operation['id'])
+            order = QuestionOrder.objects.get(survey_version=self,
+                question=question)
+            self._place(order, lookup(operation.get('before')))
+        elif kind == 'remove':
+            question = lookup(operation['id'])
+            question.survey_versions.remove(self)
+            QuestionOrder.objects.filter(survey_version=self,
+                question=question).delete()
+        else:
+            raise ValidationError('Unknown operation "%s"' % kind)
+
 
 # ============================================================================
 # Question & Answers
@@ -574,6 +950,53 @@ class QuestionOrder(TimeTrackModel, RankedModel):
             survey_version=self.survey_version).order_by('rank')
 
 
+class AnswerGroupQuerySet(models.QuerySet):
+    def _record_deletes(self):
+        # One INSERT ... SELECT writes a Tombstone per group for incremental
+        # exports, and results table rows are removed in bulk.  Done here
+        # rather than in a post_delete signal, which would stop Django's
+        # fast deletes and cost queries per group.
+        using = self.db
+        connection = connections[using]
+        quote = connection.ops.quote_name
+        now = timezone.now()
+        meta = Tombstone._meta
+        columns = ['created', 'updated', 'model_name', 'object_id',
+            'survey_version_id', 'answer_group_id']
+        params = [meta.get_field(name).get_db_prep_save(now, connection)
+            for name in ('created', 'updated')] + ['answergroup']
+
+        sql, where_params = self.values('id').query.sql_with_params()
+        group = AnswerGroup._meta
+        with connection.cursor() as cursor:
+            cursor.execute('INSERT INTO %s (%s) SELECT %%s, %%s, %%s, %s, %s, '
+                '%s FROM %s WHERE %s IN (%s)' % (quote(meta.db_table),
+                ', '.join(quote(meta.get_field(name).column) for name in
+                columns), quote('id'), quote('survey_version_id'),
+                quote('id'), quote(group.db_table), quote('id'), sql),
+                params + list(where_params))
+
+        from . import results
+        if results.enabled():
+            by_version = collections.defaultdict(list)
+            for version_id, id in self.values_list('survey_version_id',
+                    'id'):
+                by_version[version_id].append(id)
+
+            for version_id, ids in by_version.items():
+                results.forget_groups(version_id, ids, using)
+
+    def delete(self):
+        """Deletes the groups and their answers, recording the deletions
+        for exports and results tables in bulk first."""
+        with transaction.atomic(using=self.db):
+            self._record_deletes()
+            return super(AnswerGroupQuerySet, self).delete()
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+
 @python_2_unicode_compatible
 class AnswerGroup(TimeTrackModel):
     """Groups together a set of :class:`Answer` objects for a single response
@@ -584,7 +1007,8 @@ class AnswerGroup(TimeTrackModel):
         for example the :class:`User` class of the respondent.  Can be left
         blank.
     """
-    survey_version = models.ForeignKey(SurveyVersion)
+    # no constraint as answers may be on a shard, see dform.sharding
+    survey_version = models.ForeignKey(SurveyVersion, db_constraint=False)
     token = models.CharField(max_length=40)
 
     content_type = models.ForeignKey(ContentType, null=True, blank=True)
@@ -594,11 +1018,23 @@ class AnswerGroup(TimeTrackModel):
     ip_address = models.GenericIPAddressField(default='0.0.0.0',
         verbose_name='IP Address')
 
+    # answers for surveys using the "document" answer storage
+    document = JSONField(default={}, blank=True)
+
+    # sent with the survey form so a repeated POST doesn't create another
+    # group, see dform.idempotency
+    idempotency_key = models.CharField(max_length=40, null=True, blank=True)
+
+    objects = AnswerGroupQuerySet.as_manager()
+
     class Meta:
         verbose_name = 'Answer Group'
+        # incremental exports page through (updated, id)
+        index_together = [('updated', 'id')]
+        unique_together = [('survey_version', 'idempotency_key')]
 
     @classmethod
-    def factory(self, survey_version, group_data=None):
+    def factory(self, survey_version, group_data=None, idempotency_key=None):
         """Returns a new AnswerGroup object with a random token.
 
         :param survey_version:
@@ -607,20 +1043,114 @@ class AnswerGroup(TimeTrackModel):
         :param group_data:
             Optional object to be associated with the new :class:`AnswerGroup`
             instance
+        :param idempotency_key:
+            Optional key identifying the submission that created the group
 
         :returns:
             Newly created :class:`AnswerGroup` instance
+        :raises DuplicateSubmissionException:
+            if the version already has a group with the idempotency key
         """
+        using = survey_version.answer_database
+        manager = AnswerGroup.objects.db_manager(using)
+        kwargs = {}
         if group_data:
-            return AnswerGroup.objects.create(survey_version=survey_version, 
-                token=_generate_token(), group_data=group_data)
-        else:
-            return AnswerGroup.objects.create(survey_version=survey_version, 
-                token=_generate_token())
+            kwargs['group_data'] = group_data
+
+        if not idempotency_key:
+            return manager.create(survey_version=survey_version, 
+                token=_generate_token(), **kwargs)
+
+        try:
+            with transaction.atomic(using=using):
+                return manager.create(survey_version=survey_version,
+                    token=_generate_token(), idempotency_key=idempotency_key,
+                    **kwargs)
+        except IntegrityError:
+            if manager.filter(survey_version=survey_version,
+                    idempotency_key=idempotency_key).exists():
+                raise DuplicateSubmissionException()
+
+            raise
+
+    def delete(self, using=None, keep_parents=False):
+        using = using or self._state.db
+        with transaction.atomic(using=using):
+            AnswerGroup.objects.using(using).filter(
+                id=self.id)._record_deletes()
+            return super(AnswerGroup, self).delete(using, keep_parents)
 
     def __str__(self):
         return 'AnswerGroup(id=%s data=%s)' % (self.id, self.group_data)
 
+    def answer_values(self):
+        """Returns a dictionary mapping question ids to the stored answers,
+        whichever storage the survey uses."""
+        storage = self.survey_version.survey.answer_storage_backend
+        return storage.values(self)
+
+
+def _model_label(model):
+    if isinstance(model, six.string_types):
+        return model.lower()
+
+    return model._meta.label_lower
+
+
+def prefetch_group_data(groups, only=None, batch_size=500):
+    """Loads the ``group_data`` of :class:`AnswerGroup` objects with one
+    query per content type (per ``batch_size`` objects) instead of one per
+    group, so displaying it afterwards doesn't query.  Works for groups on a
+    shard as well, the objects are read from wherever the router says.
+    Groups linked to an object that no longer exists still query when their
+    ``group_data`` is read.
+
+    :param groups:
+        iterable of :class:`AnswerGroup` objects, a queryset is evaluated
+    :param only:
+        optional dictionary mapping a model, or its ``app_label.model_name``
+        label, to the names of the only fields to load for it, see
+        ``QuerySet.only()``.  Models that aren't listed are loaded in full.
+    :returns:
+        list of the groups
+    """
+    groups = list(groups)
+    only = {_model_label(key):fields for key, fields in (only or {}).items()}
+
+    wanted = collections.defaultdict(set)
+    for group in groups:
+        if group.content_type_id:
+            wanted[group.content_type_id].add(group.object_id)
+
+    found = {}
+    for content_type_id, object_ids in wanted.items():
+        # content types are cached, keep to the default database's ids
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        if model is None:
+            # the model has been removed
+            continue
+
+        queryset = model._base_manager.all()
+        fields = only.get(model._meta.label_lower)
+        if fields:
+            queryset = queryset.only(*fields)
+
+        object_ids = sorted(object_ids)
+        for start in range(0, len(object_ids), batch_size):
+            batch = object_ids[start:start + batch_size]
+            for obj in queryset.filter(pk__in=batch):
+                found[(content_type_id, obj.pk)] = obj
+
+    cache_attr = AnswerGroup.group_data.cache_attr
+    for group in groups:
+        if group.content_type_id:
+            setattr(group, cache_attr, found.get((group.content_type_id,
+                group.object_id)))
+        else:
+            setattr(group, cache_attr, None)
+
+    return groups
+
 
 @python_2_unicode_compatible
 class Answer(TimeTrackModel):
@@ -630,7 +1160,7 @@ class Answer(TimeTrackModel):
     The prefered method of creating :class:`Answer` objects is to call
     :func:`SurveyVersion.answer_question`
     """
-    question = models.ForeignKey(Question)
+    question = models.ForeignKey(Question, db_constraint=False)
     answer_group = models.ForeignKey(AnswerGroup)
 
     answer_text = models.TextField(blank=True)
@@ -638,27 +1168,40 @@ class Answer(TimeTrackModel):
     answer_int = models.IntegerField(null=True, blank=True)
     answer_float = models.FloatField(null=True, blank=True)
 
+    class Meta:
+        index_together = [('updated', 'id')]
+
     def __str__(self):
         return 'Answer(id=%s ag.id=%s q.id=%s value=%s)' % (self.id, 
-            self.answer_group.id, self.question.id, self.display_value)
+            self.answer_group_id, self.question_id, self.display_value)
 
     @classmethod
     def factory(cls, question, answer_group, value):
         question.field.check_value(question.field_parms, value)
+        return cls.store(question, answer_group, value)
+
+    @classmethod
+    def store(cls, question, answer_group, value):
+        """Creates or updates the answer to the question without validating
+        the value, which must already be in storage format, e.g. from a
+        :class:`.ValidationPlan`."""
         kwargs = {
             'answer_group':answer_group,
             'question':question,
         }
         kwargs[question.field.storage_key] = value
-        
+
+        # answers go on the same database as their group
+        manager = Answer.objects.db_manager(
+            shard_for_survey(question.survey_id))
         try:
-            answer = Answer.objects.get(question=question,
+            answer = manager.get(question=question,
                 answer_group=answer_group)
             setattr(answer, question.field.storage_key, value)
             answer.save()
             return answer
         except Answer.DoesNotExist:
-            return Answer.objects.create(**kwargs)
+            return manager.create(**kwargs)
 
     @property
     def value(self):
@@ -684,3 +1227,136 @@ class Answer(TimeTrackModel):
         of ``choice`` field
         """
         return filter(lambda x: x[0] in self.value.split(','), self.question.field_choices())
+
+
+@python_2_unicode_compatible
+class Tombstone(TimeTrackModel):
+    """Records the deletion of an :class:`Answer` or :class:`AnswerGroup`
+    so that incremental exports (see :mod:`dform.export`) can pass it on.
+    Kept on the same database as the answers, the ids aren't foreign keys
+    as the objects are gone.
+    """
+    model_name = models.CharField(max_length=20)
+    object_id = models.PositiveIntegerField()
+    survey_version_id = models.PositiveIntegerField()
+    answer_group_id = models.PositiveIntegerField()
+    question_id = models.PositiveIntegerField(null=True, blank=True)
+
+    class Meta:
+        index_together = [('updated', 'id')]
+
+    def __str__(self):
+        return 'Tombstone(id=%s %s.id=%s)' % (self.id, self.model_name,
+            self.object_id)
+
+    @classmethod
+    def for_answers(cls, answer_group, answers):
+        """Creates tombstones for answers of the group that are about to
+        be deleted.
+
+        :param answers:
+            list of ``(answer_id, question_id)``
+        """
+        cls.objects.using(answer_group._state.db).bulk_create([
+            cls(model_name='answer', object_id=answer_id,
+                survey_version_id=answer_group.survey_version_id,
+                answer_group_id=answer_group.id, question_id=question_id)
+            for answer_id, question_id in answers])
+
+
+# ============================================================================
+# Submission Event Log
+# ============================================================================
+
+@python_2_unicode_compatible
+class SubmissionEvent(models.Model):
+    """An entry in the append-only log of survey submissions and edits, see
+    :mod:`dform.events`.  The id is the event's offset in the log.
+
+    :param changes: dictionary mapping the ids of the questions changed by
+        the submission to their new values, None for cleared answers
+    """
+    KIND_CHOICES = (
+        ('submit', 'Submit'),
+        ('edit', 'Edit'),
+    )
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    survey_version_id = models.PositiveIntegerField()
+    answer_group_id = models.PositiveIntegerField()
+    changes = JSONField(default={}, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Submission Event'
+
+    def __str__(self):
+        return 'SubmissionEvent(id=%s %s ag.id=%s)' % (self.id, self.kind,
+            self.answer_group_id)
+
+    def save(self, *args, **kwargs):
+        if self.id:
+            raise ValueError('SubmissionEvents can not be changed')
+
+        super(SubmissionEvent, self).save(*args, **kwargs)
+
+
+@python_2_unicode_compatible
+class EventConsumer(models.Model):
+    """A named reader of the :class:`SubmissionEvent` log and the offset
+    of the last event it acknowledged."""
+    name = models.CharField(max_length=100, unique=True)
+    offset = models.PositiveIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Event Consumer'
+
+    def __str__(self):
+        return 'EventConsumer(%s offset=%s)' % (self.name, self.offset)
+
+# ============================================================================
+# Signals
+# ============================================================================
+
+@receiver(pre_delete, sender=SurveyVersion)
+def survey_version_pre_delete(sender, **kwargs):
+    # groups are deleted in bulk ahead of the cascade, which would only look
+    # on the version's own database and skip the tombstones
+    version = kwargs['instance']
+    version.answer_groups().delete()
+
+    from . import results
+    if results.enabled():
+        results.ResultsTable(version).drop()
+
+
+def _bump_revisions(version_ids, using):
+    # questions changed without going through SurveyVersion, e.g. in the
+    # admin: a new revision stops cached validation plans being used and
+    # editors working from the old one get a conflict
+    if version_ids and not _in_schema_edit():
+        SurveyVersion.objects.using(using).filter(id__in=version_ids).update(
+            revision=F('revision') + 1)
+
+
+@receiver(post_save, sender=Question)
+def question_post_save(sender, **kwargs):
+    if not kwargs['created'] and not _in_schema_edit():
+        question = kwargs['instance']
+        _bump_revisions(list(question.survey_versions.values_list('id',
+            flat=True)), kwargs['using'])
+
+
+@receiver(post_save, sender=QuestionOrder)
+@receiver(post_delete, sender=QuestionOrder)
+def question_order_changed(sender, **kwargs):
+    _bump_revisions([kwargs['instance'].survey_version_id], kwargs['using'])
+
+
+@receiver(pre_delete, sender=Question)
+def question_pre_delete(sender, **kwargs):
+    question = kwargs['instance']
+    alias = shard_for_survey(question.survey_id)
+    if alias:
+        Answer.objects.using(alias).filter(question=question).delete()
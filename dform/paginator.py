@@ -0,0 +1,73 @@
+# dform.paginator.py
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+# ============================================================================
+
+def estimated_count(model, using='default'):
+    """Returns the database's estimate of the number of rows in the table for
+    the given model, or ``None`` if the backend doesn't keep estimates (e.g.
+    SQLite).  Estimates come from the planner statistics and so are only as
+    fresh as the last ``ANALYZE``.
+
+    :param model:
+        Django model class whose table is being estimated
+    :param using:
+        Database alias to ask
+    """
+    connection = connections[using]
+    table = model._meta.db_table
+
+    if connection.vendor == 'postgresql':
+        sql = 'SELECT reltuples::bigint FROM pg_class WHERE relname = %s'
+    elif connection.vendor == 'mysql':
+        sql = ('SELECT table_rows FROM information_schema.tables '
+            'WHERE table_schema = DATABASE() AND table_name = %s')
+    else:
+        return None
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [table])
+        row = cursor.fetchone()
+
+    if not row or row[0] is None or row[0] < 0:
+        return None
+
+    return int(row[0])
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator for the django admin change lists of very large tables.  A
+    ``COUNT(*)`` on tens of millions of rows can take longer than rendering
+    the page, so counting is done as follows:
+
+    * unfiltered querysets use the database's row estimate, if the backend
+      supports one and the estimate is above
+      ``settings.DFORM_ESTIMATED_COUNT_THRESHOLD`` (default 100,000)
+    * everything else is counted exactly, but the count stops at
+      ``settings.DFORM_ADMIN_COUNT_LIMIT`` rows (default 10,000), the
+      change list shows at most that many rows worth of page links
+
+    Pages past the count limit are reached through keyset ("older") links
+    rather than page numbers, see :class:`dform.admin.KeysetChangeListMixin`.
+    """
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            threshold = getattr(settings, 'DFORM_ESTIMATED_COUNT_THRESHOLD',
+                100000)
+            estimate = estimated_count(queryset.model, queryset.db)
+            if estimate is not None and estimate > threshold:
+                return estimate
+
+        limit = getattr(settings, 'DFORM_ADMIN_COUNT_LIMIT', 10000)
+        if not limit:
+            return queryset.count()
+
+        # counting a sliced queryset does a COUNT over a LIMITed sub-select,
+        # bounding the work done for huge filtered sets; values() keeps any
+        # extra(select=...) columns out of the sub-select
+        return queryset.values('pk').order_by()[:limit].count()
@@ -0,0 +1,173 @@
+# dform.profiling.py
+#
+# Opt-in profiling of a sample of requests to dform's views.  Each profiled
+# request writes a cProfile stats file and a JSON description (timings,
+# queries, memory) to settings.DFORM_PROFILE_DIR.
+import cProfile, json, logging, os, random, re, time
+from functools import wraps
+
+from django.conf import settings
+
+from .queries import QueryCounter, fingerprint
+
+try:
+    import tracemalloc
+except ImportError:      # pragma: no cover, python 2.7
+    tracemalloc = None
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'HTTP_X_DFORM_PROFILE'
+RE_PROFILE_NAME = re.compile(r'^[\w.-]+\.(prof|json)$')
+
+# ============================================================================
+
+def profile_dir():
+    return getattr(settings, 'DFORM_PROFILE_DIR', '')
+
+
+def should_profile(request):
+    """Returns True if this request should be profiled: profiling is
+    configured and either the request is part of the
+    ``settings.DFORM_PROFILE_SAMPLE_RATE`` sample or it was made by a staff
+    member with the ``X-DForm-Profile`` header set.
+    """
+    if not profile_dir():
+        return False
+
+    if request.META.get(PROFILE_HEADER):
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_active and user.is_staff:
+            return True
+
+    rate = getattr(settings, 'DFORM_PROFILE_SAMPLE_RATE', 0)
+    return bool(rate) and random.random() < rate
+
+
+def profiled_view(name):
+    """View decorator that profiles a sample of requests, see
+    :func:`should_profile`.  Profiles are tagged with the view name and the
+    survey version, which the view provides by setting
+    ``request.dform_version_id``.
+    """
+    def decorator(target):
+        @wraps(target)
+        def wrapper(request, *args, **kwargs):
+            if not should_profile(request):
+                return target(request, *args, **kwargs)
+
+            tracing = tracemalloc is not None and not tracemalloc.is_tracing()
+            if tracing:
+                tracemalloc.start()
+
+            profiler = cProfile.Profile()
+            start = time.time()
+            try:
+                with QueryCounter() as counter:
+                    response = profiler.runcall(target, request, *args,
+                        **kwargs)
+            finally:
+                elapsed = time.time() - start
+                peak = None
+                if tracing:
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+
+            save_profile(name, request, profiler, counter, elapsed, peak,
+                response.status_code)
+            return response
+        return wrapper
+    return decorator
+
+
+def save_profile(name, request, profiler, counter, elapsed, peak,
+        status_code):
+    """Writes the profiler's stats and a JSON description of the request to
+    the profile directory, then removes the oldest profiles beyond
+    ``settings.DFORM_PROFILE_KEEP`` (default 100).
+    """
+    directory = profile_dir()
+    version_id = getattr(request, 'dform_version_id', 0)
+    now = time.time()
+    base = '%s-%03d_%s_%s_%s' % (time.strftime('%Y%m%d-%H%M%S',
+        time.localtime(now)), int(now * 1000) % 1000, name, version_id,
+        os.getpid())
+    info = {
+        'name':base,
+        'view':name,
+        'survey_version':version_id,
+        'path':request.path,
+        'method':request.method,
+        'status_code':status_code,
+        'time':now,
+        'created':time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now)),
+        'elapsed':elapsed,
+        'peak_memory':peak,
+        'num_queries':counter.count,
+        'db_time':counter.total_time,
+        'queries':[{
+            'alias':query['alias'],
+            'time':query['time'],
+            'sql':query['sql'],
+            'fingerprint':fingerprint(query['sql']),
+        } for query in counter.queries],
+    }
+
+    try:
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        profiler.dump_stats(os.path.join(directory, base + '.prof'))
+        with open(os.path.join(directory, base + '.json'), 'w') as f:
+            json.dump(info, f, indent=2)
+    except (IOError, OSError):
+        logger.exception('Could not write profile %s to %s', base, directory)
+        return
+
+    prune_profiles(getattr(settings, 'DFORM_PROFILE_KEEP', 100))
+
+
+def list_profiles():
+    """Returns the JSON descriptions of the saved profiles, newest first."""
+    directory = profile_dir()
+    if not directory or not os.path.isdir(directory):
+        return []
+
+    profiles = []
+    for filename in os.listdir(directory):
+        if not filename.endswith('.json'):
+            continue
+
+        try:
+            with open(os.path.join(directory, filename)) as f:
+                info = json.load(f)
+        except (IOError, OSError, ValueError):
+            continue
+
+        profiles.append(info)
+
+    profiles.sort(key=lambda info: info['time'], reverse=True)
+    return profiles
+
+
+def prune_profiles(keep):
+    for info in list_profiles()[keep:]:
+        for ext in ('.prof', '.json'):
+            try:
+                os.remove(os.path.join(profile_dir(), info['name'] + ext))
+            except OSError:
+                pass
+
+
+def profile_path(filename):
+    """Returns the full path to the named profile file, or None if the name
+    isn't a profile file in the profile directory."""
+    directory = profile_dir()
+    if not directory or not RE_PROFILE_NAME.match(filename):
+        return None
+
+    path = os.path.join(directory, filename)
+    if not os.path.isfile(path):
+        return None
+
+    return path
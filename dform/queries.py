@@ -0,0 +1,303 @@
+# dform.queries.py
+#
+# Counting and fingerprinting of the SQL issued by dform's views, used to
+# enforce query budgets in tests and to log sampled summaries in production
+import logging, random, re, time
+from collections import Counter
+from functools import wraps
+
+from django.conf import settings
+from django.db import connections
+
+from .routers import dform_databases
+
+logger = logging.getLogger(__name__)
+
+# ============================================================================
+
+RE_STRING = re.compile(r"'(?:[^']|'')*'")
+RE_NUMBER = re.compile(r'\b\d+(\.\d+)?\b')
+RE_IN_LIST = re.compile(r'\bIN \((\?, )*\?\)', re.IGNORECASE)
+RE_SPACE = re.compile(r'\s+')
+
+def fingerprint(sql):
+    """Returns a normalized version of the given SQL with literals replaced
+    by ``?`` and ``IN`` lists collapsed, so that the same statement run with
+    different parameters has the same fingerprint.
+    """
+    sql = RE_STRING.sub('?', sql)
+    sql = RE_NUMBER.sub('?', sql)
+    sql = RE_IN_LIST.sub('IN (...)', sql)
+    return RE_SPACE.sub(' ', sql).strip()
+
+
+class _HookedCursor(object):
+    # cursor proxy passing each statement and its duration to a QueryHook
+    def __init__(self, cursor, hook, alias):
+        self.cursor = cursor
+        self.hook = hook
+        self.alias = alias
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self.cursor.__exit__(exc_type, exc_value, traceback)
+
+    def _run(self, method, sql, params):
+        start = time.time()
+        try:
+            return method(sql, params)
+        finally:
+            self.hook.record(self.alias, sql, time.time() - start)
+
+    def execute(self, sql, params=None):
+        return self._run(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self._run(self.cursor.executemany, sql, param_list)
+
+
+class QueryHook(object):
+    """Context manager passing every statement run on the given database
+    aliases while it is active to :meth:`record`.  Uses the connections'
+    ``execute_wrapper()`` where Django has it (2.0+) and otherwise wraps
+    their cursors the same way.  Debug cursors aren't forced on and no
+    signals are connected, and as Django's connections belong to a thread
+    only the current thread's queries are seen.
+
+    :param using:
+        list of database aliases, defaults to all of them
+    """
+    def __init__(self, using=None):
+        self.using = using
+        self._undo = []
+
+    def record(self, alias, sql, seconds):
+        raise NotImplementedError()
+
+    def _execute_wrapper(self, alias):
+        def wrapper(execute, sql, params, many, context):
+            start = time.time()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                self.record(alias, sql, time.time() - start)
+        return wrapper
+
+    def _cursor_maker(self, make, alias):
+        def maker(*args, **kwargs):
+            return _HookedCursor(make(*args, **kwargs), self, alias)
+        return maker
+
+    def _wrap_cursors(self, connection, alias):
+        # returns a callable undoing the wrapping
+        saved = {}
+        for name in ('cursor', 'chunked_cursor'):
+            if hasattr(connection, name):
+                saved[name] = connection.__dict__.get(name)
+                setattr(connection, name, self._cursor_maker(
+                    getattr(connection, name), alias))
+
+        def undo():
+            for name, previous in saved.items():
+                if previous is None:
+                    delattr(connection, name)
+                else:
+                    setattr(connection, name, previous)
+        return undo
+
+    def __enter__(self):
+        aliases = list(connections) if self.using is None else self.using
+        for alias in aliases:
+            connection = connections[alias]
+            if hasattr(connection, 'execute_wrapper'):
+                context = connection.execute_wrapper(
+                    self._execute_wrapper(alias))
+                context.__enter__()
+                self._undo.append(
+                    lambda context=context: context.__exit__(None, None,
+                    None))
+            else:
+                self._undo.append(self._wrap_cursors(connection, alias))
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        while self._undo:
+            self._undo.pop()()
+
+
+class QueryTimer(QueryHook):
+    """:class:`QueryHook` that only adds up the number of statements and
+    their duration, cheap enough to wrap every request.
+
+    .. code-block:: python
+
+        with QueryTimer(['default']) as timer:
+            survey.questions()
+
+        print(timer.count, timer.total_time)
+    """
+    def __init__(self, using=None):
+        super(QueryTimer, self).__init__(using)
+        self.count = 0
+        self.total_time = 0.0
+
+    def record(self, alias, sql, seconds):
+        self.count += 1
+        self.total_time += seconds
+
+
+class QueryCounter(QueryHook):
+    """Context manager and decorator that captures the queries run on the
+    given database aliases, all of them by default.
+
+    .. code-block:: python
+
+        with QueryCounter() as counter:
+            survey.questions()
+
+        print(counter.count, counter.fingerprints())
+
+    When used as a decorator the most recent counter is available as the
+    ``counter`` attribute of the decorated function.
+
+    :param using:
+        list of database aliases, defaults to all of them
+    """
+    def __init__(self, using=None):
+        super(QueryCounter, self).__init__(using)
+        self.queries = []
+
+    def __enter__(self):
+        self.queries = []
+        return super(QueryCounter, self).__enter__()
+
+    def record(self, alias, sql, seconds):
+        self.queries.append({
+            'alias':alias,
+            'sql':sql,
+            'time':seconds,
+        })
+
+    def __call__(self, fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with self.__class__(self.using) as counter:
+                wrapper.counter = counter
+                return fn(*args, **kwargs)
+        return wrapper
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def total_time(self):
+        """Database time in seconds spent running the queries."""
+        return sum(query['time'] for query in self.queries)
+
+    def fingerprints(self):
+        """Returns a :class:`Counter` of query fingerprints."""
+        return Counter(fingerprint(query['sql']) for query in self.queries)
+
+    def summary(self, top=3):
+        """Returns a one line description of the captured queries, including
+        the most repeated fingerprints (the usual N+1 suspects)."""
+        repeated = ['%dx %s' % (num, sql[:120]) for sql, num in
+            self.fingerprints().most_common(top) if num > 1]
+        text = 'queries=%d db_time=%.1fms' % (self.count,
+            self.total_time * 1000)
+        if repeated:
+            text += ' repeated=[%s]' % '; '.join(repeated)
+
+        return text
+
+    def report(self):
+        """Returns a multi-line listing of every fingerprint and how many
+        times it was run, most frequent first."""
+        lines = ['%d queries:' % self.count]
+        for sql, num in self.fingerprints().most_common():
+            lines.append('  %4dx %s' % (num, sql))
+
+        return '\n'.join(lines)
+
+# ============================================================================
+# Production Logging
+# ============================================================================
+
+def sampled_query_log(target):
+    """View decorator that logs a :func:`QueryCounter.summary` for a sample
+    of requests.  The sample rate is the fraction of requests set in
+    ``settings.DFORM_QUERY_LOG_SAMPLE_RATE``, off by default.  Only the
+    databases dform routes to are watched.
+    """
+    @wraps(target)
+    def wrapper(*args, **kwargs):
+        rate = getattr(settings, 'DFORM_QUERY_LOG_SAMPLE_RATE', 0)
+        if not rate or random.random() >= rate:
+            return target(*args, **kwargs)
+
+        with QueryCounter(dform_databases()) as counter:
+            response = target(*args, **kwargs)
+
+        logger.info('%s %s', target.__name__, counter.summary())
+        return response
+    return wrapper
+
+# ============================================================================
+# Test Helpers
+# ============================================================================
+
+class QueryBudgetMixin(object):
+    """Mixin for :class:`TestCase` classes providing assertions about the
+    number of queries a piece of code runs.
+    """
+    def assertQueryBudget(self, budget, fn, *args, **kwargs):
+        """Calls ``fn`` with the given arguments and fails if it runs more
+        than ``budget`` queries.
+
+        :returns:
+            the return value of ``fn``
+        """
+        with QueryCounter() as counter:
+            result = fn(*args, **kwargs)
+
+        if counter.count > budget:
+            self.fail('Query budget of %d exceeded by %s\n%s' % (budget,
+                getattr(fn, '__name__', fn), counter.report()))
+
+        return result
+
+    def assertQueryScaling(self, setup, fn, sizes=(2, 10), per_item=0):
+        """Fails if the number of queries run by ``fn`` grows faster than
+        ``per_item`` queries for each additional item.  For each of the given
+        sizes ``setup(size)`` is called to build the data, e.g. a survey with
+        that many questions, and its return value is passed to ``fn`` whose
+        queries are counted.  Use ``per_item=0`` for paths that should run a
+        constant number of queries.
+        """
+        counters = []
+        for size in sizes:
+            context = setup(size)
+            with QueryCounter() as counter:
+                fn(context)
+            counters.append(counter)
+
+        first, last = counters[0], counters[-1]
+        growth = (last.count - first.count) / float(sizes[-1] - sizes[0])
+        if growth > per_item:
+            grew = last.fingerprints() - first.fingerprints()
+            lines = ['  +%dx %s' % (num, sql) for sql, num in
+                grew.most_common()]
+            self.fail(('Queries grow by %.1f per item (allowed %s): %d '
+                'queries for %s items, %d for %s\n%s') % (growth, per_item,
+                first.count, sizes[0], last.count, sizes[-1],
+                '\n'.join(lines)))
@@ -0,0 +1,245 @@
+# dform.recaptcha.py
+#
+# Server side verification of reCAPTCHA responses for surveys with
+# use_recaptcha.  Calls to the verification endpoint go through a pool of
+# keep-alive connections with tight timeouts, a verified response is cached
+# briefly for retries of the same submission and a circuit breaker stops
+# calling an endpoint that keeps failing.
+import hashlib, json, logging, os, socket, threading, time
+
+from django.conf import settings
+from django.core.cache import caches
+from six.moves import http_client, queue
+from six.moves.urllib.parse import urlencode, urlparse
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+VERIFY_URL = 'https://www.google.com/recaptcha/api/siteverify'
+FIELD_NAME = 'g-recaptcha-response'
+
+# ============================================================================
+
+def enabled():
+    return bool(getattr(settings, 'DFORM_RECAPTCHA_SECRET', ''))
+
+
+def _setting(name, default):
+    return getattr(settings, 'DFORM_RECAPTCHA_' + name, default)
+
+
+class ConnectionPool(object):
+    """Keeps up to ``size`` idle keep-alive connections to the host of a
+    URL for reuse by :func:`post`.
+
+    :param timeout:
+        seconds allowed for connecting and for each read
+    """
+    def __init__(self, url, size=10, timeout=2):
+        parts = urlparse(url)
+        if parts.scheme == 'https':
+            self.connection_class = http_client.HTTPSConnection
+        else:
+            self.connection_class = http_client.HTTPConnection
+
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path or '/'
+        if parts.query:
+            self.path += '?' + parts.query
+
+        self.timeout = timeout
+        self.idle = queue.LifoQueue(size)
+        self.pid = os.getpid()
+
+    def _request(self, connection, body, headers):
+        connection.request('POST', self.path, body, headers)
+        response = connection.getresponse()
+        return response, response.read()
+
+    def post(self, body, headers):
+        """Sends a POST and returns a tuple of the response status and
+        body.  A pooled connection the server has since closed is retried
+        once on a new connection, timeouts aren't retried.
+
+        :raises socket.error, http_client.HTTPException:
+            on a connection failure or timeout
+        """
+        try:
+            connection = self.idle.get_nowait()
+            reused = True
+        except queue.Empty:
+            connection = self.connection_class(self.host, self.port,
+                timeout=self.timeout)
+            reused = False
+
+        try:
+            response, data = self._request(connection, body, headers)
+        except (socket.error, http_client.HTTPException) as e:
+            connection.close()
+            if not reused or isinstance(e, socket.timeout):
+                raise
+
+            connection = self.connection_class(self.host, self.port,
+                timeout=self.timeout)
+            try:
+                response, data = self._request(connection, body, headers)
+            except (socket.error, http_client.HTTPException):
+                connection.close()
+                raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            try:
+                self.idle.put_nowait(connection)
+            except queue.Full:
+                connection.close()
+
+        return response.status, data
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class CircuitBreaker(object):
+    """Opens after ``DFORM_RECAPTCHA_FAILURE_THRESHOLD`` (default 5)
+    consecutive failures.  While open, calls are refused for
+    ``DFORM_RECAPTCHA_RESET_SECONDS`` (default 30), after which a single
+    trial call is let through: success closes the breaker, failure keeps it
+    open for another period.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.failures = 0
+        self.opened = None
+
+    def allow(self, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            if self.opened is None:
+                return True
+
+            if now - self.opened >= _setting('RESET_SECONDS', 30):
+                # half open, this caller makes the trial call
+                self.opened = now
+                return True
+
+            return False
+
+    def success(self):
+        with self.lock:
+            self.reset()
+
+    def failure(self, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self.failures += 1
+            if self.failures >= _setting('FAILURE_THRESHOLD', 5):
+                self.opened = now
+
+
+BREAKER = CircuitBreaker()
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool():
+    """Returns the :class:`ConnectionPool` for
+    ``settings.DFORM_RECAPTCHA_VERIFY_URL``, Google's endpoint by default."""
+    url = _setting('VERIFY_URL', VERIFY_URL)
+    with _pools_lock:
+        pool = _pools.get(url)
+        if pool is None or pool.pid != os.getpid():
+            # connections aren't shared with a forked parent
+            pool = ConnectionPool(url, _setting('POOL_SIZE', 10),
+                _setting('TIMEOUT', 2))
+            _pools[url] = pool
+
+        return pool
+
+
+def reset():
+    """Closes the pooled connections and closes the circuit breaker."""
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+
+        _pools.clear()
+
+    BREAKER.reset()
+
+
+def _unavailable(result):
+    metrics.RECAPTCHA_CHECKS.inc(result=result)
+    return _setting('FAIL_OPEN', False)
+
+
+def verify(token, remote_ip='', submission=None):
+    """Verifies a reCAPTCHA response token with
+    ``settings.DFORM_RECAPTCHA_SECRET``.
+
+    Tokens are single use.  A token that passed is cached for
+    ``DFORM_RECAPTCHA_CACHE_SECONDS`` (default 120) together with
+    ``submission``, so only a retry of the same submission doesn't need
+    another call; without ``submission`` nothing is cached.  When the
+    endpoint fails, times out or answers with anything but a JSON object,
+    or the circuit breaker is open, the result is
+    ``settings.DFORM_RECAPTCHA_FAIL_OPEN`` (default False, reject).
+
+    :param submission:
+        optional string identifying the submission, e.g. the survey version
+        id and idempotency key
+    :returns:
+        True if the submission should be accepted
+    """
+    if not token:
+        metrics.RECAPTCHA_CHECKS.inc(result='missing')
+        return False
+
+    cache = caches[_setting('CACHE', 'default')]
+    key = None
+    if submission:
+        key = 'dform:recaptcha:%s' % hashlib.sha256(('%s\n%s' % (
+            submission, token)).encode('utf-8')).hexdigest()
+        if cache.get(key):
+            metrics.RECAPTCHA_CHECKS.inc(result='cached')
+            return True
+
+    if not BREAKER.allow():
+        return _unavailable('open')
+
+    body = urlencode({
+        'secret':settings.DFORM_RECAPTCHA_SECRET,
+        'response':token,
+        'remoteip':remote_ip,
+    })
+    headers = {'Content-Type':'application/x-www-form-urlencoded'}
+    try:
+        status, data = get_pool().post(body, headers)
+        if status != 200:
+            raise ValueError('HTTP status %s' % status)
+
+        result = json.loads(data.decode('utf-8'))
+        if not isinstance(result, dict):
+            raise ValueError('unexpected response %r' % data[:100])
+
+        success = result.get('success') is True
+    except (socket.error, http_client.HTTPException, ValueError) as e:
+        logger.warning('reCAPTCHA verification failed: %s', e)
+        BREAKER.failure()
+        return _unavailable('error')
+
+    BREAKER.success()
+    if success and key:
+        cache.set(key, True, _setting('CACHE_SECONDS', 120))
+
+    metrics.RECAPTCHA_CHECKS.inc(result='passed' if success else 'failed')
+    return success
@@ -0,0 +1,313 @@
+# dform.results.py
+#
+# Optional wide results tables: one table per SurveyVersion with a row per
+# AnswerGroup and a typed column per question, kept up to date as answers
+# are written so they can be queried with plain SQL.  Tables are only
+# created and rebuilt outside of submissions, see record() and prepare().
+import datetime, logging
+
+from django.conf import settings
+from django.db import (connections, models, router, transaction,
+    DatabaseError)
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import SurveyVersion, AnswerGroup, Answer
+
+logger = logging.getLogger(__name__)
+
+# AnswerGroup fields copied into every results table
+GROUP_FIELDS = ('token', 'ip_address', 'created', 'updated')
+
+# (alias, table name) -> column names, for tables known to be up to date
+_ready = {}
+
+# (alias, table name) of tables record() has warned about
+_warned = set()
+
+# rows changed this long before a rebuild started are written again after
+# it, covering clock differences and transactions still in flight
+REBUILD_SLACK = datetime.timedelta(seconds=60)
+
+# ============================================================================
+
+def enabled():
+    return getattr(settings, 'DFORM_RESULTS_TABLES', False)
+
+
+def table_name(survey_version_id):
+    return 'dform_results_%s' % survey_version_id
+
+
+class ResultsTable(object):
+    """The wide results table of a :class:`SurveyVersion`, named
+    ``dform_results_<version id>``.  Columns are ``answer_group_id`` (the
+    primary key), the group's ``token``, ``ip_address``, ``created`` and
+    ``updated``, and ``q_<question id>`` for each question typed like the
+    :class:`Answer` column the question's field stores its value in.  The
+    table is on the same database as the version's answers.
+    """
+    def __init__(self, survey_version):
+        self.survey_version = survey_version
+        self.plan = survey_version.validation_plan()
+        self.name = table_name(survey_version.id)
+        self.using = survey_version.answer_database or \
+            router.db_for_write(AnswerGroup)
+
+        # (column, model field) in table order
+        self.columns = [('answer_group_id', models.IntegerField())]
+        for name in GROUP_FIELDS:
+            self.columns.append((name, AnswerGroup._meta.get_field(name)))
+        for rule in self.plan.rules:
+            self.columns.append((rule.name,
+                Answer._meta.get_field(rule.storage_key)))
+
+    @property
+    def connection(self):
+        return connections[self.using]
+
+    @property
+    def column_names(self):
+        return tuple(name for name, _ in self.columns)
+
+    def _quote(self, name):
+        return self.connection.ops.quote_name(name)
+
+    def exists(self, name=None):
+        with self.connection.cursor() as cursor:
+            return (name or self.name) in \
+                self.connection.introspection.table_names(cursor)
+
+    def _drop(self, cursor, name):
+        if self.exists(name):
+            cursor.execute('DROP TABLE %s' % self._quote(name))
+
+    def _create(self, cursor, name):
+        definitions = ['%s %s NOT NULL PRIMARY KEY' % (
+            self._quote('answer_group_id'),
+            models.IntegerField().db_type(self.connection))]
+        for column, field in self.columns[1:]:
+            definitions.append('%s %s NULL' % (self._quote(column),
+                field.db_type(self.connection)))
+
+        cursor.execute('CREATE TABLE %s (%s)' % (self._quote(name),
+            ', '.join(definitions)))
+
+    def _create_index(self, cursor):
+        cursor.execute('CREATE INDEX %s ON %s (%s)' % (
+            self._quote(self.name + '_updated'), self._quote(self.name),
+            self._quote('updated')))
+
+    def _mark_ready(self):
+        _ready[(self.using, self.name)] = self.column_names
+        _warned.discard((self.using, self.name))
+
+    def drop(self):
+        _ready.pop((self.using, self.name), None)
+        with self.connection.cursor() as cursor:
+            self._drop(cursor, self.name)
+
+    def create(self):
+        """Drops the table if there is one and creates it empty."""
+        with transaction.atomic(using=self.using):
+            with self.connection.cursor() as cursor:
+                self._drop(cursor, self.name)
+                self._create(cursor, self.name)
+                self._create_index(cursor)
+
+        self._mark_ready()
+
+    def is_current(self):
+        """Returns True if the table exists with the version's current
+        questions as columns."""
+        key = (self.using, self.name)
+        if _ready.get(key) == self.column_names:
+            return True
+
+        if not self.exists():
+            return False
+
+        with self.connection.cursor() as cursor:
+            description = self.connection.introspection.get_table_description(
+                cursor, self.name)
+
+        if tuple(column.name for column in description) != self.column_names:
+            return False
+
+        _ready[key] = self.column_names
+        return True
+
+    def _row(self, group, values):
+        row = [group.id]
+        for name, field in self.columns[1:len(GROUP_FIELDS) + 1]:
+            row.append(field.get_db_prep_value(getattr(group, name),
+                self.connection))
+        for rule, (_, field) in zip(self.plan.rules,
+                self.columns[len(GROUP_FIELDS) + 1:]):
+            row.append(field.get_db_prep_value(values.get(rule.question.id),
+                self.connection))
+
+        return row
+
+    def write(self, groups, name=None):
+        """Replaces the rows of the given :class:`AnswerGroup` objects with
+        their current answers.
+
+        :param name:
+            table to write to, defaults to the results table
+        """
+        if not groups:
+            return
+
+        values = self.plan.storage.values_many(groups)
+        rows = [self._row(group, values.get(group.id, {})) for group in
+            groups]
+
+        table = self._quote(name or self.name)
+        ids = [group.id for group in groups]
+        insert = 'INSERT INTO %s (%s) VALUES (%s)' % (table,
+            ', '.join(self._quote(name) for name in self.column_names),
+            ', '.join(['%s'] * len(self.columns)))
+
+        with transaction.atomic(using=self.using):
+            with self.connection.cursor() as cursor:
+                cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (table,
+                    self._quote('answer_group_id'),
+                    ', '.join(['%s'] * len(ids))), ids)
+                cursor.executemany(insert, rows)
+
+    def rebuild(self, batch_size=500, progress=None):
+        """Recreates the table from all of the version's answers.  The rows
+        are copied into a new table that replaces the old one in a single
+        transaction, so submissions keep writing to the old table until
+        then.  Groups changed while the copy ran are written again once the
+        new table is in place.
+
+        :param progress:
+            optional callable, called with the number of rows written so far
+            after each batch
+        :returns:
+            number of rows written
+        """
+        started = timezone.now() - REBUILD_SLACK
+        building = self.name + '_new'
+        with self.connection.cursor() as cursor:
+            self._drop(cursor, building)
+            self._create(cursor, building)
+
+        groups = self.survey_version.answer_groups().order_by('id')
+        count = 0
+        last_id = 0
+        while True:
+            batch = list(groups.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+
+            self.write(batch, building)
+            last_id = batch[-1].id
+            count += len(batch)
+            if progress:
+                progress(count)
+
+        with transaction.atomic(using=self.using):
+            with self.connection.cursor() as cursor:
+                self._drop(cursor, self.name)
+                cursor.execute('ALTER TABLE %s RENAME TO %s' % (
+                    self._quote(building), self._quote(self.name)))
+                self._create_index(cursor)
+
+        self._mark_ready()
+
+        # catch up with groups saved after their batch was copied
+        changed = groups.filter(Q(updated__gte=started) |
+            Q(answer__updated__gte=started)).distinct()
+        last_id = 0
+        while True:
+            batch = list(changed.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+
+            self.write(batch)
+            last_id = batch[-1].id
+
+        return count
+
+
+def record(survey_version, groups):
+    """Brings the results table rows of the given groups up to date, when
+    ``settings.DFORM_RESULTS_TABLES`` is on.
+
+    This is called while submissions are saved, so it never creates or
+    rebuilds a table.  If the table is missing or out of date the rows are
+    skipped and a warning is logged, the table has to be rebuilt with
+    ``dform_rebuild_results`` or :func:`ResultsTable.rebuild`.  A table
+    dropped or swapped by a rebuild since it was last checked is checked
+    again, the write is retried once if the new one is current.
+    """
+    if not enabled() or not groups:
+        return
+
+    table = ResultsTable(survey_version)
+    key = (table.using, table.name)
+    for _ in range(2):
+        if not table.is_current():
+            break
+
+        try:
+            table.write(groups)
+            return
+        except DatabaseError:
+            # the write's savepoint was rolled back, the submission goes on
+            _ready.pop(key, None)
+
+    if key not in _warned:
+        _warned.add(key)
+        logger.warning('Results table %s is missing or out of date, rows '
+            'are not written to it until it is rebuilt', table.name)
+
+
+def _rebuild(survey_version_id):
+    version = SurveyVersion.objects.filter(id=survey_version_id).first()
+    if version:
+        ResultsTable(version).rebuild()
+
+
+def prepare(survey_version):
+    """Rebuilds the version's results table once the current transaction
+    commits, when ``settings.DFORM_RESULTS_TABLES`` is on.  Called by survey
+    edits, which only happen before a version has answers, so the table is
+    ready for the first submission without the submission creating it.
+    """
+    if enabled():
+        survey_version_id = survey_version.id
+        transaction.on_commit(lambda: _rebuild(survey_version_id))
+
+
+def forget_groups(survey_version_id, group_ids, using):
+    """Removes the rows of deleted :class:`AnswerGroup` objects, given by
+    id, from their version's results table if there is one.  Tables known
+    to be current are not looked up again."""
+    if not group_ids:
+        return
+
+    connection = connections[using]
+    name = table_name(survey_version_id)
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        if (using, name) not in _ready and name not in \
+                connection.introspection.table_names(cursor):
+            return
+
+        group_ids = list(group_ids)
+        for start in range(0, len(group_ids), 500):
+            batch = group_ids[start:start + 500]
+            cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (quote(name),
+                quote('answer_group_id'), ', '.join(['%s'] * len(batch))),
+                batch)
+
+
+def forget(answer_group):
+    """Removes the row of a deleted :class:`AnswerGroup` from its version's
+    results table, if there is one."""
+    forget_groups(answer_group.survey_version_id, [answer_group.id],
+        router.db_for_write(AnswerGroup, instance=answer_group))
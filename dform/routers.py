@@ -0,0 +1,233 @@
+# dform.routers.py
+#
+# Database router sending reads of dform's models to a replica while writes,
+# transactions and reads that follow a write stay on the primary.  Sharded
+# answers are sent to their survey's shard, see dform.sharding.
+import random, threading, time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.core.signals import request_finished, request_started
+from django.db import connections
+from django.utils.deprecation import MiddlewareMixin
+
+from .sharding import is_sharded, shard_databases, shard_for_instance
+
+COOKIE_NAME = 'dform_primary'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+
+_state = threading.local()
+
+# ============================================================================
+
+def primary_database():
+    return getattr(settings, 'DFORM_WRITE_DATABASE', 'default')
+
+
+def read_databases():
+    """Returns the list of replica aliases from
+    ``settings.DFORM_READ_DATABASE``, which may be a single alias or a
+    list."""
+    aliases = getattr(settings, 'DFORM_READ_DATABASE', None)
+    if not aliases:
+        return []
+    if isinstance(aliases, (list, tuple)):
+        return list(aliases)
+
+    return [aliases]
+
+
+def dform_databases():
+    """Returns the aliases dform's models can be routed to: the primary,
+    the replicas and the shards."""
+    aliases = []
+    for alias in [primary_database()] + read_databases() + shard_databases():
+        if alias not in aliases:
+            aliases.append(alias)
+
+    return aliases
+
+
+def reset():
+    """Clears the per-thread routing state, called as each request starts
+    and finishes."""
+    _state.pinned = False
+    _state.wrote = 0
+
+
+@contextmanager
+def scope():
+    """Context manager giving the enclosed code routing state of its own,
+    like a request gets: once it writes, its reads stay on the primary
+    until it ends, and the state from before is restored afterwards.  Use
+    it around units of work outside requests, e.g. each task of a worker.
+    """
+    previous = (getattr(_state, 'pinned', False), getattr(_state, 'wrote',
+        0), getattr(_state, 'scoped', False))
+    reset()
+    _state.scoped = True
+    try:
+        yield
+    finally:
+        _state.pinned, _state.wrote, _state.scoped = previous
+
+
+def pin():
+    """Sends the rest of this thread's (request's) dform reads to the
+    primary."""
+    _state.pinned = True
+
+
+def _read_your_writes_seconds():
+    return getattr(settings, 'DFORM_READ_YOUR_WRITES_SECONDS', 10)
+
+
+def is_pinned():
+    if getattr(_state, 'pinned', False):
+        return True
+
+    # a write pins the rest of a request or scope.  Outside of them it only
+    # pins for as long as a replica may lag, so commands, workers and other
+    # threads with nothing to reset the state don't stay on the primary
+    # for good.
+    wrote = getattr(_state, 'wrote', 0)
+    if not wrote:
+        return False
+
+    return getattr(_state, 'scoped', False) or \
+        time.time() - wrote < _read_your_writes_seconds()
+
+
+@contextmanager
+def use_primary():
+    """Context manager sending the enclosed dform reads to the primary, for
+    code that needs up to date data."""
+    previous = getattr(_state, 'pinned', False)
+    _state.pinned = True
+    try:
+        yield
+    finally:
+        _state.pinned = previous
+
+
+def primary_view(target):
+    """View decorator running the view with :func:`use_primary`, for views
+    that read data they are about to change."""
+    @wraps(target)
+    def wrapper(*args, **kwargs):
+        with use_primary():
+            return target(*args, **kwargs)
+    return wrapper
+
+
+def _request_started(**kwargs):
+    reset()
+    _state.scoped = True
+
+
+def _request_finished(**kwargs):
+    reset()
+    _state.scoped = False
+
+request_started.connect(_request_started,
+    dispatch_uid='dform_routers_reset')
+request_finished.connect(_request_finished,
+    dispatch_uid='dform_routers_reset_finished')
+
+
+class DFormRouter(object):
+    """Routes reads of dform's models to the database alias (or one of the
+    aliases) in ``settings.DFORM_READ_DATABASE``.  Reads go to
+    ``settings.DFORM_WRITE_DATABASE`` (default ``'default'``) instead when:
+
+    * inside a ``transaction.atomic`` block on the primary
+    * anything has been written earlier in the request or :func:`scope`,
+      or outside of them in the last ``DFORM_READ_YOUR_WRITES_SECONDS``
+    * the request is pinned by :func:`use_primary`, or by
+      :class:`ReadYourWritesMiddleware` after the client's recent write
+
+    .. code-block:: python
+
+        DATABASE_ROUTERS = ['dform.routers.DFormRouter']
+        DFORM_READ_DATABASE = 'replica'
+
+    :class:`AnswerGroup` and :class:`Answer` queries with an instance hint
+    (related managers, saving and deleting) go to the shard of the
+    instance's survey when ``settings.DFORM_SHARD_MAP`` puts it on one.
+    Querysets without hints need to be pointed at the shard with
+    ``using()``, dform does that itself.
+    """
+    def _is_dform(self, model):
+        return model._meta.app_label == 'dform'
+
+    def _shard(self, model, hints):
+        if not is_sharded(model):
+            return None
+
+        return shard_for_instance(hints.get('instance'))
+
+    def db_for_read(self, model, **hints):
+        if not self._is_dform(model):
+            return None
+
+        shard = self._shard(model, hints)
+        if shard:
+            return shard
+
+        replicas = read_databases()
+        primary = primary_database()
+        if not replicas or is_pinned() or \
+                connections[primary].in_atomic_block:
+            return primary
+
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        if not self._is_dform(model):
+            return None
+
+        shard = self._shard(model, hints)
+        if shard:
+            return shard
+
+        # read your writes for the rest of this request
+        _state.wrote = time.time()
+        return primary_database()
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same data as the primary, sharded answers
+        # point at surveys and questions on the primary
+        aliases = set(read_databases() + shard_databases() +
+            [primary_database()])
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label == 'dform' and db in read_databases():
+            return False
+
+        return None
+
+
+class ReadYourWritesMiddleware(MiddlewareMixin):
+    """Keeps a client's dform reads on the primary for
+    ``settings.DFORM_READ_YOUR_WRITES_SECONDS`` (default 10) after it made a
+    POST (or other unsafe) request, so the pages following a submission
+    don't read from a replica that hasn't caught up yet.
+    """
+    def process_request(self, request):
+        reset()
+        if request.method not in SAFE_METHODS or \
+                request.COOKIES.get(COOKIE_NAME):
+            pin()
+
+    def process_response(self, request, response):
+        wrote = getattr(_state, 'wrote', 0)
+        if request.method not in SAFE_METHODS or wrote:
+            response.set_cookie(COOKIE_NAME, '1',
+                max_age=_read_your_writes_seconds(), httponly=True)
+
+        return response
@@ -0,0 +1,152 @@
+# dform.sampledata.py
+#
+# Random but realistic looking survey questions and answers, used to build
+# large data sets for benchmarking and load testing
+import bisect
+from collections import OrderedDict
+
+from .fields import (FIELDS, ChoiceField, Text, MultiText, Email, Checkboxes,
+    Rating, Integer, Float)
+
+# ============================================================================
+
+WORDS = ['apple', 'banana', 'service', 'quality', 'price', 'friendly',
+    'staff', 'slow', 'fast', 'delivery', 'great', 'poor', 'again', 'never',
+    'always', 'support', 'website', 'order', 'product', 'recommend', 'would',
+    'not', 'very', 'happy', 'experience', 'store', 'online', 'wait', 'time',
+    'helpful', 'easy', 'difficult', 'value', 'money', 'expected', 'better']
+
+CHOICE_WORDS = ['Red', 'Green', 'Blue', 'Yellow', 'Purple', 'Orange', 'Pink',
+    'Black', 'White', 'Grey']
+
+
+def zipf_weights(size, exponent=1.1):
+    """Returns a list of ``size`` weights following a Zipf distribution, the
+    first item being the most popular."""
+    return [1.0 / ((index + 1) ** exponent) for index in range(size)]
+
+
+class WeightedChoice(object):
+    """Picks items from a list with the given relative weights.  Uses
+    ``bisect`` on the cumulative weights so picking is O(log n)."""
+    def __init__(self, items, weights):
+        self.items = list(items)
+        self.totals = []
+        total = 0
+        for weight in weights:
+            total += weight
+            self.totals.append(total)
+
+    def pick(self, rng):
+        point = rng.random() * self.totals[-1]
+        index = bisect.bisect_right(self.totals, point)
+        return self.items[min(index, len(self.items) - 1)]
+
+
+# ratings lean positive, like most real customer surveys
+RATINGS = WeightedChoice(range(1, 6), [0.05, 0.08, 0.17, 0.35, 0.35])
+
+
+def random_field_parms(rng, field):
+    """Returns a ``field_parms`` value appropriate for the given
+    :class:`Field` class: an ``OrderedDict`` of 3 to 7 choices for choice
+    style fields and an empty dict for everything else."""
+    if not issubclass(field, ChoiceField):
+        return {}
+
+    words = rng.sample(CHOICE_WORDS, rng.randint(3, 7))
+    return OrderedDict((word[:2].lower() + str(index), word)
+        for index, word in enumerate(words))
+
+
+def random_sentence(rng, min_words, max_words):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(min_words,
+        max_words))]
+    return ' '.join(words).capitalize()
+
+# ============================================================================
+
+class AnswerGenerator(object):
+    """Generates answer values for :class:`.Question` objects in their
+    storage format (see :func:`.Answer.value`).
+
+    :param rng:
+        ``random.Random`` instance, pass a seeded one for repeatable data
+    :param answer_rate:
+        Probability an optional question gets answered, required questions
+        are always answered
+    """
+    def __init__(self, rng, answer_rate=0.85):
+        self.rng = rng
+        self.answer_rate = answer_rate
+        self._choosers = {}
+
+    def skip(self, question):
+        """Returns ``True`` if the given question should be left
+        unanswered."""
+        if question.required:
+            return False
+
+        return self.rng.random() >= self.answer_rate
+
+    def _chooser(self, question):
+        # choice weights are calculated once per question
+        chooser = self._choosers.get(question.id)
+        if not chooser:
+            keys = list(question.field_parms.keys())
+            chooser = WeightedChoice(keys, zipf_weights(len(keys)))
+            self._choosers[question.id] = chooser
+
+        return chooser
+
+    def value(self, question):
+        """Returns a random value valid for the given question."""
+        rng = self.rng
+        field = question.field
+
+        if field == Text:
+            return random_sentence(rng, 1, 8)
+        if field == MultiText:
+            return '\n'.join(random_sentence(rng, 5, 15)
+                for _ in range(rng.randint(1, 4)))
+        if field == Email:
+            return '%s%d@example.com' % (rng.choice(WORDS),
+                rng.randint(1, 99999))
+        if field == Rating:
+            return RATINGS.pick(rng)
+        if field == Integer:
+            return max(0, int(rng.gauss(40, 15)))
+        if field == Float:
+            return round(rng.lognormvariate(3, 0.8), 2)
+        if field == Checkboxes:
+            keys = list(question.field_parms.keys())
+            weights = zipf_weights(len(keys))
+            chosen = [key for key, weight in zip(keys, weights)
+                if rng.random() < weight * 0.6]
+            if not chosen:
+                chosen = [self._chooser(question).pick(rng)]
+            return ','.join(chosen)
+
+        # Dropdown & Radio
+        return self._chooser(question).pick(rng)
+
+
+def random_ip(rng):
+    """Returns a random public looking IPv4 address."""
+    return '%d.%d.%d.%d' % (rng.randint(1, 223), rng.randint(0, 255),
+        rng.randint(0, 255), rng.randint(1, 254))
+
+
+def field_for_index(index):
+    """Cycles through all of the registered :class:`Field` classes so that a
+    generated survey has every type of question."""
+    return FIELDS[index % len(FIELDS)]
+
+
+def form_value(question, value):
+    """Converts a value in storage format into what a browser would POST for
+    the question's form field."""
+    if question.field == Checkboxes:
+        return value.split(',')
+
+    return str(value)
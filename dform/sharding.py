@@ -0,0 +1,88 @@
+# dform.sharding.py
+#
+# Optional horizontal sharding of a survey's AnswerGroup and Answer rows
+# across database aliases.  Surveys, versions and questions always stay on
+# the default database, see DFormRouter for how queries get routed.
+import six
+from django.conf import settings
+from wrench.utils import dynamic_load
+
+# models whose rows live on a survey's shard
+SHARDED_MODELS = ('answergroup', 'answer')
+
+# ============================================================================
+
+def shard_databases():
+    """Returns the list of shard aliases in ``settings.DFORM_SHARDS``."""
+    return list(getattr(settings, 'DFORM_SHARDS', []))
+
+
+def modulo_shard(survey_id):
+    """Shard mapping that spreads surveys evenly across
+    ``settings.DFORM_SHARDS`` by id.  Adding a shard moves existing surveys,
+    only use it when the list of shards is fixed."""
+    shards = shard_databases()
+    return shards[int(survey_id) % len(shards)]
+
+
+def shard_for_survey(survey_id):
+    """Returns the alias holding the answers of the survey with the given id,
+    or None if they aren't sharded and use the regular databases.
+
+    ``settings.DFORM_SHARD_MAP`` is either a dictionary mapping survey ids to
+    aliases or the dotted name of a callable taking a survey id and returning
+    an alias (or None).
+    """
+    mapping = getattr(settings, 'DFORM_SHARD_MAP', None)
+    if not mapping or survey_id is None:
+        return None
+
+    if isinstance(mapping, six.string_types):
+        alias = dynamic_load(mapping)(survey_id)
+    else:
+        alias = mapping.get(survey_id)
+
+    if alias and alias not in shard_databases():
+        raise ValueError('Survey %s mapped to "%s" which is not in '
+            'DFORM_SHARDS' % (survey_id, alias))
+
+    return alias or None
+
+
+def is_sharded(model):
+    return model._meta.app_label == 'dform' and \
+        model._meta.model_name in SHARDED_MODELS
+
+
+def shard_for_instance(instance):
+    """Returns the shard alias for a model instance passed as a routing hint,
+    or None.  AnswerGroups and Answers that were loaded from or saved to a
+    shard say so in their state, for anything else the shard is looked up
+    through the survey."""
+    if instance is None or instance._meta.app_label != 'dform':
+        return None
+
+    model_name = instance._meta.model_name
+    if is_sharded(type(instance)) and \
+            instance._state.db in shard_databases():
+        return instance._state.db
+
+    if model_name == 'answergroup':
+        if instance.survey_version_id is None:
+            return None
+        return shard_for_survey(instance.survey_version.survey_id)
+
+    if model_name == 'answer':
+        # only use a group that has already been fetched, looking it up
+        # would route through here again
+        cache_name = type(instance)._meta.get_field(
+            'answer_group').get_cache_name()
+        return shard_for_instance(getattr(instance, cache_name, None))
+
+    if model_name == 'survey':
+        return shard_for_survey(instance.id)
+
+    if model_name in ('surveyversion', 'question'):
+        return shard_for_survey(instance.survey_id)
+
+    return None
@@ -0,0 +1,283 @@
+# dform.storage.py
+#
+# Answer storage backends.  A survey either keeps one Answer row per answered
+# question ("rows", the default) or a single JSON document on the
+# AnswerGroup mapping question ids to values ("document").
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Survey, AnswerGroup, Answer, Tombstone
+
+# ============================================================================
+
+class AnswerStorage(object):
+    """Interface for storing the answers of an :class:`AnswerGroup`.  Values
+    passed in must already be in storage format, e.g. from a
+    :class:`.ValidationPlan`, and are returned the same way.  Get the backend
+    for a survey with :func:`Survey.answer_storage_backend`.
+    """
+    name = ''
+
+    def values(self, answer_group):
+        """Returns a dictionary mapping question ids to the stored values of
+        the group."""
+        raise NotImplementedError()
+
+    def values_many(self, answer_groups):
+        """Returns a dictionary mapping the ids of the given groups to the
+        result of :func:`values` for each."""
+        return {group.id:self.values(group) for group in answer_groups}
+
+    def save(self, answer_group, values):
+        """Stores answers for the group.
+
+        :param values:
+            dictionary mapping :class:`Question` objects to values, None
+            removes the question's answer
+        """
+        raise NotImplementedError()
+
+    def store(self, answer_group, question, value):
+        """Stores the answer to a single question.
+
+        :returns:
+            the :class:`Answer` for backends that use them, otherwise None
+        """
+        self.save(answer_group, {question:value})
+
+    def count(self, answer_group):
+        """Returns the number of answers in the group."""
+        return len(self.values(answer_group))
+
+    def has_answers(self, survey_version):
+        """Returns True if any of the version's groups has an answer."""
+        raise NotImplementedError()
+
+    def prepare_group(self, answer_group, values):
+        """Called with an unsaved group before it is bulk created.
+
+        :param values:
+            list of ``(question_id, storage_key, value)``
+        """
+        pass
+
+    def build_answers(self, answer_group, values):
+        """Returns unsaved :class:`Answer` objects to bulk create for a group
+        after it has been saved, see :func:`prepare_group` for ``values``."""
+        return []
+
+
+class RowStorage(AnswerStorage):
+    """One :class:`Answer` row per answered question, with the value in the
+    column for the field's ``storage_key``."""
+    name = 'rows'
+
+    def values(self, answer_group):
+        answers = answer_group.answer_set.select_related('question')
+        return {answer.question_id:answer.value for answer in answers}
+
+    def values_many(self, answer_groups):
+        # one query for all the groups, the column holding each value comes
+        # from the question's field
+        using = answer_groups[0]._state.db
+        version = answer_groups[0].survey_version
+        keys = {rule.question.id:rule.storage_key for rule in
+            version.validation_plan().rules}
+        columns = ('answer_text', 'answer_key', 'answer_int', 'answer_float')
+
+        values = {group.id:{} for group in answer_groups}
+        rows = Answer.objects.using(using).filter(
+            answer_group__in=answer_groups).values_list('answer_group_id',
+            'question_id', *columns)
+        for row in rows:
+            key = keys.get(row[1])
+            if key:
+                values[row[0]][row[1]] = row[2 + columns.index(key)]
+
+        return values
+
+    def save(self, answer_group, values):
+        for question, value in values.items():
+            if value is None:
+                answers = Answer.objects.using(answer_group._state.db).filter(
+                    question=question, answer_group=answer_group)
+                cleared = list(answers.values_list('id', 'question_id'))
+                if cleared:
+                    # so incremental exports see the answer went away
+                    Tombstone.for_answers(answer_group, cleared)
+                    answers.delete()
+            else:
+                Answer.store(question, answer_group, value)
+
+    def store(self, answer_group, question, value):
+        if value is None:
+            self.save(answer_group, {question:value})
+            return None
+
+        return Answer.store(question, answer_group, value)
+
+    def count(self, answer_group):
+        return Answer.objects.using(answer_group._state.db).filter(
+            answer_group=answer_group).count()
+
+    def has_answers(self, survey_version):
+        return Answer.objects.using(survey_version.answer_database).filter(
+            answer_group__survey_version=survey_version).exists()
+
+    def build_answers(self, answer_group, values):
+        answers = []
+        for question_id, storage_key, value in values:
+            answer = Answer(answer_group_id=answer_group.id,
+                question_id=question_id)
+            setattr(answer, storage_key, value)
+            answers.append(answer)
+
+        return answers
+
+
+class DocumentStorage(AnswerStorage):
+    """All of a group's answers in its ``document`` field, a JSON object
+    mapping question ids to values.  A submission is a single row write no
+    matter how many questions the survey has.  The value types are those of
+    the fields' ``storage_key`` columns."""
+    name = 'document'
+
+    def values(self, answer_group):
+        return {int(key):value for key, value in
+            answer_group.document.items()}
+
+    def save(self, answer_group, values):
+        using = answer_group._state.db
+        with transaction.atomic(using=using):
+            # lock the row so concurrent saves to the group don't overwrite
+            # each other's answers
+            locked = AnswerGroup.objects.using(using).select_for_update(
+                ).only('document').filter(id=answer_group.id).first()
+            document = dict((locked or answer_group).document)
+            for question, value in values.items():
+                if value is None:
+                    document.pop(str(question.id), None)
+                else:
+                    document[str(question.id)] = value
+
+            answer_group.document = document
+            answer_group.save()
+
+    def has_answers(self, survey_version):
+        return survey_version.answer_groups().exclude(document={}).exists()
+
+    def prepare_group(self, answer_group, values):
+        answer_group.document = {str(question_id):value for question_id, _,
+            value in values}
+
+
+BACKENDS = {
+    RowStorage.name:RowStorage(),
+    DocumentStorage.name:DocumentStorage(),
+}
+
+def get_storage(name):
+    """Returns the backend instance for a ``Survey.answer_storage`` value."""
+    return BACKENDS[name]
+
+# ============================================================================
+# Conversion
+# ============================================================================
+
+def _rows_to_documents(groups):
+    using = groups[0]._state.db
+    by_id = {group.id:group for group in groups}
+    documents = {group.id:{} for group in groups}
+    answers = list(Answer.objects.using(using).filter(
+        answer_group__in=groups).select_related('question'))
+    for answer in answers:
+        documents[answer.answer_group_id][str(answer.question_id)] = \
+            answer.value
+
+    # saving moves "updated" on, so incremental exports pick the groups up
+    for group in groups:
+        group.document.update(documents[group.id])
+        group.save()
+
+    # and the answer rows show up as deleted
+    Tombstone.objects.using(using).bulk_create([Tombstone(
+        model_name='answer', object_id=answer.id,
+        survey_version_id=by_id[answer.answer_group_id].survey_version_id,
+        answer_group_id=answer.answer_group_id,
+        question_id=answer.question_id) for answer in answers],
+        batch_size=1000)
+    Answer.objects.using(using).filter(answer_group__in=groups).delete()
+
+
+def _documents_to_rows(groups, storage_keys):
+    using = groups[0]._state.db
+    answers = []
+    for group in groups:
+        for question_id, value in group.document.items():
+            answer = Answer(answer_group_id=group.id,
+                question_id=int(question_id))
+            setattr(answer, storage_keys[int(question_id)], value)
+            answers.append(answer)
+
+    Answer.objects.using(using).bulk_create(answers, batch_size=1000)
+    AnswerGroup.objects.using(using).filter(id__in=[group.id for group in
+        groups]).update(document={}, updated=timezone.now())
+
+
+def _convert_groups(survey, to, batch_size, progress):
+    storage_keys = {}
+    count = 0
+    for version in survey.surveyversion_set.order_by('id'):
+        for question in version.questions():
+            storage_keys[question.id] = question.field.storage_key
+
+        groups = version.answer_groups().order_by('id')
+        if to == RowStorage.name:
+            groups = groups.exclude(document={})
+        else:
+            groups = groups.filter(answer__isnull=False).distinct()
+
+        last_id = 0
+        while True:
+            batch = list(groups.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+
+            with transaction.atomic(using=batch[0]._state.db):
+                if to == DocumentStorage.name:
+                    _rows_to_documents(batch)
+                else:
+                    _documents_to_rows(batch, storage_keys)
+
+            last_id = batch[-1].id
+            count += len(batch)
+            if progress:
+                progress(count)
+
+    return count
+
+
+def convert_survey(survey, to, batch_size=500, progress=None):
+    """Moves all of a survey's answers to another storage backend and
+    switches the survey over to it.  Groups are converted in batches, each in
+    its own transaction; anything written in the old format while the first
+    pass runs is picked up by a second pass after the switch.
+
+    :param to:
+        name of the backend, ``rows`` or ``document``
+    :param progress:
+        optional callable, called with the number of groups converted so far
+        after each batch
+    :returns:
+        number of groups converted
+    """
+    if to not in BACKENDS:
+        raise ValueError('Unknown answer storage "%s"' % to)
+
+    count = _convert_groups(survey, to, batch_size, progress)
+    if survey.answer_storage != to:
+        Survey.objects.filter(id=survey.id).update(answer_storage=to)
+        survey.answer_storage = to
+        count += _convert_groups(survey, to, batch_size, progress)
+
+    return count
@@ -1,9 +1,20 @@
-import json, re
+import json, os, random, re, shutil, subprocess, sys, tempfile, threading, time
 from collections import OrderedDict
+from django.contrib.auth.models import User, Group
+from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
+from django.core.cache import caches
+from django.core.management import call_command, CommandError
 from django.core.urlresolvers import reverse, NoReverseMatch
-from django.test import TestCase, override_settings
+from django.db import connections, DatabaseError
+from django.http import HttpResponse
+from django.test import (TestCase, SimpleTestCase, RequestFactory,
+    override_settings)
+from django.test.utils import CaptureQueriesContext
 from mock import patch
+from six import StringIO
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import parse_qs
 
 from awl.utils import refetch
 from awl.waelsteng import AdminToolsMixin
@@ -11,11 +22,25 @@ from wrench.utils import parse_link
 
 from dform.admin import (SurveyAdmin, SurveyVersionAdmin, QuestionAdmin,
     QuestionOrderAdmin, AnswerAdmin, AnswerGroupAdmin)
+from dform.admission import over_limit, ConcurrencySlot
 from dform.models import (Survey, SurveyVersion, EditNotAllowedException, 
-    Question, QuestionOrder, Answer, AnswerGroup)
+    EditConflictException, DuplicateSubmissionException, Question, QuestionOrder, Answer,
+    AnswerGroup, Tombstone, prefetch_group_data)
+from dform.export import export_changes, ExportCursorError
 from dform.fields import (Text, MultiText, Dropdown, Radio, Checkboxes,
     Rating, Integer, Float)
 from dform.forms import SurveyForm
+from dform.importer import (import_answers, AnswerImporter,
+    AnswerImportError)
+from dform.metrics import REGISTRY
+from dform.results import ResultsTable
+from dform.queries import (QueryCounter, QueryTimer, QueryBudgetMixin,
+    fingerprint)
+from dform import events, journal, recaptcha, results, routers
+from dform.transfer import (SurveyImportError, clone_survey,
+    create_survey as create_from_record, export_surveys, read_surveys)
+from dform.sampledata import (AnswerGenerator, field_for_index,
+    random_field_parms, form_value)
 
 # ============================================================================
 
@@ -40,6 +65,12 @@ def edit_hook(form):
     call_back_flag = 'edit_hook'
 
 
+traces = []
+
+def trace_sink(data):
+    traces.append(data)
+
+
 def create_survey():
     # Creates and returns a survey and its questions
     survey = Survey.factory(name='survey', success_redirect='http://localhost/')
@@ -63,6 +94,29 @@ def create_survey():
 
     return survey, fields
 
+
+def create_sized_survey(num_questions, seed=1):
+    # Creates a survey with the given number of questions cycling through all
+    # of the field types
+    rng = random.Random(seed)
+    survey = Survey.factory(name='sized', success_redirect='/done/')
+    for index in range(num_questions):
+        field = field_for_index(index)
+        survey.add_question(field, 'question %s' % index,
+            field_parms=random_field_parms(rng, field))
+
+    return survey
+
+
+def answer_survey(survey, seed=1):
+    # Answers every question in the survey, returns the AnswerGroup
+    generator = AnswerGenerator(random.Random(seed), answer_rate=1)
+    group = AnswerGroup.factory(survey_version=survey.latest_version)
+    for question in survey.questions():
+        survey.answer_question(question, group, generator.value(question))
+
+    return group
+
 # ============================================================================
 # Test Objects
 # ============================================================================
@@ -305,6 +359,69 @@ class SurveyTests(TestCase):
         with self.assertRaises(EditNotAllowedException):
             survey.replace_from_dict(delta)
 
+    def test_edit_revisions(self):
+        survey, fields = create_survey()
+        version = survey.latest_version
+        base = refetch(version).revision
+        self.assertEqual(base, version.revision)
+
+        # checked edits only apply against the current revision
+        question = survey.add_question(Text, 'checked', revision=base)
+        self.assertEqual(base + 1, refetch(version).revision)
+
+        with self.assertRaises(EditConflictException) as ar:
+            version.remove_question(question, revision=base)
+
+        self.assertEqual(base + 1, ar.exception.revision)
+        self.assertIn(question, version.questions())
+
+        version.remove_question(question, revision=base + 1)
+        self.assertNotIn(question, version.questions())
+        self.assertEqual(base + 2, version.revision)
+
+        # unchecked edits always apply and still move the revision on
+        version.add_question(Text, 'unchecked')
+        self.assertEqual(base + 3, refetch(version).revision)
+
+        # stale and invalid full saves change nothing
+        data = version.to_dict()
+        data['name'] = 'renamed'
+        data['base_revision'] = base
+        with self.assertRaises(EditConflictException):
+            version.replace_from_dict(data)
+
+        data['questions'][0]['text'] = 'edited'
+        data['base_revision'] = base + 3
+        data['name'] = ''
+        with self.assertRaises(ValidationError):
+            version.replace_from_dict(data)
+
+        version = refetch(version)
+        self.assertEqual(base + 3, version.revision)
+        self.assertEqual('survey', version.survey.name)
+
+        data['name'] = 'renamed'
+        version.replace_from_dict(data)
+        self.assertEqual(base + 4, refetch(version).revision)
+        self.assertEqual('edited', version.questions()[0].text)
+
+        # an answer arriving during an edit undoes the edit
+        count = Question.objects.count()
+        original = SurveyVersion._add_question
+
+        def answered_during(version, *args):
+            question = original(version, *args)
+            group = AnswerGroup.factory(survey_version=version)
+            version.answer_question(fields['text'], group, 'mid edit')
+            return question
+
+        with patch.object(SurveyVersion, '_add_question', answered_during):
+            with self.assertRaises(EditNotAllowedException):
+                version.add_question(Text, 'half edited')
+
+        self.assertEqual(count, Question.objects.count())
+        self.assertEqual(base + 4, refetch(version).revision)
+
     def test_on_success(self):
         survey = Survey.factory(name='test')
         version = survey.latest_version
@@ -704,12 +821,229 @@ class AdminTestCase(TestCase, AdminToolsMixin):
         url, text = parse_link(html)
         self.assertEqual('2 Answers', text)
 
+    @override_settings(DFORM_ADMIN_COUNT_LIMIT=3)
+    def test_large_table_changelists(self):
+        self.initiate()
+
+        survey = Survey.factory(name='survey')
+        q1 = survey.add_question(Text, '1st question')
+        survey.add_question(Text, '2nd question')
+        for i in range(5):
+            ag = AnswerGroup.factory(survey_version=survey.latest_version)
+            survey.answer_question(q1, ag, 'answer %s' % i)
+
+        # counts come back annotated on the change list rows, count is
+        # limited by the setting
+        with patch.object(AnswerGroupAdmin, 'list_per_page', 2):
+            response = self.authed_get('/admin/dform/answergroup/')
+
+        cl = response.context['cl']
+        self.assertEqual(3, cl.result_count)
+        rows = list(cl.result_list)
+        self.assertEqual(2, len(rows))
+        for row in rows:
+            self.assertEqual(1, row.num_answers)
+            self.assertEqual(2, row.num_questions)
+
+        html = self.field_value(cl.model_admin, rows[0], 'show_answers')
+        url, text = parse_link(html)
+        self.assertEqual('1 Answer', text)
+
+        # follow the keyset link to the older rows
+        keyset_url = response.context['keyset_url']
+        self.assertIn('id__lt=%s' % rows[1].id, keyset_url)
+
+        with patch.object(AnswerGroupAdmin, 'list_per_page', 2):
+            response = self.authed_get('/admin/dform/answergroup/' +
+                keyset_url)
+
+        older = list(response.context['cl'].result_list)
+        self.assertEqual(rows[1].id - 1, older[0].id)
+
+        # answer change list
+        response = self.authed_get('/admin/dform/answer/')
+        self.assertEqual(3, response.context['cl'].result_count)
+        self.assertNotIn('keyset_url', response.context)
+
+    def test_prefetch_group_data(self):
+        self.initiate()
+        survey = Survey.factory(name='survey')
+        version = survey.latest_version
+        users = [User.objects.create(username='user%s' % i) for i in
+            range(4)]
+        group = Group.objects.create(name='staff')
+
+        for user in users:
+            AnswerGroup.factory(version, group_data=user)
+        AnswerGroup.factory(version, group_data=group)
+        AnswerGroup.factory(version)
+        missing = AnswerGroup.factory(version, group_data=users[0])
+        AnswerGroup.objects.filter(id=missing.id).update(object_id=0)
+
+        # content types are cached after first use
+        for model in (User, Group):
+            ContentType.objects.get_for_model(model)
+
+        # one query for the groups, one per content type
+        with self.assertNumQueries(3):
+            groups = prefetch_group_data(AnswerGroup.objects.order_by('id'),
+                only={User:['username']})
+
+        # objects that no longer exist are looked for again on access
+        with self.assertNumQueries(0):
+            data = [answer_group.group_data for answer_group in groups[:-1]]
+            for answer_group in groups[:-1]:
+                str(answer_group)
+
+        self.assertEqual(users + [group, None], data)
+        self.assertIsNone(groups[-1].group_data)
+        self.assertIn('email', data[0].get_deferred_fields())
+        self.assertEqual(set(), data[4].get_deferred_fields())
+
+        # change list rows come back with their group_data loaded
+        with patch.object(AnswerGroupAdmin, 'group_data_only',
+                {'auth.user':['username']}):
+            response = self.authed_get('/admin/dform/answergroup/')
+
+        rows = list(response.context['cl'].result_list)
+        self.assertEqual(7, len(rows))
+        cache_attr = AnswerGroup.group_data.cache_attr
+        for row in rows:
+            self.assertTrue(hasattr(row, cache_attr))
+
+        self.assertIn('user3', response.content.decode('utf-8'))
+
 
 # ============================================================================
 # Test Views
 # ============================================================================
 
 class SurveyAdminViewTests(TestCase, AdminToolsMixin):
+    def test_patched_survey_submission(self):
+        self.initiate()
+
+        # a survey started in the editor and saved with a patch can be
+        # submitted
+        self.authed_get('/dform_admin/survey_editor/0/')
+        version = SurveyVersion.objects.order_by('-id').first()
+        self.assertEqual('', version.survey.success_redirect)
+
+        patch = {
+            'base_revision':version.revision,
+            'survey':{},
+            'operations':[{'op':'add', 'ref':'new-1',
+                'field_key':Text.field_key, 'text':'why?'}],
+        }
+        response = self.authed_post(reverse('dform-survey-delta', args=(
+            version.id, )), {'delta':json.dumps(patch)})
+        question_id = json.loads(response.content.decode('utf-8'))['added'][
+            'new-1']
+        version = refetch(version)
+        self.assertEqual('/', version.survey.success_redirect)
+
+        self.client.logout()
+        response = self.client.post(reverse('dform-survey', args=(
+            version.id, version.survey.token)), {'q_%s' % question_id:'yes'})
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(1, AnswerGroup.objects.filter(
+            survey_version=version).count())
+
+    def test_survey_patch_view(self):
+        self.initiate()
+        survey, fields = create_survey()
+        version = survey.latest_version
+        url = reverse('dform-survey-delta', args=(version.id,))
+        ids = [q.id for q in fields.values()]
+
+        # building the survey moved the revision on
+        base = version.revision
+        self.assertEqual(len(fields), base)
+
+        def post(patch, response_code=200):
+            response = self.authed_post(url, {'delta':json.dumps(patch)},
+                response_code=response_code)
+            return json.loads(response.content.decode('utf-8'))
+
+        # only the named rows are written
+        patch = {
+            'base_revision':base,
+            'survey':{'name':'renamed'},
+            'operations':[
+                {'op':'remove', 'id':fields['radio'].id},
+                {'op':'update', 'id':fields['text'].id, 'text':'fixed'},
+                {'op':'add', 'ref':'new-1', 'field_key':Text.field_key,
+                    'text':'added', 'required':True},
+                {'op':'add', 'ref':'new-2', 'field_key':Integer.field_key,
+                    'text':'first', 'before':fields['multitext'].id},
+                {'op':'move', 'id':fields['float'].id, 'before':'new-2'},
+            ],
+        }
+        result = post(patch)
+
+        self.assertTrue(result['success'])
+        self.assertEqual(base + 1, result['revision'])
+        added = result['added']
+
+        version = refetch(version)
+        self.assertEqual(base + 1, version.revision)
+        self.assertEqual('renamed', version.survey.name)
+        self.assertEqual('http://localhost/', version.survey.success_redirect)
+        questions = version.questions()
+        expected = [fields['float'].id, added['new-2']] + [id for id in ids
+            if id not in (fields['radio'].id, fields['float'].id)] + [
+            added['new-1']]
+        self.assertEqual(expected, [q.id for q in questions])
+        self.assertEqual('fixed', refetch(fields['text']).text)
+        self.assertEqual(True, questions[-1].required)
+
+        # stale base revisions conflict and change nothing
+        patch = {
+            'base_revision':base,
+            'operations':[{'op':'remove', 'id':fields['text'].id}],
+        }
+        result = post(patch, response_code=409)
+        self.assertEqual({'success':False, 'conflict':True,
+            'revision':base + 1}, result)
+        self.assertEqual(expected, [q.id for q in version.questions()])
+
+        # full saves move the revision on too
+        version.replace_from_dict(version.to_dict())
+        self.assertEqual(base + 2, refetch(version).revision)
+
+        # invalid operations roll back
+        patch = {
+            'base_revision':base + 2,
+            'operations':[
+                {'op':'remove', 'id':fields['text'].id},
+                {'op':'update', 'id':fields['dropdown'].id,
+                    'field_parms':{}},
+            ],
+        }
+        result = post(patch)
+        self.assertFalse(result['success'])
+        self.assertIn('questions', result['errors'])
+        self.assertEqual(base + 2, refetch(version).revision)
+        self.assertEqual(expected, [q.id for q in version.questions()])
+
+        patch['operations'] = [{'op':'remove', 'id':0}]
+        self.authed_post(url, {'delta':json.dumps(patch)}, response_code=404)
+        patch['operations'] = [{'op':'rename'}]
+        self.assertFalse(post(patch)['success'])
+
+        # patches need an integer base revision, checked before claiming
+        patch['operations'] = [{'op':'remove', 'id':fields['text'].id}]
+        for base_revision in (None, 'x', '%s' % (base + 2), 1.5, True):
+            patch['base_revision'] = base_revision
+            result = post(patch, response_code=400)
+            self.assertIn('base_revision', result['errors'])
+
+        del patch['base_revision']
+        post(patch, response_code=400)
+        with self.assertRaises(ValidationError):
+            version.apply_patch(patch)
+        self.assertEqual(base + 2, refetch(version).revision)
+        self.assertEqual(expected, [q.id for q in version.questions()])
+
     def test_survey_delta_view(self):
         self.initiate()
         self.maxDiff = None
@@ -1053,6 +1387,52 @@ class SurveyViewTests(TestCase):
         url_base = '/dform/embedded_survey_with_answers/%s/%s/%s/%s/'
         self._survey_with_answers(url_base, True, False)
 
+    def test_idempotent_submission(self):
+        survey, fields = self._data_gen()
+        version = survey.latest_version
+        url = reverse('dform-survey', args=(version.id, survey.token))
+
+        # the form carries a new key
+        response = self.client.get(url)
+        key = response.context['form'].idempotency_key
+        self.assertIn('value="%s"' % key, response.content.decode('utf-8'))
+        self.assertNotEqual(key, self.client.get(url).context[
+            'form'].idempotency_key)
+
+        data = {
+            'q_%s' % fields['text'].id:'a',
+            'dform_idempotency_key':key,
+        }
+        response = self.client.post(url, data)
+        self.assertEqual(302, response.status_code)
+        group = AnswerGroup.objects.get()
+        self.assertEqual(key, group.idempotency_key)
+
+        # repeats are caught by the cache, then by the unique key
+        response = self.client.post(url, data)
+        self.assertEqual(302, response.status_code)
+        self.assertIn(survey.success_redirect, response['location'])
+        with self.settings(DFORM_IDEMPOTENCY_TIMEOUT=0):
+            response = self.client.post(url, data)
+            self.assertEqual(302, response.status_code)
+            self.assertIn(survey.success_redirect, response['location'])
+
+        self.assertEqual(1, AnswerGroup.objects.count())
+        self.assertEqual(1, Answer.objects.count())
+
+        # missing or malformed keys don't deduplicate
+        for value in ('', 'x'):
+            data['dform_idempotency_key'] = value
+            self.client.post(url, data)
+        self.assertEqual(3, AnswerGroup.objects.count())
+        self.assertEqual(2, AnswerGroup.objects.filter(
+            idempotency_key=None).count())
+
+        # a key is only used once per survey version
+        self.assertRaises(DuplicateSubmissionException, AnswerGroup.factory,
+            version, idempotency_key=key)
+        AnswerGroup.factory(survey.new_version(), idempotency_key=key)
+
 
 class FormTest(TestCase):
     def test_form(self):
@@ -1071,3 +1451,2177 @@ class FormTest(TestCase):
         form = SurveyForm(survey_version=survey.latest_version)
 
         self.assertTrue(form.has_required())
+
+    def test_check_values(self):
+        parms = OrderedDict([('a', 'Apple'), ('b', 'Bear')])
+        values = {
+            Text:['x', '', 'a'],
+            Dropdown:['a', 'b', 'c', 'a', '', 1, ['a']],
+            Checkboxes:['a', 'a,b', 'a,c', 'c', 'b,a', 1],
+            Integer:['1', '-3', '1.5', 'x', 2, 2.5, float('nan'), None],
+            Float:['1', '1.5', 'x', 'nan', 2, None],
+        }
+        def check(field, column):
+            mask = field.check_values(parms, column)
+
+            # same results as checking one at a time
+            expected = []
+            for value in column:
+                try:
+                    field.check_value(parms, value)
+                    expected.append(False)
+                except Exception:
+                    expected.append(True)
+
+            self.assertEqual(expected, mask, field.__name__)
+
+        for field, column in values.items():
+            check(field, column)
+
+        # columns of strings are checked with NumPy when it is installed,
+        # and in Python without it
+        strings = [u'1', u' -3 ', u'+4', u'--1', u'+-1', u'1.5', u'.5', u'x',
+            u'', u' ', u'1_000', u'\u0661\u0662', u'\xb2', u'nan', u'1e5',
+            u'1\x00', u'9' * 30, u'+.5', u'.', u'1.2.3', u'-', u'1 2',
+            u'5.']
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+
+        for field in (Integer, Float, Rating):
+            check(field, strings)
+            check(field, [u'1', u'22', u'-3'] * 1000)
+            with patch('dform.fields._numpy', return_value=None):
+                check(field, strings)
+
+            if numpy:
+                check(field, numpy.asarray(strings))
+
+        # large columns of a few distinct values
+        column = ['a', 'b'] * 50000 + ['c']
+        mask = Dropdown.check_values(parms, column)
+        self.assertEqual(len(column), len(mask))
+        self.assertEqual([len(column) - 1], [i for i, m in enumerate(mask)
+            if m])
+        self.assertFalse(any(Integer.check_values(parms,
+            [str(i) for i in range(1000)])))
+
+    def test_validation_plan(self):
+        survey, fields = create_survey()
+        version = survey.latest_version
+        fields['integer'].required = True
+        fields['integer'].save()
+
+        plan = version.validation_plan()
+        self.assertIs(plan, version.validation_plan())
+        self.assertEqual(len(fields), len(plan.rules))
+        self.assertEqual('q_%s' % fields['text'].id, plan.rules[1].name)
+        with self.assertRaises(AttributeError):
+            plan.rule(0)
+
+        # edits through the version recompile it
+        question = version.add_question(Text, 'new')
+        self.assertIsNot(plan, version.validation_plan())
+        plan = version.validation_plan()
+        self.assertEqual(question, plan.rule(question.id).question)
+
+        # plans are shared by the process until the questions change, also
+        # when they are changed outside the version, e.g. in the admin
+        self.assertIs(plan, refetch(version).validation_plan())
+        question.text = 'changed'
+        question.save()
+        fresh = refetch(version)
+        self.assertEqual(version.revision + 1, fresh.revision)
+        self.assertIsNot(plan, fresh.validation_plan())
+        self.assertEqual('changed', fresh.validation_plan().rule(
+            question.id).question.text)
+
+        # least recently used plans are dropped
+        with self.settings(DFORM_VALIDATION_PLAN_CACHE_SIZE=1):
+            Survey.factory(name='other').latest_version.validation_plan()
+            self.assertIsNot(fresh.validation_plan(),
+                refetch(fresh).validation_plan())
+
+        # JSON style submission
+        values, errors = plan.validate({
+            fields['checkboxes'].id:['e', 'f'],
+            'q_%s' % fields['float'].id:'1.5',
+            str(fields['radio'].id):'',
+            'q_%s' % fields['dropdown'].id:'z',
+            'q_0':'x',
+        })
+        self.assertEqual({
+            fields['checkboxes'].id:'e,f',
+            fields['float'].id:1.5,
+        }, values)
+        self.assertEqual({
+            'q_%s' % fields['dropdown'].id:'value was not in available '
+                'choices',
+            'q_0':'Unknown question',
+            'q_%s' % fields['integer'].id:'This field is required.',
+        }, errors)
+
+        # answering reuses the compiled plan, no per answer lookups of the
+        # question
+        group = AnswerGroup.factory(survey_version=version)
+        with QueryCounter() as counter:
+            version.answer_question(fields['rating'], group, '4')
+        self.assertEqual(2, counter.count)
+        self.assertEqual(4, group.answer_set.get().answer_int)
+        with self.assertRaises(ValidationError):
+            version.answer_question(fields['checkboxes'], group, 'e,x')
+
+    def test_document_storage(self):
+        survey, fields = create_survey()
+        survey.answer_storage = 'document'
+        survey.save()
+        version = survey.latest_version
+        self.assertTrue(version.is_editable())
+
+        # whole submission is one document on the group
+        form = SurveyForm({
+            'q_%s' % fields['text'].id:'words',
+            'q_%s' % fields['checkboxes'].id:['e', 'f'],
+            'q_%s' % fields['integer'].id:'3',
+        }, survey_version=version)
+        self.assertTrue(form.is_valid())
+        form.save()
+        group = refetch(form.answer_group)
+
+        self.assertEqual(0, Answer.objects.count())
+        expected = {
+            fields['text'].id:'words',
+            fields['checkboxes'].id:'e,f',
+            fields['integer'].id:3,
+        }
+        self.assertEqual(expected, group.answer_values())
+        self.assertFalse(version.is_editable())
+        with self.assertRaises(EditNotAllowedException):
+            version.validate_editable()
+
+        # edits
+        form = SurveyForm(survey_version=version, answer_group=group)
+        self.assertEqual(3, form['q_%s' % fields['integer'].id].value())
+
+        form = SurveyForm({'q_%s' % fields['integer'].id:'4'},
+            survey_version=version, answer_group=group)
+        self.assertTrue(form.is_valid())
+        form.save()
+        self.assertEqual({fields['integer'].id:4},
+            refetch(group).answer_values())
+
+        # saves through a stale copy of the group keep the other answers
+        stale = refetch(group)
+        self.assertEqual(None, version.answer_question(fields['float'], group,
+            '1.5'))
+        version.answer_question(fields['text'], stale, 'stale')
+        self.assertEqual({fields['integer'].id:4, fields['float'].id:1.5,
+            fields['text'].id:'stale'}, refetch(group).answer_values())
+        version.answer_question(fields['text'], group, None)
+        self.assertEqual({fields['integer'].id:4, fields['float'].id:1.5},
+            refetch(group).answer_values())
+
+        group_admin = AnswerGroupAdmin(AnswerGroup, None)
+        self.assertEqual('2 Answers', group_admin.show_answers(refetch(group)))
+
+        # imports
+        importer = AnswerImporter(version)
+        importer.run([(1, {'q_%s' % fields['rating'].id:'2'})])
+        self.assertEqual(0, Answer.objects.count())
+        imported = AnswerGroup.objects.get(id__gt=group.id)
+        self.assertEqual({fields['rating'].id:2}, imported.answer_values())
+
+        # converting to rows and back, changes show up in exports
+        updated = refetch(group).updated
+        out = StringIO()
+        call_command('dform_convert_storage', survey.id, 'rows', stdout=out)
+        self.assertLess(updated, refetch(group).updated)
+        self.assertIn('Converted 2 AnswerGroups', out.getvalue())
+        survey = refetch(survey)
+        self.assertEqual('rows', survey.answer_storage)
+        self.assertEqual(3, Answer.objects.count())
+        group = refetch(group)
+        self.assertEqual({}, group.document)
+        self.assertEqual({fields['integer'].id:4, fields['float'].id:1.5},
+            group.answer_values())
+
+        answer_ids = set(Answer.objects.values_list('id', flat=True))
+        updated = refetch(group).updated
+        call_command('dform_convert_storage', survey.id, 'document',
+            batch_size=1, stdout=StringIO())
+        self.assertEqual('document', refetch(survey).answer_storage)
+        self.assertEqual(0, Answer.objects.count())
+        self.assertLess(updated, refetch(group).updated)
+        self.assertEqual(answer_ids, set(Tombstone.objects.filter(
+            model_name='answer').values_list('object_id', flat=True)))
+        self.assertEqual({fields['integer'].id:4, fields['float'].id:1.5},
+            refetch(group).answer_values())
+        self.assertEqual({fields['rating'].id:2},
+            refetch(imported).answer_values())
+
+        with self.assertRaises(CommandError):
+            call_command('dform_convert_storage', 0, 'rows',
+                stdout=StringIO())
+
+
+class QueryBudgetTests(TestCase, QueryBudgetMixin, AdminToolsMixin):
+    def test_fingerprint(self):
+        sql1 = ('SELECT "a"."id" FROM "a" WHERE "a"."id" IN (1, 2, 3) AND '
+            '"a"."name" = \'it\'\'s\' LIMIT 21')
+        sql2 = ('SELECT "a"."id"   FROM "a" WHERE "a"."id" IN (7) AND '
+            '"a"."name" = \'x\' LIMIT 21')
+        expected = ('SELECT "a"."id" FROM "a" WHERE "a"."id" IN (...) AND '
+            '"a"."name" = ? LIMIT ?')
+        self.assertEqual(expected, fingerprint(sql1))
+        self.assertEqual(expected, fingerprint(sql2))
+
+        with QueryCounter() as counter:
+            Survey.objects.filter(id=1).count()
+            Survey.objects.filter(id=2).count()
+
+        self.assertEqual(2, counter.count)
+        self.assertEqual(1, len(counter.fingerprints()))
+        self.assertIn('queries=2', counter.summary())
+        self.assertIn('2x SELECT COUNT(*)', counter.summary())
+        self.assertIn('2x SELECT COUNT(*)', counter.report())
+
+        # only the given aliases are watched, without debug cursors
+        with QueryCounter(['default']) as counter:
+            self.assertFalse(connections['default'].queries_logged)
+            Survey.objects.count()
+            connections['shard'].cursor().execute('SELECT 1')
+        self.assertEqual(['default'], [q['alias'] for q in counter.queries])
+
+        # decorator form
+        @QueryCounter()
+        def count_surveys():
+            return Survey.objects.count()
+
+        count_surveys()
+        self.assertEqual(1, count_surveys.counter.count)
+
+        # budget and scaling failures
+        with self.assertRaises(AssertionError):
+            self.assertQueryBudget(0, count_surveys)
+        self.assertQueryBudget(1, count_surveys)
+
+        def setup(size):
+            return size
+
+        def scaling(size):
+            for index in range(size):
+                Survey.objects.filter(id=index).count()
+
+        self.assertQueryScaling(setup, scaling, per_item=1)
+        with self.assertRaises(AssertionError):
+            self.assertQueryScaling(setup, scaling)
+
+    def test_survey_views(self):
+        self.initiate()
+
+        def setup(size):
+            survey = create_sized_survey(size)
+            version = survey.latest_version
+            return {
+                'survey':survey,
+                'version':version,
+                'url':reverse('dform-survey', args=(version.id,
+                    survey.token)),
+            }
+
+        def get(context):
+            response = self.client.get(context['url'])
+            self.assertEqual(200, response.status_code)
+
+        self.assertQueryScaling(setup, get)
+
+        def sample(context):
+            self.client.get(reverse('dform-sample-survey', args=(
+                context['version'].id, )))
+
+        self.assertQueryScaling(setup, sample)
+
+        def editor(context):
+            self.authed_get('/dform_admin/survey_editor/%s/' % (
+                context['version'].id))
+
+        self.assertQueryScaling(setup, editor)
+
+        # submissions write one answer per question
+        def setup_post(size):
+            context = setup(size)
+            generator = AnswerGenerator(random.Random(1), answer_rate=1)
+            context['data'] = {'q_%s' % q.id:form_value(q,
+                generator.value(q)) for q in context['survey'].questions()}
+            return context
+
+        def post(context):
+            response = self.client.post(context['url'], context['data'])
+            self.assertEqual(302, response.status_code)
+
+        self.assertQueryScaling(setup_post, post, per_item=3)
+
+        # viewing a survey with answers
+        def setup_answers(size):
+            survey = create_sized_survey(size)
+            group = answer_survey(survey)
+            return reverse('dform-survey-with-answers', args=(
+                survey.latest_version.id, survey.token, group.id,
+                group.token))
+
+        def get_answers(url):
+            response = self.client.get(url)
+            self.assertEqual(200, response.status_code)
+
+        self.assertQueryScaling(setup_answers, get_answers)
+
+        # editor patches cost the same however big the survey is
+        def setup_patch(size):
+            version = create_sized_survey(size).latest_version
+            questions = version.questions()
+            patch = {
+                'base_revision':version.revision,
+                'operations':[
+                    {'op':'update', 'id':questions[1].id, 'text':'typo'},
+                    {'op':'move', 'id':questions[-1].id,
+                        'before':questions[0].id},
+                ],
+            }
+            return {
+                'url':reverse('dform-survey-delta', args=(version.id, )),
+                'data':{'delta':json.dumps(patch)},
+            }
+
+        def save_patch(context):
+            self.authed_post(context['url'], context['data'])
+
+        self.assertQueryScaling(setup_patch, save_patch)
+
+    @override_settings(DFORM_RESULTS_TABLES=True)
+    def test_deletes(self):
+        # deleting answers costs the same however many groups there are,
+        # tombstones and results rows are written in bulk
+        results._ready.clear()
+
+        def setup(size):
+            survey = create_sized_survey(3)
+            with patch('dform.results.logger'):
+                for _ in range(size):
+                    answer_survey(survey)
+
+            ResultsTable(survey.latest_version).rebuild()
+            return survey
+
+        def delete_groups(survey):
+            survey.latest_version.answer_groups().delete()
+
+        self.assertQueryScaling(setup, delete_groups)
+        self.assertEqual(12, Tombstone.objects.filter(
+            model_name='answergroup').count())
+        self.assertEqual(0, AnswerGroup.objects.count())
+        with connections['default'].cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM %s' % ResultsTable(
+                Survey.objects.last().latest_version).name)
+            self.assertEqual(0, cursor.fetchone()[0])
+
+        def delete_survey(survey):
+            survey.delete()
+
+        self.assertQueryScaling(setup, delete_survey)
+        self.assertEqual(24, Tombstone.objects.filter(
+            model_name='answergroup').count())
+
+    def test_admin_columns(self):
+        self.initiate()
+
+        def setup(size):
+            survey = create_sized_survey(3)
+            for _ in range(size):
+                answer_survey(survey)
+
+        def changelist(name):
+            def fn(context):
+                self.authed_get('/admin/dform/%s/' % name)
+            return fn
+
+        self.assertQueryScaling(setup, changelist('answergroup'))
+        self.assertQueryScaling(setup, changelist('answer'))
+
+    @override_settings(DFORM_QUERY_LOG_SAMPLE_RATE=1.0)
+    def test_sampled_logging(self):
+        survey = create_sized_survey(3)
+        url = reverse('dform-survey', args=(survey.latest_version.id,
+            survey.token))
+
+        with patch('dform.queries.logger') as mock_logger:
+            self.client.get(url)
+            self.assertTrue(mock_logger.info.called)
+            args = mock_logger.info.call_args[0]
+            self.assertEqual('survey', args[1])
+            self.assertIn('queries=', args[2])
+
+        with patch('dform.queries.dform_databases', return_value=['shard']):
+            with patch('dform.queries.logger') as mock_logger:
+                self.client.get(url)
+                self.assertIn('queries=0 ', mock_logger.info.call_args[0][2])
+
+        with self.settings(DFORM_QUERY_LOG_SAMPLE_RATE=0):
+            with patch('dform.queries.logger') as mock_logger:
+                self.client.get(url)
+                self.assertFalse(mock_logger.info.called)
+
+# ============================================================================
+# Metrics
+# ============================================================================
+
+@override_settings(DFORM_METRICS=True)
+class MetricsTests(TestCase, AdminToolsMixin):
+    def setUp(self):
+        REGISTRY.reset()
+
+    def test_metrics(self):
+        self.initiate()
+        survey = create_sized_survey(3)
+        version = survey.latest_version
+        url = reverse('dform-survey', args=(version.id, survey.token))
+        generator = AnswerGenerator(random.Random(1), answer_rate=1)
+        data = {'q_%s' % q.id:form_value(q, generator.value(q)) for q in
+            survey.questions()}
+
+        self.client.get(url)
+        self.client.post(url, data)
+        with self.settings(DFORM_SUBMIT_HOOK='dform.tests.test_dform.'
+                'submit_hook'):
+            self.client.post(url, data)
+
+        text = self.authed_get('/dform_admin/metrics/').content.decode('utf-8')
+        label = '{survey="%s"}' % survey.id
+        self.assertIn('dform_survey_renders_total%s 1' % label, text)
+        self.assertIn('dform_survey_submissions_total%s 2' % label, text)
+        self.assertIn('dform_view_seconds_count{view="survey",survey="%s"} 3'
+            % survey.id, text)
+        self.assertIn('dform_view_seconds_bucket{view="survey",survey="%s",'
+            'le="+Inf"} 3' % survey.id, text)
+        self.assertIn('dform_hook_seconds_count{hook="DFORM_SUBMIT_HOOK",'
+            'survey="%s"} 1' % survey.id, text)
+        self.assertIn('dform_view_db_seconds_count{view="survey",survey="%s"} '
+            '3' % survey.id, text)
+
+        # database time is added up without capturing the queries
+        with QueryTimer(['default']) as timer:
+            self.assertFalse(connections['default'].queries_logged)
+            Survey.objects.count()
+            Survey.objects.count()
+            connections['shard'].cursor().execute('SELECT 1')
+        self.assertEqual(2, timer.count)
+        self.assertLess(0, timer.total_time)
+        self.assertNotIn('cursor', connections['default'].__dict__)
+
+        # scraper token, anonymous requests are sent to login
+        self.client.logout()
+        self.authed = False
+        response = self.client.get('/dform_admin/metrics/')
+        self.assertEqual(302, response.status_code)
+
+        with self.settings(DFORM_METRICS_TOKEN='secret'):
+            response = self.client.get('/dform_admin/metrics/',
+                HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(200, response.status_code)
+            self.assertIn('text/plain', response['Content-Type'])
+
+            response = self.client.get('/dform_admin/metrics/',
+                HTTP_AUTHORIZATION='Bearer wrong')
+            self.assertEqual(302, response.status_code)
+
+        # disabled
+        with self.settings(DFORM_METRICS=False):
+            self.authed_get('/dform_admin/metrics/', response_code=404)
+
+    def test_multiple_processes(self):
+        self.initiate()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        # snapshot from another worker process that has since exited
+        process = subprocess.Popen(['true'])
+        process.wait()
+        dead = os.path.join(directory, 'dform_metrics_%s_abc.json' %
+            process.pid)
+        other = [
+            ['dform_survey_renders_total', ['1'], 4],
+            ['dform_survey_renders_total', ['2'], 1],
+            ['unknown_metric', [], 12],
+        ]
+        with open(dead, 'w') as f:
+            json.dump(other, f)
+
+        # a running process with a reused pid doesn't overwrite it
+        live = os.path.join(directory, 'dform_metrics_%s_old.json' %
+            os.getpid())
+        with open(live, 'w') as f:
+            json.dump([['dform_survey_renders_total', ['1'], 3]], f)
+
+        # partially written files are ignored
+        with open(os.path.join(directory, 'dform_metrics_%s_x.json.tmp' %
+                os.getpid()), 'w') as f:
+            f.write('[[')
+
+        with self.settings(DFORM_METRICS_DIR=directory,
+                DFORM_METRICS_FLUSH_INTERVAL=0.01):
+            from dform import metrics
+            metrics.RENDERS.inc(survey=1)
+            metrics.RENDERS.inc(survey=1)
+
+            # the flush thread writes the snapshot without a scrape
+            mine = os.path.join(directory, 'dform_metrics_%s_%s.json' % (
+                os.getpid(), REGISTRY.token))
+            for _ in range(200):
+                if os.path.exists(mine):
+                    break
+                time.sleep(0.01)
+            self.assertTrue(os.path.exists(mine))
+
+            text = self.authed_get('/dform_admin/metrics/').content.decode(
+                'utf-8')
+            self.assertIn('dform_survey_renders_total{survey="1"} 9', text)
+            self.assertIn('dform_survey_renders_total{survey="2"} 1', text)
+            self.assertNotIn('unknown_metric', text)
+
+            # the exited process was folded into the archive
+            self.assertFalse(os.path.exists(dead))
+            self.assertTrue(os.path.exists(live))
+            self.assertTrue(os.path.exists(os.path.join(directory,
+                'dform_metrics_archive.json')))
+
+            # and its counts survive later scrapes, including the final
+            # flush of a process at exit
+            metrics.RENDERS.inc(survey=2)
+            REGISTRY.flush_changes()
+            self.assertFalse(REGISTRY.dirty)
+            os.remove(live)
+            text = self.authed_get('/dform_admin/metrics/').content.decode(
+                'utf-8')
+            self.assertIn('dform_survey_renders_total{survey="1"} 6', text)
+            self.assertIn('dform_survey_renders_total{survey="2"} 2', text)
+
+# ============================================================================
+# Profiling
+# ============================================================================
+
+class ProfilingTests(TestCase, AdminToolsMixin):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_profiling(self):
+        self.initiate()
+        survey = create_sized_survey(3)
+        version = survey.latest_version
+        url = reverse('dform-survey', args=(version.id, survey.token))
+
+        # not configured
+        self.authed_get('/dform_admin/profiles/', response_code=404)
+        with self.settings(DFORM_PROFILE_SAMPLE_RATE=1.0):
+            self.client.get(url)
+        self.assertEqual([], os.listdir(self.directory))
+
+        with self.settings(DFORM_PROFILE_DIR=self.directory):
+            # not sampled, header ignored for anonymous users
+            self.client.logout()
+            self.authed = False
+            self.client.get(url, HTTP_X_DFORM_PROFILE='1')
+            self.assertEqual([], os.listdir(self.directory))
+
+            # sampled
+            with self.settings(DFORM_PROFILE_SAMPLE_RATE=1.0):
+                self.client.get(url)
+
+            names = sorted(os.listdir(self.directory))
+            self.assertEqual(2, len(names))
+            self.assertTrue(names[0].endswith('_survey_%s_%s.json' % (
+                version.id, os.getpid())))
+
+            with open(os.path.join(self.directory, names[0])) as f:
+                info = json.load(f)
+            self.assertEqual('survey', info['view'])
+            self.assertEqual(version.id, info['survey_version'])
+            self.assertEqual(200, info['status_code'])
+            self.assertEqual(info['num_queries'], len(info['queries']))
+            self.assertTrue(info['num_queries'] > 0)
+
+            # staff header
+            self.authed_get('/dform_admin/survey_editor/%s/' % version.id,
+                headers={'HTTP_X_DFORM_PROFILE':'1'})
+            self.assertEqual(4, len(os.listdir(self.directory)))
+
+            # listing and download
+            response = self.authed_get('/dform_admin/profiles/')
+            profiles = response.context['profiles']
+            self.assertEqual(['survey_editor', 'survey'],
+                [p['view'] for p in profiles])
+            self.assertIn(profiles[1]['name'], response.content.decode(
+                'utf-8'))
+
+            response = self.authed_get('/dform_admin/profiles/%s.prof' % (
+                profiles[1]['name']))
+            self.assertIn('attachment', response['Content-Disposition'])
+            self.authed_get('/dform_admin/profiles/missing.prof',
+                response_code=404)
+            self.authed_get('/dform_admin/profiles/settings.py',
+                response_code=404)
+
+            # oldest are removed
+            with self.settings(DFORM_PROFILE_KEEP=1,
+                    DFORM_PROFILE_SAMPLE_RATE=1.0):
+                self.client.get(url)
+            self.assertEqual(2, len(os.listdir(self.directory)))
+
+# ============================================================================
+# Submission Tracing
+# ============================================================================
+
+@override_settings(DFORM_TRACE_SINK='dform.tests.test_dform.trace_sink')
+class TracingTests(TestCase):
+    def setUp(self):
+        del traces[:]
+
+    def test_tracing(self):
+        survey, fields = create_survey()
+        version = survey.latest_version
+        url = reverse('dform-survey', args=(version.id, survey.token))
+        data = {
+            'q_%s' % q.id:form_value(q, AnswerGenerator(random.Random(1),
+                answer_rate=1).value(q)) for q in survey.questions()
+        }
+
+        # off by default
+        self.client.post(url, data)
+        self.assertEqual([], traces)
+
+        with self.settings(DFORM_TRACE_THRESHOLD=0,
+                DFORM_SUBMIT_HOOK='dform.tests.test_dform.submit_hook'):
+            # GETs aren't traced
+            self.client.get(url)
+            self.assertEqual([], traces)
+
+            self.client.post(url, data)
+            self.assertEqual(1, len(traces))
+            trace = traces[0]
+            self.assertEqual('survey', trace['trace'])
+            self.assertEqual(version.id, trace['survey_version'])
+            self.assertEqual(302, trace['status_code'])
+            self.assertEqual(['populate_fields', 'check_value', 'validation',
+                'save', 'hook', 'on_success'], list(trace['spans'].keys()))
+            self.assertEqual(len(data), trace['spans']['check_value'][
+                'count'])
+            self.assertTrue(trace['total_ms'] >= trace['spans']['save']['ms'])
+
+            # failed validation renders the form again
+            self.client.post(url, {'q_%s' % fields['integer'].id:'x'})
+            self.assertEqual(['populate_fields', 'validation', 'render'],
+                list(traces[1]['spans'].keys()))
+            self.assertEqual(200, traces[1]['status_code'])
+
+            # editing answers
+            group = AnswerGroup.objects.first()
+            self.client.post(reverse('dform-survey-with-answers', args=(
+                version.id, survey.token, group.id, group.token)), data)
+            self.assertEqual('survey_with_answers', traces[2]['trace'])
+
+        # only slow submissions
+        with self.settings(DFORM_TRACE_THRESHOLD=60):
+            self.client.post(url, data)
+            self.assertEqual(3, len(traces))
+
+        # default sink logs a line of JSON
+        with self.settings(DFORM_TRACE_THRESHOLD=0, DFORM_TRACE_SINK=''):
+            with patch('dform.tracing.logger') as mock_logger:
+                self.client.post(url, data)
+                args = mock_logger.info.call_args[0]
+                self.assertEqual('survey', json.loads(args[1])['trace'])
+
+# ============================================================================
+# Database Routing
+# ============================================================================
+
+class RouterTests(SimpleTestCase):
+    def setUp(self):
+        routers.reset()
+        self.router = routers.DFormRouter()
+
+    def test_router(self):
+        # no replica configured
+        self.assertEqual('default', self.router.db_for_read(Survey))
+
+        with self.settings(DFORM_READ_DATABASE='replica'):
+            self.assertEqual('replica', self.router.db_for_read(Survey))
+            self.assertEqual('replica', self.router.db_for_read(Answer))
+            self.assertEqual(None, self.router.db_for_read(User))
+            self.assertEqual(None, self.router.db_for_write(User))
+            self.assertFalse(self.router.allow_migrate('replica', 'dform'))
+            self.assertEqual(None, self.router.allow_migrate('default',
+                'dform'))
+
+            # reading objects from the replica and writing them on the
+            # primary is allowed
+            survey = Survey(id=1)
+            survey._state.db = 'replica'
+            version = SurveyVersion(id=1)
+            version._state.db = 'default'
+            self.assertTrue(self.router.allow_relation(survey, version))
+
+            # explicitly on the primary
+            with routers.use_primary():
+                self.assertEqual('default', self.router.db_for_read(Survey))
+            self.assertEqual('replica', self.router.db_for_read(Survey))
+
+            @routers.primary_view
+            def view(request):
+                return self.router.db_for_read(Survey)
+
+            self.assertEqual('default', view(None))
+            self.assertEqual('replica', self.router.db_for_read(Survey))
+
+            # transactions stay on the primary
+            connection = connections['default']
+            connection.in_atomic_block = True
+            try:
+                self.assertEqual('default', self.router.db_for_read(Survey))
+            finally:
+                connection.in_atomic_block = False
+
+            # reads after a write stay on the primary for the request
+            self.assertEqual('default', self.router.db_for_write(Answer))
+            self.assertEqual('default', self.router.db_for_read(Survey))
+            routers.reset()
+            self.assertEqual('replica', self.router.db_for_read(Survey))
+
+            routers._request_started()
+            self.router.db_for_write(Answer)
+            with self.settings(DFORM_READ_YOUR_WRITES_SECONDS=0):
+                self.assertEqual('default', self.router.db_for_read(Survey))
+                routers._request_finished()
+                self.assertEqual('replica', self.router.db_for_read(Survey))
+
+                # outside of requests a write only pins for as long as a
+                # replica may lag, a scope pins until it ends
+                self.router.db_for_write(Answer)
+                self.assertEqual('replica', self.router.db_for_read(Survey))
+                with routers.scope():
+                    self.assertEqual('replica',
+                        self.router.db_for_read(Survey))
+                    self.router.db_for_write(Answer)
+                    self.assertEqual('default',
+                        self.router.db_for_read(Survey))
+
+                self.assertEqual('replica', self.router.db_for_read(Survey))
+
+            self.router.db_for_write(Answer)
+            self.assertEqual('default', self.router.db_for_read(Survey))
+            routers.reset()
+
+        with self.settings(DFORM_READ_DATABASE=['r1', 'r2']):
+            self.assertIn(self.router.db_for_read(Survey), ['r1', 'r2'])
+
+    @override_settings(DFORM_READ_DATABASE='replica',
+        DFORM_READ_YOUR_WRITES_SECONDS=5)
+    def test_read_your_writes(self):
+        factory = RequestFactory()
+        middleware = routers.ReadYourWritesMiddleware()
+
+        # plain reads use the replica and set no cookie
+        request = factory.get('/')
+        middleware.process_request(request)
+        self.assertEqual('replica', self.router.db_for_read(Survey))
+        response = middleware.process_response(request, HttpResponse())
+        self.assertNotIn(routers.COOKIE_NAME, response.cookies)
+
+        # a submission is on the primary and marks the client
+        request = factory.post('/')
+        middleware.process_request(request)
+        self.assertEqual('default', self.router.db_for_read(Survey))
+        response = middleware.process_response(request, HttpResponse())
+        cookie = response.cookies[routers.COOKIE_NAME]
+        self.assertEqual(5, cookie['max-age'])
+
+        # which keeps its next requests on the primary
+        request = factory.get('/')
+        request.COOKIES[routers.COOKIE_NAME] = '1'
+        middleware.process_request(request)
+        self.assertEqual('default', self.router.db_for_read(Survey))
+
+@override_settings(DATABASE_ROUTERS=['dform.routers.DFormRouter'],
+    DFORM_SHARDS=['shard'])
+class ShardTests(TestCase, AdminToolsMixin):
+    multi_db = True
+
+    def test_sharding(self):
+        self.initiate()
+        routers.reset()
+        survey = Survey.factory(name='sharded')
+        version = survey.latest_version
+        q1 = survey.add_question(Integer, 'How many?')
+        q2 = survey.add_question(Text, 'Why?')
+        other = Survey.factory(name='other')
+
+        with self.settings(DFORM_SHARD_MAP={survey.id:'shard'}):
+            self.assertEqual('shard', survey.answer_database)
+            self.assertEqual('shard', version.answer_database)
+            self.assertEqual(None, other.answer_database)
+
+            # form submissions and answer_question write to the shard
+            form = SurveyForm({'q_%s' % q1.id:'3', 'q_%s' % q2.id:'x'},
+                survey_version=version)
+            self.assertTrue(form.is_valid())
+            form.save()
+            group = form.answer_group
+            self.assertEqual('shard', group._state.db)
+
+            group2 = AnswerGroup.factory(version)
+            survey.answer_question(q1, group2, '4')
+
+            self.assertEqual(0, AnswerGroup.objects.count())
+            self.assertEqual(0, Answer.objects.count())
+            self.assertEqual(2, version.answer_groups().count())
+            self.assertEqual(3, Answer.objects.using('shard').count())
+            self.assertFalse(version.is_editable())
+
+            # related managers follow the group to its shard
+            self.assertEqual(2, group.answer_set.count())
+            router = routers.DFormRouter()
+            self.assertEqual('shard', router.db_for_read(Answer,
+                instance=group))
+            self.assertEqual('default', router.db_for_read(Question,
+                instance=group))
+            self.assertTrue(router.allow_relation(group, version))
+
+            # editing answers
+            form = SurveyForm({'q_%s' % q1.id:'5'}, survey_version=version,
+                answer_group=group)
+            self.assertTrue(form.is_valid())
+            form.save()
+            answers = Answer.objects.using('shard').filter(answer_group=group)
+            self.assertEqual([5], [a.answer_int for a in answers])
+
+            url = reverse('dform-survey-with-answers', args=(version.id,
+                survey.token, group.id, group.token))
+            self.authed_get(url)
+
+            # bulk imports
+            importer = AnswerImporter(version)
+            importer.run([(1, {'q_%s' % q1.id:'6'})])
+            self.assertEqual(3, version.answer_groups().count())
+            self.assertEqual(0, AnswerGroup.objects.count())
+
+            # admin
+            version_admin = SurveyVersionAdmin(SurveyVersion, self.site)
+            html = self.field_value(version_admin, version, 'show_answers')
+            self.assertIn('shard=shard', html)
+            self.assertIn('3 Answer Sets', html)
+
+            group_admin = AnswerGroupAdmin(AnswerGroup, self.site)
+            html = self.field_value(group_admin, group, 'show_answers')
+            self.assertIn('shard=shard', html)
+
+            url = reverse('admin:dform_answergroup_changelist')
+            response = self.authed_get(url + '?shard=shard')
+            self.assertEqual(3, len(response.context['cl'].result_list))
+            response = self.authed_get(url)
+            self.assertEqual(0, len(response.context['cl'].result_list))
+
+            url = reverse('admin:dform_answer_changelist')
+            response = self.authed_get(url + '?shard=shard')
+            self.assertEqual(3, len(response.context['cl'].result_list))
+
+            url = reverse('admin:dform_answergroup_change', args=(group.id,))
+            self.authed_get(url + '?shard=shard')
+            self.authed_get(url, response_code=404)
+
+            url = reverse('dform-answer-links', args=(group.id,))
+            self.authed_get(url + '?shard=shard')
+            self.authed_get(url, response_code=404)
+            self.authed_get(url + '?shard=nope', response_code=404)
+
+            # deleting a version removes its answers from the shard
+            version.delete()
+            self.assertEqual(0, AnswerGroup.objects.using('shard').count())
+            self.assertEqual(0, Answer.objects.using('shard').count())
+
+        # survey mapped to an unknown alias
+        with self.settings(DFORM_SHARD_MAP={other.id:'nope'}):
+            with self.assertRaises(ValueError):
+                other.answer_database
+
+        with self.settings(DFORM_SHARDS=['s0', 's1'],
+                DFORM_SHARD_MAP='dform.sharding.modulo_shard'):
+            self.assertEqual('s%s' % (other.id % 2), other.answer_database)
+
+
+# ============================================================================
+# Results Tables
+# ============================================================================
+
+@override_settings(DFORM_RESULTS_TABLES=True)
+class ResultsTests(TestCase):
+    def setUp(self):
+        # tables made by other tests were rolled back
+        results._ready.clear()
+
+    def results(self, version):
+        table = ResultsTable(version)
+        columns = ', '.join(['answer_group_id', 'token'] +
+            [rule.name for rule in table.plan.rules])
+        with connections['default'].cursor() as cursor:
+            cursor.execute('SELECT %s FROM %s ORDER BY answer_group_id' % (
+                columns, table.name))
+            return [tuple(row) for row in cursor.fetchall()]
+
+    def test_results_tables(self):
+        survey, fields = create_survey()
+        version = survey.latest_version
+        names = ['q_%s' % fields[key].id for key in ('checkboxes', 'rating',
+            'integer', 'float')]
+
+        # submissions skip a missing table instead of creating it
+        with patch('dform.results.logger') as logger:
+            form = SurveyForm({names[0]:['e', 'f'], names[2]:'3'},
+                survey_version=version)
+            self.assertTrue(form.is_valid())
+            form.save()
+            AnswerGroup.factory(survey_version=version).delete()
+
+        self.assertEqual(1, logger.warning.call_count)
+        self.assertFalse(ResultsTable(version).exists())
+        g1 = form.answer_group
+        self.assertEqual(g1, refetch(g1))
+
+        # created by a rebuild, outside the submission
+        ResultsTable(version).rebuild()
+        empty = (None, ) * 4
+        self.assertEqual([(g1.id, g1.token) + empty + ('e,f', None, 3, None)],
+            self.results(version))
+
+        # edits and answer_question update the row
+        form = SurveyForm({names[2]:'4', names[3]:'1.5'},
+            survey_version=version, answer_group=g1)
+        self.assertTrue(form.is_valid())
+        form.save()
+        g2 = AnswerGroup.factory(survey_version=version)
+        version.answer_question(fields['text'], g2, 'hi')
+        expected = [
+            (g1.id, g1.token) + empty + (None, None, 4, 1.5),
+            (g2.id, g2.token, None, 'hi') + empty + empty[:2],
+        ]
+        self.assertEqual(expected, self.results(version))
+
+        # typed columns
+        table = ResultsTable(version)
+        with connections['default'].cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM %s WHERE q_%s > 3' % (
+                table.name, fields['integer'].id))
+            self.assertEqual(1, cursor.fetchone()[0])
+
+        g2.delete()
+        self.assertEqual(expected[:1], self.results(version))
+
+        # rebuilt from scratch
+        with connections['default'].cursor() as cursor:
+            cursor.execute('DELETE FROM %s' % table.name)
+
+        out = StringIO()
+        call_command('dform_rebuild_results', version.id, stdout=out)
+        self.assertIn('with 1 rows', out.getvalue())
+        self.assertEqual(expected[:1], self.results(version))
+
+        with self.assertRaises(CommandError):
+            call_command('dform_rebuild_results', stdout=StringIO())
+
+        # document storage and imports
+        survey.answer_storage = 'document'
+        survey.save()
+        version = refetch(version)
+        importer = AnswerImporter(version)
+        importer.run([(1, {names[1]:'2', 'token':'abc'})])
+        self.assertEqual((None, ) * 5 + (2, None, None),
+            self.results(version)[-1][2:])
+
+        # dropped with the version
+        new_version = survey.new_version()
+        AnswerGroup.factory(survey_version=new_version)
+        call_command('dform_rebuild_results', survey=[survey.id],
+            stdout=StringIO())
+        self.assertTrue(ResultsTable(new_version).exists())
+        new_version.delete()
+        self.assertFalse(ResultsTable(new_version).exists())
+
+    def test_concurrent_rebuilds(self):
+        survey, fields = create_survey()
+        version = survey.latest_version
+        question = fields['text']
+        table = ResultsTable(version)
+        table.create()
+        g1 = AnswerGroup.factory(survey_version=version)
+        version.answer_question(question, g1, 'one')
+
+        # the table went away behind this process's back: the write is
+        # skipped, not failed, and the table looked up again next time
+        with connections['default'].cursor() as cursor:
+            cursor.execute('DROP TABLE %s' % table.name)
+
+        g2 = AnswerGroup.factory(survey_version=version)
+        with patch('dform.results.logger') as logger:
+            version.answer_question(question, g2, 'two')
+            self.assertEqual(1, logger.warning.call_count)
+        self.assertNotIn(('default', table.name), results._ready)
+        self.assertEqual('two', refetch(g2).answer_values()[question.id])
+
+        # replaced by a rebuild since it was checked: retried on the new one
+        table.rebuild()
+        g3 = AnswerGroup.factory(survey_version=version)
+        with patch.object(ResultsTable, 'write', autospec=True,
+                side_effect=[DatabaseError('gone'), None]) as write:
+            version.answer_question(question, g3, 'three')
+        self.assertEqual(2, write.call_count)
+
+        # rebuilds fill a new table then swap it in, groups changed during
+        # the copy are written again afterwards
+        copied = []
+
+        def write_during_copy(self, groups, name=None):
+            if name and groups[0] == g3:
+                # g1 was copied in an earlier batch
+                copied.append(name)
+                version.answer_question(question, g1, 'changed')
+            original(self, groups, name)
+
+        original = ResultsTable.write
+        with patch.object(ResultsTable, 'write', write_during_copy):
+            self.assertEqual(3, ResultsTable(version).rebuild(batch_size=1))
+
+        self.assertEqual([table.name + '_new'], copied)
+        self.assertFalse(table.exists(table.name + '_new'))
+        rows = self.results(version)
+        self.assertEqual([g1.id, g2.id, g3.id], [row[0] for row in rows])
+        self.assertEqual('changed', rows[0][3])
+
+        # deleted rows go in one statement, without introspection once the
+        # table is known
+        with CaptureQueriesContext(connections['default']) as captured:
+            results.forget_groups(version.id, [g2.id, g3.id], 'default')
+        self.assertEqual(1, len(captured.captured_queries))
+        self.assertEqual([g1.id], [row[0] for row in self.results(version)])
+
+    def test_prepared_by_edits(self):
+        # on_commit callbacks don't run inside a TestCase
+        with patch('django.db.transaction.on_commit', lambda fn: fn()):
+            survey = Survey.factory(name='survey')
+            version = survey.latest_version
+            question = survey.add_question(Text, 'text')
+            self.assertTrue(ResultsTable(version).is_current())
+
+            new_version = survey.new_version()
+            self.assertTrue(ResultsTable(new_version).is_current())
+
+        # not in use until the rebuild has been committed
+        new_version.add_question(Text, 'second')
+        new_version = refetch(new_version)
+        self.assertFalse(ResultsTable(new_version).is_current())
+
+        with patch('dform.results.logger'):
+            new_version.answer_question(question, AnswerGroup.factory(
+                survey_version=new_version), 'skipped')
+
+        version.answer_question(question, AnswerGroup.factory(
+            survey_version=version), 'written')
+        self.assertEqual(1, len(self.results(version)))
+
+# ============================================================================
+# Submission Event Log
+# ============================================================================
+
+@override_settings(DFORM_EVENT_LOG=True, DFORM_EVENTS_TOKEN='secret')
+class EventLogTests(TestCase, AdminToolsMixin):
+    def test_event_log(self):
+        self.initiate()
+        survey, fields = create_survey()
+        version = survey.latest_version
+        text = 'q_%s' % fields['text'].id
+        integer = 'q_%s' % fields['integer'].id
+
+        # submissions and edits append events
+        url = reverse('dform-survey', args=(version.id, survey.token))
+        response = self.client.post(url, {text:'a', integer:'1'})
+        self.assertEqual(302, response.status_code)
+        group = AnswerGroup.objects.get()
+
+        url = reverse('dform-survey-with-answers', args=(version.id,
+            survey.token, group.id, group.token))
+        response = self.client.post(url, {text:'a', integer:'2'})
+        self.assertEqual(302, response.status_code)
+
+        found = events.read()
+        self.assertEqual(['submit', 'edit'], [e.kind for e in found])
+        first = events.to_dict(found[0])
+        self.assertEqual(version.id, first['survey_version'])
+        self.assertEqual(group.id, first['answer_group'])
+        self.assertEqual({str(fields['text'].id):'a',
+            str(fields['integer'].id):1}, first['changes'])
+        self.assertEqual({str(fields['integer'].id):2}, found[1].changes)
+
+        # answers aren't kept without their event
+        with patch('dform.events.SubmissionEvent.objects.create',
+                side_effect=DatabaseError):
+            submit = reverse('dform-survey', args=(version.id, survey.token))
+            with self.assertRaises(DatabaseError):
+                self.client.post(submit, {text:'b', integer:'3'})
+            with self.assertRaises(DatabaseError):
+                self.client.post(url, {text:'c', integer:'4'})
+
+        self.assertEqual(1, AnswerGroup.objects.count())
+        self.assertEqual({fields['text'].id:'a', fields['integer'].id:2},
+            version.validation_plan().storage.values(group))
+        self.assertEqual(2, len(events.read()))
+
+        # append only
+        with self.assertRaises(ValueError):
+            found[0].save()
+
+        # a gap holds reading back until it settles
+        third = events.append('edit', version, group, {})
+        events.append('edit', version, group, {})
+        third.delete()
+        self.assertEqual([], events.read(found[1].id))
+        self.assertEqual(2, len(events.read()))
+        with self.settings(DFORM_EVENT_SETTLE_SECONDS=0):
+            self.assertEqual(3, len(events.read()))
+            self.assertEqual(1, len(events.read(limit=1)))
+
+        self.assertEqual([], events.poll(1000, timeout=0.1))
+
+        # long-poll view, as staff or with the token
+        feed = reverse('dform-events')
+        response = self.authed_get(feed + '?after=0&limit=1')
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(found[0].id, data['offset'])
+        self.assertEqual(['submit'], [e['kind'] for e in data['events']])
+        self.authed_get(feed + '?limit=x', response_code=400)
+
+        self.client.logout()
+        self.authed = False
+        response = self.client.get(feed, HTTP_AUTHORIZATION='Bearer secret')
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(2, len(data['events']))
+        response = self.client.get(feed)
+        self.assertEqual(302, response.status_code)
+
+        # acknowledging offsets
+        ack = reverse('dform-events-ack')
+        response = self.client.post(ack, {'consumer':'etl',
+            'offset':found[0].id}, HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(found[0].id, json.loads(
+            response.content.decode('utf-8'))['offset'])
+        self.assertEqual(found[0].id, events.get_offset('etl'))
+        response = self.client.post(ack, {'consumer':'etl', 'offset':0},
+            HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(found[0].id, events.get_offset('etl'))
+        response = self.client.post(ack, {'consumer':'etl', 'offset':9})
+        self.assertEqual(404, response.status_code)
+
+        response = self.client.get(feed + '?consumer=etl',
+            HTTP_AUTHORIZATION='Bearer secret')
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(['edit'], [e['kind'] for e in data['events']])
+
+        # command carries on from the consumer's offset
+        out = StringIO()
+        call_command('dform_tail_events', consumer='etl', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(1, len(lines))
+        self.assertEqual(found[1].id, json.loads(lines[0])['offset'])
+        self.assertEqual(found[1].id, events.get_offset('etl'))
+
+        with self.settings(DFORM_EVENT_LOG=False):
+            response = self.client.get(feed,
+                HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(404, response.status_code)
+            with self.assertRaises(CommandError):
+                call_command('dform_tail_events', stdout=StringIO())
+
+# ============================================================================
+# Submission Journal
+# ============================================================================
+
+class JournalTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_journal(self):
+        survey, fields = create_survey()
+        version = survey.latest_version
+        text = 'q_%s' % fields['text'].id
+        integer = 'q_%s' % fields['integer'].id
+        url = reverse('dform-survey', args=(version.id, survey.token))
+        patcher = patch('dform.tests.test_dform.submit_hook')
+        hook = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        with self.settings(DFORM_JOURNAL_DIR=self.directory,
+                DFORM_EVENT_LOG=True,
+                DFORM_SUBMIT_HOOK='dform.tests.test_dform.submit_hook'):
+            # submissions are journalled, not saved, the hook waits for
+            # the replay
+            response = self.client.post(url, {text:'a', integer:'1'})
+            self.assertEqual(302, response.status_code)
+            response = self.client.post(url, {text:'b'})
+            self.assertEqual(302, response.status_code)
+            self.assertEqual(0, AnswerGroup.objects.count())
+            self.assertFalse(hook.called)
+
+            # open segments are only replayed once stale
+            self.assertEqual([], journal.claim_segments())
+            journal.get_writer().close()
+            paths = journal.claim_segments()
+            self.assertEqual(1, len(paths))
+
+            # a torn final line is skipped
+            with open(paths[0], 'ab') as f:
+                f.write(b'{"id": "to')
+
+            out = StringIO()
+            with patch('dform.journal.logger') as mock_logger:
+                call_command('dform_replay_journal', throttle=0, stdout=out)
+                self.assertTrue(mock_logger.warning.called)
+
+            self.assertIn('Replayed 2 submissions', out.getvalue())
+            self.assertEqual([], os.listdir(self.directory))
+
+            groups = AnswerGroup.objects.order_by('id')
+            self.assertEqual(2, len(groups))
+            self.assertEqual({fields['text'].id:'a', fields['integer'].id:1},
+                version.validation_plan().storage.values(groups[0]))
+            self.assertEqual(['submit', 'submit'],
+                [e.kind for e in events.read()])
+            self.assertEqual(list(groups), [call[0][0].answer_group for call
+                in hook.call_args_list])
+            # the hook gets a bound, validated form like the view's
+            form = hook.call_args_list[0][0][0]
+            self.assertEqual(version, form.survey_version)
+            self.assertEqual('a', form[text].value())
+            self.assertTrue(form.is_valid())
+            self.assertEqual(1, form.cleaned_data[integer])
+            self.assertEqual({fields['text'].id:'a',
+                fields['integer'].id:1}, {key:value for key, value in
+                form.changed_answers().items() if value is not None})
+
+            # replay is idempotent
+            records = [{'id':groups[0].token, 'survey_version':version.id,
+                'ip_address':'127.0.0.1', 'answers':{}}]
+            self.assertEqual(0, journal.replay_records(records))
+
+            # as are repeats of an idempotency key
+            records = [{'id':token, 'survey_version':version.id,
+                'ip_address':'127.0.0.1', 'idempotency_key':'repeated',
+                'answers':{}} for token in ('x' * 30, 'y' * 30)]
+            self.assertEqual(1, journal.replay_records(records))
+            self.assertEqual(0, journal.replay_records(records[1:]))
+
+            # a failing hook doesn't stop the replay
+            hook.side_effect = ValueError('boom')
+            records[0]['id'] = 'z' * 30
+            records[0]['idempotency_key'] = 'other'
+            with patch('dform.journal.logger') as mock_logger:
+                self.assertEqual(1, journal.replay_records(records[:1]))
+                self.assertTrue(mock_logger.exception.called)
+            hook.side_effect = None
+
+            # a failed journal write falls back to saving
+            with patch('dform.journal.get_writer', side_effect=OSError):
+                with patch('dform.views.logger') as mock_logger:
+                    response = self.client.post(url, {text:'c'})
+                    self.assertTrue(mock_logger.exception.called)
+
+            self.assertEqual(302, response.status_code)
+            self.assertEqual(5, AnswerGroup.objects.count())
+            self.assertEqual(5, hook.call_count)
+
+        with self.assertRaises(CommandError):
+            call_command('dform_replay_journal', stdout=StringIO())
+
+    def test_interrupted_replay(self):
+        survey, fields = create_survey()
+        version = survey.latest_version
+        text = 'q_%s' % fields['text'].id
+        url = reverse('dform-survey', args=(version.id, survey.token))
+        patcher = patch('dform.tests.test_dform.submit_hook')
+        hook = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        class Crash(Exception):
+            pass
+
+        with self.settings(DFORM_JOURNAL_DIR=self.directory,
+                DFORM_EVENT_LOG=True,
+                DFORM_SUBMIT_HOOK='dform.tests.test_dform.submit_hook'):
+            for value in ('a', 'b', 'c'):
+                self.client.post(url, {text:value})
+
+            journal.get_writer().close()
+            path = journal.claim_segments()[0]
+
+            # the first batch finishes, the second commits and the process
+            # dies before its events and hook
+            follow_up = journal._follow_up
+            calls = []
+            def crash(*args, **kwargs):
+                calls.append(args)
+                if len(calls) > 1:
+                    raise Crash()
+                follow_up(*args, **kwargs)
+
+            with patch('dform.journal._follow_up', side_effect=crash):
+                with self.assertRaises(Crash):
+                    journal.replay_segment(path, batch_size=2, throttle=0)
+
+            self.assertEqual(3, AnswerGroup.objects.count())
+            self.assertEqual(2, len(events.read()))
+            self.assertEqual(2, hook.call_count)
+
+            # the rerun finishes the follow-up without repeating the first
+            # batch
+            self.assertEqual([path], journal.claim_segments())
+            self.assertEqual(0, journal.replay_segment(path, throttle=0))
+            self.assertEqual(3, AnswerGroup.objects.count())
+            groups = AnswerGroup.objects.order_by('id')
+            self.assertEqual([group.id for group in groups],
+                [event.answer_group_id for event in events.read()])
+            self.assertEqual(list(groups), [call[0][0].answer_group for call
+                in hook.call_args_list])
+            self.assertEqual([], os.listdir(self.directory))
+
+    def test_writer(self):
+        with self.settings(DFORM_JOURNAL_DIR=self.directory,
+                DFORM_JOURNAL_SEGMENT_BYTES=1):
+            writer = journal.get_writer()
+            writer.append({'id':'a'})
+            writer.append({'id':'b'})
+            writer.close()
+            self.assertEqual(2, writer.written)
+            self.assertEqual(2, writer.synced)
+
+            paths = journal.claim_segments()
+            self.assertEqual(2, len(paths))
+            self.assertEqual([{'id':'a'}, {'id':'b'}],
+                [list(journal.read_segment(path))[0] for path in paths])
+
+            # stale open segments are claimed
+            writer.append({'id':'c'})
+            with self.settings(DFORM_JOURNAL_SEGMENT_SECONDS=-1):
+                self.assertEqual(3, len(journal.claim_segments()))
+
+# ============================================================================
+# Admission Control
+# ============================================================================
+
+class AdmissionTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+
+    def test_sliding_window(self):
+        cache = caches['default']
+        # 10 hits late in one window, the next window starts with them
+        # weighted by the overlap
+        for _ in range(10):
+            self.assertFalse(over_limit('a', 10, 60, cache, now=119))
+
+        self.assertTrue(over_limit('a', 10, 60, cache, now=119))
+        self.assertTrue(over_limit('a', 10, 60, cache, now=120))
+        self.assertFalse(over_limit('a', 10, 60, cache, now=170))
+
+        # slots
+        with ConcurrencySlot('t', 1, cache) as first:
+            self.assertTrue(first.acquired)
+            with ConcurrencySlot('t', 1, cache) as second:
+                self.assertFalse(second.acquired)
+
+        with ConcurrencySlot('t', 1, cache) as third:
+            self.assertTrue(third.acquired)
+
+        # an expired slot is free again and the late release of its old
+        # holder doesn't free the new holder's slot
+        with ConcurrencySlot('t', 2, cache) as first:
+            self.assertTrue(first.acquired)
+            cache.delete(first.key)
+            with ConcurrencySlot('t', 2, cache) as second:
+                self.assertEqual(first.key, second.key)
+                first.__exit__(None, None, None)
+                with ConcurrencySlot('t', 2, cache) as third:
+                    self.assertTrue(third.acquired)
+                    with ConcurrencySlot('t', 2, cache) as fourth:
+                        self.assertFalse(fourth.acquired)
+
+        self.assertEqual({}, cache.get_many(first.keys))
+
+    def test_views(self):
+        survey, fields = create_survey()
+        version = survey.latest_version
+        url = reverse('dform-survey', args=(version.id, survey.token))
+        data = {'q_%s' % fields['text'].id:'a'}
+
+        with self.settings(DFORM_RATE_LIMITS={'ip':(2, 60)}):
+            self.assertEqual(302, self.client.post(url, data).status_code)
+            self.assertEqual(302, self.client.post(url, data).status_code)
+
+            # rejected without touching the database
+            with self.assertNumQueries(0):
+                response = self.client.post(url, data)
+            self.assertEqual(429, response.status_code)
+            self.assertEqual('60', response['Retry-After'])
+
+            # renders aren't limited
+            self.assertEqual(200, self.client.get(url).status_code)
+
+            # other IPs aren't affected
+            response = self.client.post(url, data, REMOTE_ADDR='10.0.0.1')
+            self.assertEqual(302, response.status_code)
+
+        with self.settings(DFORM_RATE_LIMITS={'survey':(1, 60)}):
+            self.assertEqual(302, self.client.post(url, data).status_code)
+            url2 = reverse('dform-survey-latest', args=(survey.id,
+                survey.token))
+            self.assertEqual(429, self.client.post(url2, data).status_code)
+
+            other, _ = create_survey()
+            url3 = reverse('dform-survey', args=(other.latest_version.id,
+                other.token))
+            self.assertEqual(302, self.client.post(url3, data).status_code)
+
+        self.assertEqual(4, AnswerGroup.objects.filter(
+            survey_version=version).count())
+
+        # at the concurrency cap
+        with self.settings(DFORM_SURVEY_CONCURRENCY=1):
+            with ConcurrencySlot(survey.token, 1):
+                self.assertEqual(429, self.client.post(url,
+                    data).status_code)
+
+            self.assertEqual(302, self.client.post(url, data).status_code)
+
+# ============================================================================
+# reCAPTCHA Verification
+# ============================================================================
+
+class VerifyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # stand-in for the reCAPTCHA siteverify endpoint, tokens starting with
+    # "good" pass once
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        data = parse_qs(self.rfile.read(length).decode('utf-8'))
+        self.server.requests.append(data)
+        time.sleep(self.server.delay)
+
+        token = data['response'][0]
+        success = token.startswith('good') and token not in self.server.used
+        self.server.used.add(token)
+        body = self.server.body or json.dumps({'success':success})
+        body = body.encode('utf-8')
+        self.send_response(self.server.status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class VerifyServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+            VerifyHandler)
+        self.connections = 0
+        self.used = set()
+        self.requests = []
+        self.delay = 0
+        self.status = 200
+        self.body = ''
+
+
+class RecaptchaTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        recaptcha.reset()
+        self.addCleanup(recaptcha.reset)
+
+        self.server = VerifyServer()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.settings_override = self.settings(DFORM_RECAPTCHA_KEY='key',
+            DFORM_RECAPTCHA_SECRET='secret', DFORM_RECAPTCHA_TIMEOUT=0.2,
+            DFORM_RECAPTCHA_FAILURE_THRESHOLD=2,
+            DFORM_RECAPTCHA_VERIFY_URL='http://127.0.0.1:%s/verify' % (
+                self.server.server_address[1]))
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    def test_verify(self):
+        self.assertTrue(recaptcha.verify('good', '10.0.0.1'))
+        self.assertFalse(recaptcha.verify('bad'))
+        self.assertFalse(recaptcha.verify(''))
+        self.assertEqual(['secret'], self.server.requests[0]['secret'])
+        self.assertEqual(['10.0.0.1'], self.server.requests[0]['remoteip'])
+
+        # one pooled connection, tokens are single use
+        self.assertFalse(recaptcha.verify('good'))
+        self.assertEqual(3, len(self.server.requests))
+        self.assertEqual(1, self.server.connections)
+
+        # passes are only cached for retries of the same submission
+        self.assertTrue(recaptcha.verify('good2', submission='1:key'))
+        self.assertTrue(recaptcha.verify('good2', submission='1:key'))
+        self.assertFalse(recaptcha.verify('good2', submission='1:other'))
+        self.assertFalse(recaptcha.verify('good2', submission='2:key'))
+        self.assertEqual(6, len(self.server.requests))
+
+        # failures are closed by default, the breaker opens
+        with patch('dform.recaptcha.logger') as mock_logger:
+            self.server.status = 500
+            self.assertFalse(recaptcha.verify('bad'))
+            self.server.status = 200
+            self.server.delay = 0.5
+            self.assertFalse(recaptcha.verify('bad'))
+            self.assertEqual(2, mock_logger.warning.call_count)
+
+        self.server.delay = 0
+        with self.settings(DFORM_RECAPTCHA_FAIL_OPEN=True):
+            self.assertTrue(recaptcha.verify('bad'))
+        self.assertEqual(8, len(self.server.requests))
+
+        # a trial call after the reset period closes it again
+        with self.settings(DFORM_RECAPTCHA_RESET_SECONDS=0):
+            self.assertFalse(recaptcha.verify('bad'))
+        self.assertEqual(9, len(self.server.requests))
+        self.assertTrue(recaptcha.BREAKER.allow())
+
+    def test_malformed_response(self):
+        # JSON that isn't an object is a failed call, counted by the breaker
+        with patch('dform.recaptcha.logger') as mock_logger:
+            for body in ('[true]', '"success"'):
+                self.server.body = body
+                self.assertFalse(recaptcha.verify('good'))
+
+            self.assertEqual(2, mock_logger.warning.call_count)
+
+        self.assertFalse(recaptcha.BREAKER.allow())
+        with self.settings(DFORM_RECAPTCHA_FAIL_OPEN=True):
+            self.assertTrue(recaptcha.verify('good'))
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_submission(self):
+        survey, fields = create_survey()
+        survey.use_recaptcha = True
+        survey.save()
+        version = survey.latest_version
+        url = reverse('dform-survey', args=(version.id, survey.token))
+        data = {'q_%s' % fields['text'].id:'a'}
+
+        # rejected before anything is written
+        response = self.client.post(url, data)
+        self.assertEqual(200, response.status_code)
+        self.assertIn('not a robot', response.content.decode('utf-8'))
+        data['g-recaptcha-response'] = 'bad'
+        response = self.client.post(url, data)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(0, AnswerGroup.objects.count())
+
+        data['g-recaptcha-response'] = 'good'
+        data['dform_idempotency_key'] = 'first-submission'
+        response = self.client.post(url, data)
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(1, AnswerGroup.objects.count())
+
+        # a solved token doesn't let other submissions through
+        data['dform_idempotency_key'] = 'second-submission'
+        response = self.client.post(url, data)
+        self.assertEqual(200, response.status_code)
+        self.assertIn('not a robot', response.content.decode('utf-8'))
+        self.assertEqual(1, AnswerGroup.objects.count())
+
+        # not verified without a secret
+        with self.settings(DFORM_RECAPTCHA_SECRET=''):
+            del data['g-recaptcha-response']
+            response = self.client.post(url, data)
+            self.assertEqual(302, response.status_code)
+
+        self.assertEqual(3, len(self.server.requests))
+
+# ============================================================================
+# Survey Transfer
+# ============================================================================
+
+def strip_ids(record):
+    # an export record with the question ids replaced by their position
+    positions = {q['id']:index for index, q in enumerate(record['questions'])}
+    record = json.loads(json.dumps(record), object_pairs_hook=OrderedDict)
+    del record['token']
+    for question in record['questions']:
+        question['id'] = positions[question['id']]
+    for version in record['versions']:
+        version['questions'] = [positions[id] for id in version['questions']]
+
+    return record
+
+
+class SurveyTransferTests(TestCase):
+    def test_export_import(self):
+        survey, fields = create_survey()
+        survey.use_recaptcha = True
+        survey.save()
+        version = survey.new_version()
+        version.remove_question(fields['text'])
+        version.add_question(Text, 'second version only')
+        QuestionOrder.objects.filter(survey_version=version,
+            question=fields['float']).update(rank=0)
+        other = Survey.factory(name='empty')
+
+        records = list(export_surveys(Survey.objects.all(), batch_size=1))
+        self.assertEqual(['survey', 'empty'], [r['name'] for r in records])
+        record = records[0]
+        self.assertEqual(9, len(record['questions']))
+        self.assertEqual([1, 2], [v['version_num'] for v in
+            record['versions']])
+        first = SurveyVersion.objects.get(survey=survey, version_num=1)
+        self.assertEqual([q.id for q in first.questions()],
+            record['versions'][0]['questions'])
+        self.assertEqual([q.id for q in version.questions()],
+            record['versions'][1]['questions'])
+
+        # through the commands and back
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, 'surveys.jsonl')
+            call_command('dform_export_surveys', survey.id, other.id,
+                output=filename, stderr=StringIO())
+
+            with self.assertRaises(CommandError):
+                call_command('dform_export_surveys', other.id + 10,
+                    output=filename, stderr=StringIO())
+
+            call_command('dform_export_surveys', output=filename,
+                stderr=StringIO())
+            call_command('dform_import_surveys', filename, stdout=StringIO())
+            self.assertEqual(4, Survey.objects.count())
+
+            lines = list(read_surveys(filename))
+            self.assertEqual([1, 2], [line_num for line_num, _ in lines])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        copy = Survey.objects.filter(name='survey').order_by('id').last()
+        self.assertNotEqual(survey.id, copy.id)
+        self.assertEqual(survey.token, copy.token)
+        self.assertTrue(copy.use_recaptcha)
+
+        copied = next(export_surveys(Survey.objects.filter(id=copy.id)))
+        self.assertEqual(strip_ids(record), strip_ids(copied))
+        self.assertEqual(list(fields['dropdown'].field_parms.items()),
+            list(copy.latest_version.questions()[2].field_parms.items()))
+
+        # the number of queries doesn't depend on the number of questions
+        def queries(size):
+            survey = create_sized_survey(size)
+            record = next(export_surveys(Survey.objects.filter(
+                id=survey.id)))
+            with CaptureQueriesContext(connections['default']) as context:
+                create_from_record(record, new_token=True)
+
+            return len(context)
+
+        self.assertEqual(queries(2), queries(30))
+
+    def test_clone(self):
+        survey, fields = create_survey()
+        survey.new_version()
+
+        copies = clone_survey(survey, name='client copy', count=3)
+        self.assertEqual(3, len(copies))
+        self.assertEqual(4, Survey.objects.count())
+        tokens = set([survey.token] + [copy.token for copy in copies])
+        self.assertEqual(4, len(tokens))
+
+        original = strip_ids(next(export_surveys(Survey.objects.filter(
+            id=survey.id))))
+        for copy in copies:
+            self.assertEqual('client copy', copy.name)
+            self.assertEqual(2, copy.surveyversion_set.count())
+            data = strip_ids(next(export_surveys(Survey.objects.filter(
+                id=copy.id))))
+            data['name'] = 'survey'
+            self.assertEqual(original, data)
+
+        # copies are independent and editable
+        copy = copies[0]
+        copy.remove_question(copy.questions()[0])
+        self.assertEqual(len(fields), len(survey.questions()))
+        self.assertEqual(len(fields) - 1, len(copy.questions()))
+
+        stdout = StringIO()
+        call_command('dform_clone_survey', survey.id, count=2, stdout=stdout)
+        self.assertEqual(6, Survey.objects.count())
+        self.assertIn('token=', stdout.getvalue())
+
+        with self.assertRaises(CommandError):
+            call_command('dform_clone_survey', 0, stdout=StringIO())
+
+    def test_import_errors(self):
+        survey, fields = create_survey()
+        record = next(export_surveys(Survey.objects.all()))
+
+        def bad(**changes):
+            data = json.loads(json.dumps(record),
+                object_pairs_hook=OrderedDict)
+            data.update(changes)
+            return data
+
+        invalid = [
+            bad(name='  '),
+            bad(versions=[]),
+            bad(versions=[{'version_num':0, 'questions':[]}]),
+            bad(versions=[{'version_num':1, 'questions':[-1]}]),
+            bad(questions=[{'id':1, 'field_key':'zz'}]),
+            bad(questions=[{'id':1, 'field_key':Dropdown.field_key,
+                'field_parms':{}}]),
+        ]
+        for data in invalid:
+            with self.assertRaises(SurveyImportError):
+                create_from_record(data)
+
+        self.assertEqual(1, Survey.objects.count())
+        self.assertEqual(len(fields), Question.objects.count())
+
+        # surveys before a bad line are kept
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, 'surveys.jsonl')
+            with open(filename, 'w') as f:
+                f.write(json.dumps(record) + '\n\n')
+                f.write(json.dumps(bad(name='')) + '\n')
+
+            with self.assertRaises(CommandError) as ar:
+                call_command('dform_import_surveys', filename,
+                    new_tokens=True, stdout=StringIO())
+
+            self.assertIn('line 3', str(ar.exception))
+            self.assertEqual(2, Survey.objects.count())
+            self.assertNotEqual(survey.token, Survey.objects.last().token)
+
+            with open(filename, 'w') as f:
+                f.write('{"name":\n')
+
+            with self.assertRaises(SurveyImportError):
+                list(read_surveys(filename))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+# ============================================================================
+# Management Commands
+# ============================================================================
+
+class ManagementCommandTests(TestCase):
+    def test_generate_data(self):
+        User.objects.create(username='one')
+        User.objects.create(username='two')
+
+        call_command('dform_generate_data', surveys=2, versions=2,
+            questions=9, groups=7, batch_size=20, seed=42, answer_rate=0.5,
+            link_model='auth.User', link_ratio=0.5, stdout=StringIO())
+
+        self.assertEqual(2, Survey.objects.count())
+        self.assertEqual(4, SurveyVersion.objects.count())
+        self.assertEqual(18, Question.objects.count())
+        self.assertEqual(36, QuestionOrder.objects.count())
+        self.assertEqual(28, AnswerGroup.objects.count())
+
+        # every field type is used and every answer passes validation
+        survey = Survey.objects.first()
+        keys = set(q.field_key for q in survey.questions())
+        self.assertEqual(9, len(keys))
+
+        for answer in Answer.objects.all():
+            answer.question.field.check_value(answer.question.field_parms,
+                answer.value)
+
+        # some groups linked, required questions always answered
+        linked = AnswerGroup.objects.exclude(content_type=None)
+        self.assertTrue(0 < linked.count() < 28)
+        self.assertIsInstance(linked.first().group_data, User)
+
+        for question in Question.objects.filter(required=True):
+            self.assertEqual(14, Answer.objects.filter(
+                question=question).count())
+
+        # same seed gives the same data
+        values = list(Answer.objects.order_by('id').values_list(
+            'answer_text', 'answer_key', 'answer_int', 'answer_float'))
+        Survey.objects.all().delete()
+        call_command('dform_generate_data', surveys=2, versions=2,
+            questions=9, groups=7, batch_size=20, seed=42, answer_rate=0.5,
+            link_model='auth.User', link_ratio=0.5, stdout=StringIO())
+
+        self.assertEqual(values, list(Answer.objects.order_by('id'
+            ).values_list('answer_text', 'answer_key', 'answer_int',
+            'answer_float')))
+
+        # answers go through the survey's storage and results tables are
+        # built for the new versions
+        Survey.objects.all().delete()
+        results._ready.clear()
+        with self.settings(DFORM_RESULTS_TABLES=True):
+            call_command('dform_generate_data', questions=9, groups=7,
+                batch_size=20, seed=42, answer_storage='document',
+                stdout=StringIO())
+
+            version = SurveyVersion.objects.get()
+            self.assertEqual('document', version.survey.answer_storage)
+            self.assertEqual(0, Answer.objects.count())
+            storage = version.validation_plan().storage
+            groups = list(version.answer_groups())
+            self.assertEqual(7, len(groups))
+            self.assertTrue(all(storage.values(group) for group in groups))
+            required = Question.objects.filter(required=True)
+            self.assertTrue(required)
+            self.assertTrue(all(question.id in storage.values(group)
+                for group in groups for question in required))
+
+            table = ResultsTable(version)
+            self.assertTrue(table.is_current())
+            with connections['default'].cursor() as cursor:
+                cursor.execute('SELECT COUNT(*) FROM %s' % table.name)
+                self.assertEqual(7, cursor.fetchone()[0])
+
+    @override_settings(DFORM_EXPORT_LAG_SECONDS=0)
+    def test_export_changes(self):
+        survey, fields = create_survey()
+        version = survey.latest_version
+        text = 'q_%s' % fields['text'].id
+        integer = 'q_%s' % fields['integer'].id
+
+        form = SurveyForm({text:'a', integer:'1'}, survey_version=version)
+        self.assertTrue(form.is_valid())
+        form.save()
+        group = form.answer_group
+
+        export = export_changes(survey)
+        self.assertFalse(export.has_more)
+        self.assertEqual(['answer_group', 'answer', 'answer'],
+            [record['type'] for record in export.records])
+        self.assertEqual(group.token, export.records[0]['token'])
+        self.assertEqual(['a', 1], [record['value'] for record in
+            export.records[1:]])
+
+        # nothing changed
+        export = export_changes(survey, export.cursor)
+        self.assertEqual([], export.records)
+        cursor = export.cursor
+
+        # clearing an answer leaves a tombstone
+        form = SurveyForm({integer:'2'}, survey_version=version,
+            answer_group=group)
+        self.assertTrue(form.is_valid())
+        form.save()
+        cleared = Tombstone.objects.get()
+        self.assertEqual(fields['text'].id, cleared.question_id)
+
+        export = export_changes(survey, cursor)
+        self.assertEqual([('answer', 2), ('deleted', None)],
+            [(record['type'], record.get('value')) for record in
+            export.records])
+        self.assertEqual('answer', export.records[1]['model'])
+        cursor = export.cursor
+
+        group2 = AnswerGroup.factory(survey_version=version)
+        group2_id = group2.id
+        group2.delete()
+        export = export_changes(survey, cursor)
+        self.assertEqual([('deleted', 'answergroup', group2_id)],
+            [(record['type'], record['model'], record['id']) for record in
+            export.records])
+
+        # paging
+        export = export_changes(survey, limit=1)
+        self.assertTrue(export.has_more)
+        self.assertEqual(3, len(export.records))
+        export = export_changes(survey, export.cursor, limit=1)
+        self.assertEqual(['deleted'], [record['type'] for record in
+            export.records])
+
+        with self.assertRaises(ExportCursorError):
+            export_changes(survey, 'junk')
+
+        # identity of the linked objects
+        user = User.objects.create(username='one', email='one@example.com')
+        AnswerGroup.objects.filter(id=group.id).update(
+            content_type=ContentType.objects.get_for_model(User),
+            object_id=user.id)
+        export = export_changes(survey, limit=1,
+            group_data_fields={'auth.User':['username']})
+        self.assertEqual({'model':'auth.user', 'id':user.id,
+            'username':'one'}, export.records[0]['group_data'])
+
+        export = export_changes(survey, limit=1, group_data_fields={})
+        self.assertEqual({'model':'auth.user', 'id':user.id},
+            export.records[0]['group_data'])
+        self.assertNotIn('group_data', export_changes(survey,
+            limit=1).records[0])
+
+        # command resumes from its cursor file
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cursor_file = os.path.join(directory, 'cursor')
+        output = os.path.join(directory, 'out.jsonl')
+
+        call_command('dform_export_changes', survey.id, limit=1,
+            cursor_file=cursor_file, output=output, stderr=StringIO())
+        with open(output) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(4, len(records))
+
+        call_command('dform_export_changes', survey.id,
+            cursor_file=cursor_file, output=output, stderr=StringIO())
+        with open(output) as f:
+            self.assertEqual(4, len(f.readlines()))
+
+        with self.assertRaises(CommandError):
+            call_command('dform_export_changes', survey.id, cursor='junk',
+                stderr=StringIO())
+
+    def test_load_test(self):
+        call_command('dform_generate_data', questions=9, groups=3, seed=1,
+            stdout=StringIO())
+        survey = Survey.objects.first()
+        answers = Answer.objects.count()
+
+        out = StringIO()
+        call_command('dform_load_test', concurrency=1, respondents=12,
+            seed=3, stdout=out)
+        text = out.getvalue()
+
+        self.assertIn('12 respondents with concurrency 1', text)
+        self.assertIn('24 requests', text)
+        self.assertIn('Error rate: 0.00%', text)
+        self.assertIn('Lock contention: 0 lock errors', text)
+        for view in ('survey', 'survey_latest', 'embedded_survey',
+                'survey_with_answers'):
+            self.assertTrue(re.search(r'^%s +GET' % view, text, re.M), view)
+
+        # new submissions were stored
+        self.assertTrue(AnswerGroup.objects.count() > 3)
+        self.assertTrue(Answer.objects.count() > answers)
+
+        # view mix and errors
+        out = StringIO()
+        with patch('dform.views.SurveyForm.save',
+                side_effect=ValueError('boom')):
+            call_command('dform_load_test', survey=survey.id,
+                mix='survey=1', respondents=2, concurrency=1, stdout=out)
+        text = out.getvalue()
+        self.assertIn('Error rate: 50.00%', text)
+        self.assertIn('2x survey POST: ValueError: boom', text)
+        self.assertNotIn('survey_latest', text)
+
+        with self.assertRaises(CommandError):
+            call_command('dform_load_test', mix='nope=1', stdout=StringIO())
+
+    def test_import_answers(self):
+        survey, fields = create_survey()
+        version = survey.latest_version
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        # columns by id, q_<id> and text; empty cells are not answered
+        filename = os.path.join(directory, 'answers.csv')
+        with open(filename, 'w') as f:
+            f.write('%s,q_%s,check,integer,float,ip_address\n' % (
+                fields['text'].id, fields['dropdown'].id))
+            f.write('hello,a,"e,f",3,1.5,10.0.0.1\n')
+            f.write('there,b,,4,,\n')
+            f.write('\n')
+            f.write('again,,f,5,2,\n')
+
+        out = StringIO()
+        call_command('dform_import_answers', str(version.id), filename,
+            batch_size=2, stdout=out)
+        self.assertIn('Imported 3 AnswerGroups and 12 Answers', out.getvalue())
+
+        groups = AnswerGroup.objects.filter(survey_version=version).order_by(
+            'id')
+        self.assertEqual(3, groups.count())
+        self.assertEqual('10.0.0.1', groups[0].ip_address)
+        self.assertEqual('0.0.0.0', groups[1].ip_address)
+        answers = {a.question_id:a.value for a in groups[0].answer_set.all()}
+        self.assertEqual({
+            fields['text'].id:'hello',
+            fields['dropdown'].id:'a',
+            fields['checkboxes'].id:'e,f',
+            fields['integer'].id:3,
+            fields['float'].id:1.5,
+        }, answers)
+        self.assertEqual(3, groups[1].answer_set.count())
+
+        # JSON Lines, lists for multiple choices, worker processes
+        filename = os.path.join(directory, 'answers.jsonl')
+        with open(filename, 'w') as f:
+            for num in range(5):
+                f.write(json.dumps({
+                    'q_%s' % fields['checkboxes'].id:['e', 'f'],
+                    'rating':num + 1,
+                    'token':'token%s' % num,
+                }) + '\n')
+
+        importer = import_answers(version, filename, workers=2,
+            batch_size=2)
+        self.assertEqual((5, 10), (importer.groups, importer.answers))
+        group = AnswerGroup.objects.get(token='token4')
+        self.assertEqual(5, group.answer_set.get(
+            question=fields['rating']).value)
+
+        # tokens repeated within a file or already used in the version
+        filename = os.path.join(directory, 'tokens.jsonl')
+        with open(filename, 'w') as f:
+            for token in ['new1', 'new1', 'token4', 'new2']:
+                f.write(json.dumps({'rating':1, 'token':token}) + '\n')
+
+        before = AnswerGroup.objects.count()
+        with self.assertRaises(AnswerImportError) as context:
+            import_answers(version, filename)
+        self.assertIn('line 2: token "new1" is already used on line 1',
+            str(context.exception))
+
+        with self.assertRaises(AnswerImportError) as context:
+            import_answers(version, filename, batch_size=1)
+        self.assertIn('line 2: token "new1" is already used in this survey',
+            str(context.exception))
+        self.assertEqual(before + 1, AnswerGroup.objects.count())
+        AnswerGroup.objects.filter(token='new1').delete()
+
+        importer = import_answers(version, filename, skip_invalid=True)
+        self.assertEqual(2, importer.groups)
+        self.assertEqual([2, 3], [e[0] for e in importer.skipped])
+        self.assertEqual(2, AnswerGroup.objects.get(
+            token='token4').answer_set.count())
+        self.assertEqual(before + 2, AnswerGroup.objects.count())
+        AnswerGroup.objects.filter(token__in=['new1', 'new2']).delete()
+
+        # invalid rows stop the import or are skipped
+        filename = os.path.join(directory, 'bad.csv')
+        with open(filename, 'w') as f:
+            f.write('integer,drop,unknown\n')
+            f.write('1,a,\n')
+            f.write('x,a,\n')
+            f.write('2,z,\n')
+            f.write('3,a,oops\n')
+            f.write('4,b,\n')
+
+        with self.assertRaises(CommandError) as context:
+            call_command('dform_import_answers', str(version.id), filename,
+                stdout=StringIO())
+        self.assertIn('line 3: column "integer"', str(context.exception))
+
+        before = AnswerGroup.objects.count()
+        importer = import_answers(version, filename, skip_invalid=True)
+        self.assertEqual(2, importer.groups)
+        self.assertEqual([2, 3, 4], [e[0] - 1 for e in importer.skipped])
+        self.assertIn('unknown column', importer.skipped[2][1])
+        self.assertEqual(before + 2, AnswerGroup.objects.count())
+
+        # resuming from a checkpoint skips the rows already imported
+        checkpoint = os.path.join(directory, 'checkpoint.json')
+        with open(checkpoint, 'w') as f:
+            json.dump({'survey_version':version.id, 'rows':4}, f)
+
+        importer = import_answers(version, filename, skip_invalid=True,
+            checkpoint=checkpoint)
+        self.assertEqual(1, importer.groups)
+        self.assertEqual(5, importer.rows_done)
+        self.assertFalse(os.path.exists(checkpoint))
+
+        with open(checkpoint, 'w') as f:
+            json.dump({'survey_version':version.id + 1, 'rows':4}, f)
+        with self.assertRaises(AnswerImportError):
+            import_answers(version, filename, checkpoint=checkpoint)
+        os.remove(checkpoint)
+
+        # the checkpoint is written in the batch's transaction, one whose
+        # batch rolled back doesn't skip its rows
+        class Crash(Exception):
+            pass
+
+        before = AnswerGroup.objects.count()
+        write_checkpoint = AnswerImporter._write_checkpoint
+        def crash(importer, rows, token=None):
+            write_checkpoint(importer, rows, token)
+            if token and importer.rows_done >= 2:
+                raise Crash()
+
+        with patch.object(AnswerImporter, '_write_checkpoint', crash):
+            with self.assertRaises(Crash):
+                import_answers(version, filename, skip_invalid=True,
+                    checkpoint=checkpoint, batch_size=2)
+
+        self.assertEqual(before + 1, AnswerGroup.objects.count())
+        with open(checkpoint) as f:
+            data = json.load(f)
+        self.assertEqual((5, 4), (data['rows'], data['previous']))
+
+        importer = import_answers(version, filename, skip_invalid=True,
+            checkpoint=checkpoint, batch_size=2)
+        self.assertEqual(1, importer.groups)
+        self.assertEqual(before + 2, AnswerGroup.objects.count())
+
+# ============================================================================
+# Benchmarks
+# ============================================================================
+
+BENCHMARKS_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__)))), 'benchmarks')
+
+class BenchmarkTests(TestCase):
+    def test_benchmarks(self):
+        # every benchmark runs once at a small scale, so one broken by a
+        # change to the code it times fails here rather than in a timing run
+        sys.path.insert(0, BENCHMARKS_DIR)
+        self.addCleanup(sys.path.remove, BENCHMARKS_DIR)
+        from harness import BENCHMARKS, Benchmark, measure
+        import suite    # noqa, registers the benchmarks
+
+        self.assertIn('clone_survey', BENCHMARKS)
+        for name, bench in BENCHMARKS.items():
+            result = measure(bench, 2, 1)
+            self.assertLess(0, result['queries'], name)
+            self.assertLessEqual(result['wall']['min'],
+                result['wall']['max'], name)
+
+        # each run is rolled back and re-seeded, repeats do the same work
+        seen = []
+
+        def run(survey):
+            seen.append((survey.surveyversion_set.count(), random.random()))
+            survey.new_version()
+
+        measure(Benchmark('repeats', lambda scale: Survey.factory('bench'),
+            run), 2, 3)
+        self.assertEqual(5, len(seen))
+        self.assertEqual(1, len(set(seen)))
@@ -0,0 +1,122 @@
+# dform.tracing.py
+#
+# Per-submission timing breakdown.  A survey POST is split into spans (form
+# construction, validation, saving, hooks, redirect and rendering) and slow
+# submissions are sent to a sink, by default one JSON log line.
+import json, logging, threading, time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from wrench.utils import dynamic_load
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+# ============================================================================
+
+class Trace(object):
+    """Timings for one request.  Each span is a named block of code; a span
+    entered more than once (e.g. ``check_value`` for each answer) adds up its
+    time and counts how many times it was run.
+    """
+    def __init__(self, name, **tags):
+        self.name = name
+        self.tags = tags
+        self.spans = OrderedDict()
+        self.start = time.time()
+        self.total = None
+
+    @contextmanager
+    def span(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            seconds, count = self.spans.get(name, (0.0, 0))
+            self.spans[name] = (seconds + elapsed, count + 1)
+
+    def finish(self):
+        self.total = time.time() - self.start
+
+    def as_dict(self):
+        data = OrderedDict([
+            ('trace', self.name),
+            ('total_ms', round(self.total * 1000, 3)),
+        ])
+        data.update(sorted(self.tags.items()))
+        data['spans'] = OrderedDict((name, OrderedDict([
+            ('ms', round(seconds * 1000, 3)),
+            ('count', count),
+        ])) for name, (seconds, count) in self.spans.items())
+        return data
+
+
+def current():
+    """Returns the :class:`Trace` for the request being handled by this
+    thread, or None."""
+    return getattr(_local, 'trace', None)
+
+
+@contextmanager
+def span(name):
+    """Times the enclosed block as a span of the current trace; does nothing
+    if there isn't one."""
+    trace = current()
+    if trace is None:
+        yield
+        return
+
+    with trace.span(name):
+        yield
+
+
+def log_sink(data):
+    """Default sink, logs the trace as a single JSON line."""
+    logger.info('submission %s', json.dumps(data))
+
+
+def traced_submission(name):
+    """View decorator that traces POST requests.  Tracing is off unless
+    ``settings.DFORM_TRACE_THRESHOLD`` is set; traces of submissions taking
+    at least that many seconds are passed to the callable named in
+    ``settings.DFORM_TRACE_SINK`` (default :func:`log_sink`).  The view tags
+    the trace with its survey version by setting ``request.dform_version_id``.
+    """
+    def decorator(target):
+        @wraps(target)
+        def wrapper(request, *args, **kwargs):
+            threshold = getattr(settings, 'DFORM_TRACE_THRESHOLD', None)
+            if threshold is None or request.method != 'POST':
+                return target(request, *args, **kwargs)
+
+            trace = Trace(name)
+            previous = current()
+            _local.trace = trace
+            try:
+                response = target(request, *args, **kwargs)
+            finally:
+                _local.trace = previous
+                trace.finish()
+
+            if trace.total < threshold:
+                return response
+
+            trace.tags.update({
+                'survey_version':getattr(request, 'dform_version_id', None),
+                'status_code':response.status_code,
+            })
+
+            sink = getattr(settings, 'DFORM_TRACE_SINK', '')
+            sink = dynamic_load(sink) if sink else log_sink
+            try:
+                sink(trace.as_dict())
+            except Exception:
+                logger.exception('Trace sink %s failed', sink)
+
+            return response
+        return wrapper
+    return decorator
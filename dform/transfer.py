@@ -0,0 +1,340 @@
+# dform.transfer.py
+#
+# Bulk export, import and cloning of survey definitions: surveys with all of
+# their versions, questions and question ordering, but not their answers.
+# Exports are JSON Lines, one survey per line.  Imports write each survey
+# with a few bulk_create() calls in a single transaction instead of going
+# through Survey.factory() and add_question().
+import io, json
+from collections import OrderedDict, defaultdict
+
+import six
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from . import results
+from .fields import FIELDS_DICT
+from .models import (Survey, SurveyVersion, Question, QuestionOrder,
+    _generate_token)
+
+# ============================================================================
+
+class SurveyImportError(Exception):
+    """Raised when a survey can't be imported.
+
+    :param line: line number in the source file, 0 if not line specific
+    """
+    def __init__(self, message, line=0):
+        super(SurveyImportError, self).__init__(message, line)
+        self.message = message
+        self.line = line
+
+    def __str__(self):
+        if self.line:
+            return 'line %s: %s' % (self.line, self.message)
+
+        return self.message
+
+# ----------------------------------------------------------------------------
+# Export
+# ----------------------------------------------------------------------------
+
+def _survey_record(survey, versions, orders, questions):
+    used = set()
+    version_data = []
+    for version in versions:
+        ids = orders[version.id]
+        used.update(ids)
+        version_data.append(OrderedDict([
+            ('version_num', version.version_num),
+            ('success_redirect', version.success_redirect),
+            ('questions', ids),
+        ]))
+
+    question_data = []
+    for question in questions:
+        if question.id in used:
+            question_data.append(OrderedDict([
+                ('id', question.id),
+                ('field_key', question.field_key),
+                ('text', question.text),
+                ('required', question.required),
+                ('field_parms', question.field_parms),
+            ]))
+
+    return OrderedDict([
+        ('name', survey.name),
+        ('token', survey.token),
+        ('success_redirect', survey.success_redirect),
+        ('use_recaptcha', survey.use_recaptcha),
+        ('answer_storage', survey.answer_storage),
+        ('questions', question_data),
+        ('versions', version_data),
+    ])
+
+
+def export_surveys(surveys, batch_size=100):
+    """Generator returning a dictionary describing each survey, with all of
+    its versions and their questions in order.  Surveys are read in batches
+    with four queries per batch however many questions they have.
+
+    Format:
+
+    .. code-block::python
+
+        {
+            'name':survey_name,
+            'token':survey_token,
+            'success_redirect':redirect,
+            'use_recaptcha':use_recaptcha,
+            'answer_storage':storage_backend_name,
+            'questions':[{
+                'id':question_id,
+                'field_key':question_field_key,
+                'text':question_text,
+                'required':is_question_required,
+                'field_parms':OrderedDict(*field_parm_tuples),
+            }, ...],
+            'versions':[{
+                'version_num':version_number,
+                'success_redirect':redirect,
+                'questions':[question_id, ...],
+            }, ...],
+        }
+
+    Question ids only link the versions to the questions within a survey,
+    imports create new ones.
+
+    :param surveys:
+        queryset of :class:`Survey` objects to export
+    :param batch_size:
+        number of surveys read at a time
+    """
+    survey_ids = list(surveys.order_by('id').values_list('id', flat=True))
+    for start in range(0, len(survey_ids), batch_size):
+        batch = survey_ids[start:start + batch_size]
+
+        versions = defaultdict(list)
+        for version in SurveyVersion.objects.filter(
+                survey_id__in=batch).order_by('version_num'):
+            versions[version.survey_id].append(version)
+
+        orders = defaultdict(list)
+        rows = QuestionOrder.objects.filter(
+            survey_version__survey_id__in=batch).order_by('rank',
+            'id').values_list('survey_version_id', 'question_id')
+        for version_id, question_id in rows:
+            orders[version_id].append(question_id)
+
+        questions = defaultdict(list)
+        for question in Question.objects.filter(
+                survey_id__in=batch).order_by('id'):
+            questions[question.survey_id].append(question)
+
+        for survey in Survey.objects.filter(id__in=batch).order_by('id'):
+            yield _survey_record(survey, versions[survey.id], orders,
+                questions[survey.id])
+
+
+def write_surveys(surveys, out, batch_size=100):
+    """Writes :func:`export_surveys` to a text file as JSON Lines.
+
+    :returns:
+        number of surveys written
+    """
+    count = 0
+    for record in export_surveys(surveys, batch_size):
+        # keys aren't sorted, field_parms keep their order
+        out.write(u'%s\n' % json.dumps(record))
+        count += 1
+
+    return count
+
+# ----------------------------------------------------------------------------
+# Import
+# ----------------------------------------------------------------------------
+
+def read_surveys(filename, encoding='utf-8'):
+    """Generator returning ``(line number, record)`` for each survey in a
+    JSON Lines file written by :func:`write_surveys`.
+
+    :raises SurveyImportError:
+        if a line isn't valid JSON
+    """
+    with io.open(filename, encoding=encoding) as f:
+        for line_num, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+
+            try:
+                record = json.loads(line, object_pairs_hook=OrderedDict)
+            except ValueError as e:
+                raise SurveyImportError('invalid JSON: %s' % e, line_num)
+
+            yield line_num, record
+
+
+def _check_record(record):
+    # raises SurveyImportError if the record can't be created
+    if not isinstance(record, dict):
+        raise SurveyImportError('expected a survey object')
+
+    name = record.get('name', '')
+    if not isinstance(name, six.string_types) or not name.strip():
+        raise SurveyImportError('name cannot be blank')
+
+    keys = set()
+    for question in record.get('questions', []):
+        try:
+            field = FIELDS_DICT[question['field_key']]
+            field.check_field_parms(question.get('field_parms', {}))
+            keys.add(question['id'])
+        except (KeyError, TypeError):
+            raise SurveyImportError('invalid question %s' % (
+                json.dumps(question)))
+        except ValidationError as e:
+            raise SurveyImportError('question %s: %s' % (question['id'],
+                '; '.join(e.messages)))
+
+    versions = record.get('versions', [])
+    if not versions:
+        raise SurveyImportError('survey has no versions')
+
+    numbers = set()
+    for version in versions:
+        number = version.get('version_num')
+        if not isinstance(number, int) or number < 1 or number in numbers:
+            raise SurveyImportError('invalid version_num %s' % number)
+
+        numbers.add(number)
+        ids = version.get('questions', [])
+        if len(set(ids)) != len(ids) or not keys.issuperset(ids):
+            raise SurveyImportError('version %s has unknown or repeated '
+                'questions' % number)
+
+
+def _fill_ids(objects, queryset):
+    # Only PostgreSQL returns ids from bulk_create.  The objects all belong
+    # to a survey created in the same transaction, so elsewhere the ids are
+    # the survey's rows in the order they were inserted.
+    if not objects or objects[0].id:
+        return
+
+    ids = queryset.order_by('id').values_list('id', flat=True)
+    for obj, id in zip(objects, ids):
+        obj.id = id
+
+
+@transaction.atomic
+def create_survey(record, name=None, new_token=False):
+    """Creates a survey from a dictionary in the :func:`export_surveys`
+    format, in one transaction.
+
+    :param record:
+        dictionary describing the survey
+    :param name:
+        name for the survey, defaults to the one in ``record``
+    :param new_token:
+        generate a new token instead of keeping the one in ``record``
+    :returns:
+        newly created :class:`Survey`
+    :raises SurveyImportError:
+        if ``record`` isn't valid
+    """
+    _check_record(record)
+
+    token = record.get('token')
+    if new_token or not token:
+        token = _generate_token()
+
+    survey = Survey(name=(name or record['name']).strip(), token=token,
+        success_redirect=record.get('success_redirect', ''),
+        use_recaptcha=record.get('use_recaptcha', False),
+        answer_storage=record.get('answer_storage', 'rows'))
+
+    # bulk_create() skips the post_save signal that adds a first version
+    Survey.objects.bulk_create([survey])
+    if not survey.id:
+        survey.id = Survey.objects.filter(token=token).order_by(
+            '-id').values_list('id', flat=True)[0]
+
+    versions = [SurveyVersion(survey=survey,
+        version_num=data['version_num'],
+        success_redirect=data.get('success_redirect', ''))
+        for data in record['versions']]
+    SurveyVersion.objects.bulk_create(versions)
+    _fill_ids(versions, SurveyVersion.objects.filter(survey=survey))
+
+    questions = OrderedDict()
+    for data in record.get('questions', []):
+        questions[data['id']] = Question(survey=survey,
+            field_key=data['field_key'], text=data.get('text', ''),
+            required=data.get('required', False),
+            field_parms=data.get('field_parms', {}))
+
+    Question.objects.bulk_create(list(questions.values()))
+    _fill_ids(list(questions.values()), Question.objects.filter(
+        survey=survey))
+
+    Link = Question.survey_versions.through
+    links = []
+    orders = []
+    for version, data in zip(versions, record['versions']):
+        for rank, key in enumerate(data.get('questions', []), 1):
+            question = questions[key]
+            links.append(Link(question_id=question.id,
+                surveyversion_id=version.id))
+            orders.append(QuestionOrder(survey_version=version,
+                question=question, rank=rank))
+
+    Link.objects.bulk_create(links)
+    QuestionOrder.objects.bulk_create(orders)
+    for version in versions:
+        results.prepare(version)
+
+    return survey
+
+
+def import_surveys(records, new_tokens=False, progress=None):
+    """Creates a survey for each ``(line number, record)`` from
+    :func:`read_surveys`, each in its own transaction.  Surveys created
+    before one that fails are kept.
+
+    :param new_tokens:
+        generate new tokens instead of keeping the exported ones
+    :param progress:
+        optional callable passed each newly created :class:`Survey`
+    :returns:
+        number of surveys created
+    :raises SurveyImportError:
+        if a record isn't valid
+    """
+    count = 0
+    for line_num, record in records:
+        try:
+            survey = create_survey(record, new_token=new_tokens)
+        except SurveyImportError as e:
+            raise SurveyImportError(e.message, line_num)
+
+        count += 1
+        if progress:
+            progress(survey)
+
+    return count
+
+
+def clone_survey(survey, name=None, count=1):
+    """Deep copies a survey, with all of its versions and questions, under
+    new tokens.  The survey is read once however many copies are made.
+
+    :param name:
+        name for the copies, defaults to the survey's
+    :param count:
+        number of copies to make
+    :returns:
+        list of the new :class:`Survey` objects
+    """
+    surveys = Survey.objects.filter(id=survey.id)
+    record = next(export_surveys(surveys))
+    return [create_survey(record, name, new_token=True) for _ in
+        range(count)]
@@ -0,0 +1,154 @@
+# dform.validation.py
+#
+# Compiled validation for a SurveyVersion: one validating and converting
+# closure per question, built once per revision of the version and shared
+# by SurveyForm, SurveyVersion.answer_question() and JSON style callers.
+import threading
+from collections import namedtuple, OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+
+# ============================================================================
+
+Rule = namedtuple('Rule', ['question', 'name', 'field', 'storage_key',
+    'coerce'])
+Rule.__doc__ = """Validation for a single question.  ``coerce(value)``
+raises :class:`ValidationError` for a bad value and otherwise returns it
+converted for storage in the ``storage_key`` column of an :class:`Answer`.
+``name`` is the question's :class:`SurveyForm` field name."""
+
+
+def is_empty(value):
+    return value is None or value == '' or value == [] or value == ()
+
+
+def compile_rule(question):
+    """Returns the :class:`Rule` for a :class:`Question`."""
+    field = question.field
+    if hasattr(field, 'coercer'):
+        coerce = field.coercer(question.field_parms)
+    else:
+        # field classes from outside dform only have check_value
+        def coerce(value):
+            field.check_value(question.field_parms, value)
+            return value
+
+    return Rule(question, 'q_%s' % question.id, field, field.storage_key,
+        coerce)
+
+
+class ValidationPlan(object):
+    """The compiled :class:`Rule` objects for the questions of a
+    :class:`SurveyVersion`, in order, and the :class:`.AnswerStorage` its
+    answers are written with.  Get one with
+    :func:`SurveyVersion.validation_plan` rather than building it directly,
+    plans are cached for reuse by :func:`cached_plan`.
+    """
+    def __init__(self, survey_version):
+        self.survey_version_id = survey_version.id
+        # kept here as every write path already has the plan
+        self.storage = survey_version.survey.answer_storage_backend
+        self.rules = tuple(compile_rule(question) for question in
+            survey_version.questions())
+        self.by_id = {rule.question.id:rule for rule in self.rules}
+
+    def rule(self, question):
+        """Returns the :class:`Rule` for a :class:`Question` or question id.
+
+        :raises AttributeError:
+            if the question isn't part of the survey version
+        """
+        question_id = getattr(question, 'id', question)
+        try:
+            return self.by_id[int(question_id)]
+        except (KeyError, TypeError, ValueError):
+            raise AttributeError('Question %s is not in SurveyVersion %s' % (
+                question_id, self.survey_version_id))
+
+    def validate(self, data):
+        """Validates a dictionary of answers, for example the body of a JSON
+        request.  Keys are question ids or form field names (``q_<id>``).
+        Empty values are left out and multiple choice values may be lists.
+
+        :returns:
+            tuple of a dictionary mapping question ids to values ready for
+            storage and a dictionary mapping keys to error messages, the
+            latter empty if everything is valid
+        """
+        values = {}
+        errors = {}
+        failed = set()
+        for key, value in data.items():
+            text = str(key)
+            if text.startswith('q_'):
+                text = text[2:]
+
+            try:
+                rule = self.rule(text)
+            except AttributeError:
+                errors[key] = 'Unknown question'
+                continue
+
+            if is_empty(value):
+                continue
+
+            try:
+                values[rule.question.id] = rule.coerce(value)
+            except ValidationError as e:
+                errors[key] = '; '.join(e.messages)
+                failed.add(rule.question.id)
+
+        for rule in self.rules:
+            question_id = rule.question.id
+            if rule.question.required and question_id not in values and \
+                    question_id not in failed:
+                errors[rule.name] = 'This field is required.'
+
+        return values, errors
+
+# ============================================================================
+# Process Cache
+# ============================================================================
+
+_plans = OrderedDict()
+_plans_lock = threading.Lock()
+
+def _cache_size():
+    return getattr(settings, 'DFORM_VALIDATION_PLAN_CACHE_SIZE', 1000)
+
+
+def plan_key(survey_version):
+    """Returns the key a version's plan is cached under.  Every change to a
+    version's questions increments its ``revision``, and ``created`` tells
+    apart versions given the id of a deleted one."""
+    return (survey_version.id, survey_version.created,
+        survey_version.revision, survey_version.survey.answer_storage)
+
+
+def cached_plan(survey_version):
+    """Returns the :class:`ValidationPlan` for a version from the cache of
+    this process, compiling it on first use.  The least recently used plans
+    are dropped once there are more than
+    ``settings.DFORM_VALIDATION_PLAN_CACHE_SIZE`` (default 1000).
+    """
+    key = plan_key(survey_version)
+    with _plans_lock:
+        plan = _plans.pop(key, None)
+        if plan is not None:
+            _plans[key] = plan
+            return plan
+
+    plan = ValidationPlan(survey_version)
+    with _plans_lock:
+        _plans[key] = plan
+        while len(_plans) > _cache_size():
+            _plans.popitem(last=False)
+
+    return plan
+
+
+def clear_plans():
+    """Empties the cache of this process."""
+    with _plans_lock:
+        _plans.clear()
@@ -7,16 +7,27 @@ from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.staticfiles.storage import staticfiles_storage
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
-from django.http import JsonResponse, HttpResponseRedirect, Http404
+from django.db import router, transaction
+from django.http import (JsonResponse, HttpResponse, HttpResponseRedirect,
+    Http404, FileResponse)
 from django.shortcuts import get_object_or_404, render
 from django.template import Context, Template
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.csrf import csrf_exempt
 
 from awl.decorators import post_required
 from wrench.utils import dynamic_load
 
+from . import events, idempotency, journal, metrics, profiling
+from .admission import admission_control
 from .forms import SurveyForm
-from .models import (EditNotAllowedException, Survey, SurveyVersion, Question,
-    AnswerGroup)
+from .models import (EditNotAllowedException, EditConflictException,
+    DuplicateSubmissionException, Survey, SurveyVersion, Question, AnswerGroup,
+    SubmissionEvent)
+from .queries import sampled_query_log
+from .routers import primary_view
+from .sharding import shard_databases
+from .tracing import span, traced_submission
 
 logger = logging.getLogger(__name__)
 
@@ -39,8 +50,12 @@ def permission_hook(target):
 # Admin Methods 
 # ============================================================================
 
+@sampled_query_log
 @staff_member_required
 @post_required(['delta'])
+@primary_view
+@metrics.timed_view('survey_delta')
+@profiling.profiled_view('survey_delta')
 def survey_delta(request, survey_version_id):
     delta = json.loads(request.POST['delta'], object_pairs_hook=OrderedDict)
     if survey_version_id == '0':
@@ -50,15 +65,32 @@ def survey_delta(request, survey_version_id):
     else:
         version = get_object_or_404(SurveyVersion, id=survey_version_id)
 
+    request.dform_survey_id = version.survey_id
+    request.dform_version_id = version.id
     response = {
         'success':True,
     }
 
     try:
-        version.replace_from_dict(delta)
+        if 'operations' in delta:
+            # patch from the editor, see SurveyVersion.apply_patch()
+            response['added'] = version.apply_patch(delta)
+        else:
+            version.replace_from_dict(delta)
+
+        response['revision'] = version.revision
+
+        metrics.SURVEY_EDITS.inc(survey=version.survey_id)
     except ValidationError as ve:
         response['success'] = False
         response['errors'] = ve.params
+        if ve.code == 'base_revision':
+            # a malformed patch rather than a mistake in the survey
+            return JsonResponse(response, status=400)
+    except EditConflictException as e:
+        # someone else saved first, the editor has to reload
+        return JsonResponse({'success':False, 'conflict':True,
+            'revision':e.revision}, status=409)
     except EditNotAllowedException:
         raise Http404('Survey %s is not editable' % version.survey)
     except Question.DoesNotExist as dne:
@@ -68,7 +100,10 @@ def survey_delta(request, survey_version_id):
     return JsonResponse(response)
 
 
+@sampled_query_log
 @staff_member_required
+@metrics.timed_view('survey_editor')
+@profiling.profiled_view('survey_editor')
 def survey_editor(request, survey_version_id):
     if survey_version_id == '0':
         # new survey
@@ -77,11 +112,15 @@ def survey_editor(request, survey_version_id):
     else:
         version = get_object_or_404(SurveyVersion, id=survey_version_id)
 
+    request.dform_survey_id = version.survey_id
+    request.dform_version_id = version.id
+
     admin_link = reverse('admin:index')
     return_url = request.META.get('HTTP_REFERER', admin_link)
     save_url = reverse('dform-survey-delta', args=(version.id, ))
     data = {
         'survey_version':json.dumps(version.to_dict()),
+        'revision':version.revision,
         'save_url':save_url,
         'return_url':return_url,
     }
@@ -89,7 +128,9 @@ def survey_editor(request, survey_version_id):
     return render(request, 'dform/edit_survey.html', data)
 
 
+@sampled_query_log
 @staff_member_required
+@primary_view
 def new_version(request, survey_id):
     survey = get_object_or_404(Survey, id=survey_id)
     survey.new_version()
@@ -138,7 +179,14 @@ def answer_links(request, answer_group_id):
     """Shows links and embedding code for pointing to this AnswerGroup on an 
     HTML page so a user could edit their data.
     """
-    answer_group = get_object_or_404(AnswerGroup, id=answer_group_id)
+    # ids are only unique within a database, sharded groups are linked to
+    # with the alias of their shard
+    shard = request.GET.get('shard') or None
+    if shard and shard not in shard_databases():
+        raise Http404('Unknown shard')
+
+    answer_group = get_object_or_404(AnswerGroup.objects.using(shard),
+        id=answer_group_id)
     survey_url = request.build_absolute_uri(
         reverse('dform-survey-with-answers', args=(
             answer_group.survey_version.id, 
@@ -153,10 +201,132 @@ def answer_links(request, answer_group_id):
 
     return render(request, 'dform/links_answers.html', data)
 
+
+@staff_member_required
+def _metrics_response(request):
+    return HttpResponse(metrics.REGISTRY.render(),
+        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def show_metrics(request):
+    """Shows the DForm metrics in the Prometheus text exposition format.
+    Only available when ``settings.DFORM_METRICS`` is ``True``.  Requires a
+    staff login, or for scrapers, an ``Authorization: Bearer`` header
+    matching ``settings.DFORM_METRICS_TOKEN``.
+    """
+    if not metrics.enabled():
+        raise Http404('Metrics are not enabled')
+
+    token = getattr(settings, 'DFORM_METRICS_TOKEN', '')
+    auth = request.META.get('HTTP_AUTHORIZATION', '')
+    if token and constant_time_compare(auth, 'Bearer %s' % token):
+        return HttpResponse(metrics.REGISTRY.render(),
+            content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    return _metrics_response(request)
+
+
+def _events_token_ok(request):
+    token = getattr(settings, 'DFORM_EVENTS_TOKEN', '')
+    auth = request.META.get('HTTP_AUTHORIZATION', '')
+    return token and constant_time_compare(auth, 'Bearer %s' % token)
+
+
+def _events_feed(request):
+    try:
+        limit = min(int(request.GET.get('limit', 100)), 1000)
+        timeout = min(float(request.GET.get('timeout', 0)),
+            getattr(settings, 'DFORM_EVENT_POLL_MAX_SECONDS', 30))
+        if 'after' in request.GET:
+            after = int(request.GET['after'])
+        else:
+            after = events.get_offset(request.GET.get('consumer', ''))
+    except ValueError:
+        return JsonResponse({'error':'Bad parameter'}, status=400)
+
+    found = events.poll(after, max(1, limit), max(0, timeout))
+    return JsonResponse({
+        'events':[events.to_dict(event) for event in found],
+        'offset':found[-1].id if found else after,
+    })
+
+
+@staff_member_required
+def _events_response(request):
+    return _events_feed(request)
+
+
+def event_feed(request):
+    """Returns submission log events as JSON, waiting up to ``timeout``
+    seconds (capped by ``settings.DFORM_EVENT_POLL_MAX_SECONDS``, default
+    30) for new ones.  Reads after the ``after`` offset or the offset last
+    acknowledged by ``consumer``.  Requires ``settings.DFORM_EVENT_LOG`` and
+    a staff login or an ``Authorization: Bearer`` header matching
+    ``settings.DFORM_EVENTS_TOKEN``.
+    """
+    if not events.enabled():
+        raise Http404('The event log is not enabled')
+
+    if _events_token_ok(request):
+        return _events_feed(request)
+
+    return _events_response(request)
+
+
+@csrf_exempt
+@post_required(['consumer', 'offset'])
+def event_ack(request):
+    """Acknowledges that ``consumer`` has processed the events up to
+    ``offset``.  Only accepts the ``settings.DFORM_EVENTS_TOKEN`` bearer
+    token."""
+    if not events.enabled() or not _events_token_ok(request):
+        raise Http404('Not found')
+
+    try:
+        offset = int(request.POST['offset'])
+    except ValueError:
+        return JsonResponse({'error':'Bad offset'}, status=400)
+
+    consumer = request.POST['consumer']
+    return JsonResponse({
+        'consumer':consumer,
+        'offset':events.ack(consumer, offset),
+    })
+
+
+@staff_member_required
+def profiles(request):
+    """Lists the request profiles saved in ``settings.DFORM_PROFILE_DIR``,
+    newest first."""
+    if not profiling.profile_dir():
+        raise Http404('Profiling is not enabled')
+
+    data = {
+        'title':'DForm Request Profiles',
+        'profiles':profiling.list_profiles(),
+    }
+
+    return render(request, 'dform/profiles.html', data)
+
+
+@staff_member_required
+def profile_download(request, filename):
+    """Downloads a saved profile: the ``.prof`` cProfile stats (for pstats
+    or snakeviz) or the ``.json`` description with the queries."""
+    path = profiling.profile_path(filename)
+    if not path:
+        raise Http404('No such profile')
+
+    response = FileResponse(open(path, 'rb'),
+        content_type='application/octet-stream')
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return response
+
 # ============================================================================
 # Form Views
 # ============================================================================
 
+@sampled_query_log
 @permission_hook
 def sample_survey(request, survey_version_id):
     """A view for displaying a sample version of a form.  The submit mechanism
@@ -181,28 +351,85 @@ def sample_survey(request, survey_version_id):
 
 # -------------------
 
+def _save_form(kind, version, form):
+    # saves the answers and appends their event in one transaction when the
+    # event log is on the answers' database.  With the answers on another
+    # shard their transaction commits first, so an event never refers to
+    # answers that were rolled back.
+    with transaction.atomic(using=router.db_for_write(SubmissionEvent)):
+        with transaction.atomic(using=version.answer_database):
+            with span('save'):
+                form.save()
+
+            if events.enabled():
+                with span('event_log'):
+                    events.append(kind, version, form.answer_group,
+                        form.changed_answers())
+
+
+@metrics.timed_view('survey')
+@profiling.profiled_view('survey')
+@traced_submission('survey')
 def _survey_view(request, survey_version_id, token, is_embedded):
     """General view code for handling a survey, called by survey() or
     embedded_survey()
     """
     version = get_object_or_404(SurveyVersion, id=survey_version_id,
         survey__token=token)
+    request.dform_survey_id = version.survey_id
+    request.dform_version_id = version.id
 
     if request.method == 'POST':
-        form = SurveyForm(request.POST, survey_version=version, 
-            ip_address=request.META['REMOTE_ADDR'])
-        if form.is_valid():
-            form.save()
-
-            name = getattr(settings, 'DFORM_SUBMIT_HOOK', '')
-            if name:
-                fn = dynamic_load(name)
-                fn(form)
-
-            return HttpResponseRedirect(version.on_success())
+        # a repeat of an earlier submission gets the same redirect
+        key = idempotency.clean_key(request.POST.get(idempotency.FIELD_NAME))
+        redirect = idempotency.seen(version, key)
+        if redirect is not None:
+            metrics.DUPLICATE_SUBMISSIONS.inc(survey=version.survey_id)
+            return HttpResponseRedirect(redirect)
+
+        with span('populate_fields'):
+            form = SurveyForm(request.POST, survey_version=version, 
+                ip_address=request.META['REMOTE_ADDR'])
+
+        with span('validation'):
+            is_valid = form.is_valid()
+
+        if is_valid:
+            journalled = False
+            if journal.enabled():
+                # answers reach the database when the journal is replayed
+                try:
+                    with span('journal'):
+                        journal.append(form)
+                    journalled = True
+                except (IOError, OSError):
+                    logger.exception('Journal write failed, saving directly')
+
+            if not journalled:
+                try:
+                    _save_form('submit', version, form)
+                except DuplicateSubmissionException:
+                    metrics.DUPLICATE_SUBMISSIONS.inc(survey=version.survey_id)
+                    return HttpResponseRedirect(version.on_success())
+
+            metrics.SUBMISSIONS.inc(survey=version.survey_id)
+            if not journalled:
+                # journalled submissions get their hook call on replay
+                with span('hook'):
+                    metrics.run_hook('DFORM_SUBMIT_HOOK', form)
+
+            with span('on_success'):
+                redirect = version.on_success()
+
+            idempotency.remember(version, form.idempotency_key, redirect)
+            return HttpResponseRedirect(redirect)
+
+        metrics.VALIDATION_FAILURES.inc(survey=version.survey_id)
     else:
         form = SurveyForm(survey_version=version)
 
+    metrics.RENDERS.inc(survey=version.survey_id)
+
     try:
         # check if we have an alternate submit mechanism defined
         template = Template(settings.DFORM_SURVEY_SUBMIT)
@@ -221,9 +448,12 @@ def _survey_view(request, survey_version_id, token, is_embedded):
         'submit_action':submit_action,
     }
 
-    return render(request, 'dform/survey.html', data)
+    with span('render'):
+        return render(request, 'dform/survey.html', data)
 
 
+@sampled_query_log
+@admission_control
 @permission_hook
 def survey(request, survey_version_id, token):
     """View for submitting the answers to a survey version.
@@ -234,6 +464,8 @@ def survey(request, survey_version_id, token):
     return _survey_view(request, survey_version_id, token, False)
 
 
+@sampled_query_log
+@admission_control
 @permission_hook
 def embedded_survey(request, survey_version_id, token):
     """View for submitting the answers to a survey version with additional
@@ -245,6 +477,8 @@ def embedded_survey(request, survey_version_id, token):
     return _survey_view(request, survey_version_id, token, True)
 
 
+@sampled_query_log
+@admission_control
 @permission_hook
 def survey_latest(request, survey_id, token):
     """View for submitting the answers to the latest version of a survey.
@@ -256,6 +490,8 @@ def survey_latest(request, survey_id, token):
     return _survey_view(request, survey.latest_version.id, token, False)
 
 
+@sampled_query_log
+@admission_control
 @permission_hook
 def embedded_survey_latest(request, survey_id, token):
     """View for submitting the answers to the latest version of a survey with 
@@ -269,6 +505,9 @@ def embedded_survey_latest(request, survey_id, token):
 
 #------------------
 
+@metrics.timed_view('survey_with_answers')
+@profiling.profiled_view('survey_with_answers')
+@traced_submission('survey_with_answers')
 def _survey_with_answers_view(request, survey_version_id, survey_token, 
         answer_group_id, answer_token, is_embedded):
     """General view code for editing answer for a survey.  Called by
@@ -276,24 +515,38 @@ def _survey_with_answers_view(request, survey_version_id, survey_token,
     """
     version = get_object_or_404(SurveyVersion, id=survey_version_id, 
         survey__token=survey_token)
-    answer_group = get_object_or_404(AnswerGroup, id=answer_group_id,
-        token=answer_token)
+    answer_group = get_object_or_404(
+        AnswerGroup.objects.using(version.answer_database),
+        id=answer_group_id, token=answer_token)
+    request.dform_survey_id = version.survey_id
+    request.dform_version_id = version.id
 
     if request.method == 'POST':
-        form = SurveyForm(request.POST, survey_version=version,
-            answer_group=answer_group)
-        if form.is_valid():
-            form.save()
+        with span('populate_fields'):
+            form = SurveyForm(request.POST, survey_version=version,
+                answer_group=answer_group)
 
-            name = getattr(settings, 'DFORM_EDIT_HOOK', '')
-            if name:
-                fn = dynamic_load(name)
-                fn(form)
+        with span('validation'):
+            is_valid = form.is_valid()
 
-            return HttpResponseRedirect(version.on_success())
+        if is_valid:
+            _save_form('edit', version, form)
+
+            metrics.EDITS.inc(survey=version.survey_id)
+            with span('hook'):
+                metrics.run_hook('DFORM_EDIT_HOOK', form)
+
+            with span('on_success'):
+                redirect = version.on_success()
+
+            return HttpResponseRedirect(redirect)
+
+        metrics.VALIDATION_FAILURES.inc(survey=version.survey_id)
     else:
         form = SurveyForm(survey_version=version, answer_group=answer_group)
 
+    metrics.RENDERS.inc(survey=version.survey_id)
+
     try:
         # check for alternate survey edit handler
         template = Template(settings.DFORM_SURVEY_WITH_ANSWERS_SUBMIT)
@@ -319,9 +572,12 @@ def _survey_with_answers_view(request, survey_version_id, survey_token,
         'submit_action':submit_action,
     }
 
-    return render(request, 'dform/survey.html', data)
+    with span('render'):
+        return render(request, 'dform/survey.html', data)
 
 
+@sampled_query_log
+@admission_control
 @permission_hook
 def survey_with_answers(request, survey_version_id, survey_token, 
         answer_group_id, answer_token):
@@ -334,6 +590,8 @@ def survey_with_answers(request, survey_version_id, survey_token,
         answer_group_id, answer_token, False)
 
 
+@sampled_query_log
+@admission_control
 @permission_hook
 def embedded_survey_with_answers(request, survey_version_id, survey_token, 
         answer_group_id, answer_token):
@@ -7,7 +7,7 @@ from django.conf import settings
 
 default_labels = ['dform.tests', ]
 
-def get_suite(labels=default_labels):
+def configure():
     #-- Configure Django
     BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'dform'))
 
@@ -17,7 +17,11 @@ def get_suite(labels=default_labels):
         DATABASES={
             'default':{
                 'ENGINE':'django.db.backends.sqlite3',
-            }
+            },
+            # answer shard for the sharding tests
+            'shard':{
+                'ENGINE':'django.db.backends.sqlite3',
+            },
         },
         ROOT_URLCONF='dform.tests.urls',
         MIDDLEWARE_CLASSES = (
@@ -58,6 +62,10 @@ def get_suite(labels=default_labels):
 
     django.setup()
 
+
+def get_suite(labels=default_labels):
+    configure()
+
     #from django.core.management import call_command
     #call_command('shell')
     #quit()